@@ -0,0 +1,399 @@
+# app/ann.py
+# ============================================================
+# Optional approximate-nearest-neighbour backend for retrieve_children.
+#
+# - IVF: spherical k-means centroids; every child vector lives in the
+#   inverted list of its nearest centroid.
+# - Vectors are stored as int8 codes + one float32 scale per row
+#   (~4x less RAM than float32); ids as fixed-width bytes.
+# - Rows are sorted by (list, department), so each list is split into
+#   contiguous per-department ranges. A search only scans the ranges of the
+#   caller's allowed departments and keeps probing further lists until it
+#   has enough candidates: RBAC filtering happens inside the search, not
+#   after it, so filtered queries still get a full shortlist.
+# - retrieve_children can rescore the shortlist with the full-precision
+#   embeddings stored in Chroma.
+#
+# Enabled with RETRIEVAL_BACKEND=ann. One index per index generation,
+# built in the background and persisted next to chroma_db; until it is
+# ready, queries use Chroma's exact search.
+#
+#   python -m app.ann --synthetic 200000   recall@k / latency benchmark
+#   python -m app.ann                      same, against the active index
+# ============================================================
+
+import argparse
+import glob
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+ANN_NPROBE = 32                # lists probed (more if the allowed departments are sparse)
+ANN_RESCORE_FACTOR = 4         # shortlist = k * factor when rescoring
+ANN_TRAIN_SAMPLE = 50_000
+ANN_KMEANS_ITERS = 12
+ANN_PAGE_SIZE = 5_000
+
+
+def default_n_lists(n: int) -> int:
+    return int(max(1, min(65_536, round(4 * np.sqrt(max(n, 1))))))
+
+
+def quantize(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: x ~= codes * scale."""
+    x = np.asarray(x, dtype=np.float32)
+    scale = np.abs(x).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(x / scale[:, None]), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+
+def spherical_kmeans(x: np.ndarray, n_lists: int, iters: int = ANN_KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists, len(x))
+    centroids = x[rng.choice(len(x), size=n_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = np.bincount(assign, minlength=n_lists) == 0
+        # Re-seed empty clusters with random points so every list stays useful.
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class AnnIndex:
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        codes: np.ndarray,
+        scales: np.ndarray,
+        ids: np.ndarray,
+        departments: List[str],
+        offsets: np.ndarray,
+    ) -> None:
+        self.centroids = centroids
+        self.codes = codes
+        self.scales = scales
+        self.ids = ids
+        self.departments = departments
+        self.dept_index = {d: i for i, d in enumerate(departments)}
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + self.scales.nbytes + self.ids.nbytes + self.centroids.nbytes + self.offsets.nbytes)
+
+    # ---------------------------
+    # Build
+    # ---------------------------
+    @classmethod
+    def build(
+        cls,
+        batches: Iterator[Tuple[List[str], np.ndarray, List[str]]],
+        n_lists: Optional[int] = None,
+        train_sample: int = ANN_TRAIN_SAMPLE,
+        seed: int = 0,
+    ) -> "AnnIndex":
+        """
+        Build from (ids, vectors, departments) batches in one streaming pass:
+        rows are quantized as they arrive and a reservoir sample of float
+        vectors is kept for k-means training.
+        """
+        rng = np.random.default_rng(seed)
+        codes_parts: List[np.ndarray] = []
+        scale_parts: List[np.ndarray] = []
+        ids: List[str] = []
+        dept_codes: List[int] = []
+        departments: List[str] = []
+        dept_index: Dict[str, int] = {}
+        sample: Optional[np.ndarray] = None
+        filled = 0
+        seen = 0
+
+        for batch_ids, vecs, depts in batches:
+            vecs = np.asarray(vecs, dtype=np.float32)
+            if not len(vecs):
+                continue
+            c, s = quantize(vecs)
+            codes_parts.append(c)
+            scale_parts.append(s)
+            ids.extend(batch_ids)
+            for d in depts:
+                if d not in dept_index:
+                    dept_index[d] = len(departments)
+                    departments.append(d)
+                dept_codes.append(dept_index[d])
+
+            # Reservoir sample of float rows for training (vectorized per batch).
+            if sample is None:
+                sample = np.empty((train_sample, vecs.shape[1]), dtype=np.float32)
+            fill = min(len(vecs), train_sample - filled)
+            if fill > 0:
+                sample[filled : filled + fill] = vecs[:fill]
+                filled += fill
+            rest = vecs[fill:]
+            if len(rest):
+                slots = rng.integers(0, seen + fill + np.arange(1, len(rest) + 1))
+                keep = slots < train_sample
+                sample[slots[keep]] = rest[keep]
+            seen += len(vecs)
+
+        if not ids:
+            raise ValueError("cannot build an ANN index from an empty collection")
+
+        codes = np.concatenate(codes_parts)
+        scales = np.concatenate(scale_parts)
+        depts_arr = np.asarray(dept_codes, dtype=np.int32)
+
+        centroids = spherical_kmeans(sample[:filled], n_lists or default_n_lists(len(ids)), seed=seed)
+        n_lists = len(centroids)
+
+        # Assign on dequantized rows, in chunks to bound temporary memory.
+        assign = np.empty(len(ids), dtype=np.int32)
+        for a in range(0, len(ids), ANN_PAGE_SIZE):
+            chunk = codes[a : a + ANN_PAGE_SIZE].astype(np.float32) * scales[a : a + ANN_PAGE_SIZE, None]
+            assign[a : a + ANN_PAGE_SIZE] = np.argmax(chunk @ centroids.T, axis=1)
+
+        nd = len(departments)
+        keys = assign.astype(np.int64) * nd + depts_arr
+        order = np.argsort(keys, kind="stable")
+        offsets = np.searchsorted(keys[order], np.arange(n_lists * nd + 1)).astype(np.int64)
+
+        encoded = [i.encode("utf-8") for i in ids]
+        ids_arr = np.array(encoded, dtype=f"S{max(len(e) for e in encoded)}")[order]
+        return cls(centroids, codes[order], scales[order], ids_arr, departments, offsets)
+
+    @classmethod
+    def from_collection(cls, children_col, n_lists: Optional[int] = None) -> "AnnIndex":
+        def pages():
+            offset = 0
+            while True:
+                got = children_col.get(limit=ANN_PAGE_SIZE, offset=offset, include=["embeddings", "metadatas"])
+                ids = got.get("ids") or []
+                if not ids:
+                    return
+                metas = got.get("metadatas") or [{}] * len(ids)
+                yield ids, np.asarray(got.get("embeddings"), dtype=np.float32), [(m or {}).get("department", "") for m in metas]
+                offset += len(ids)
+
+        return cls.build(pages(), n_lists=n_lists)
+
+    # ---------------------------
+    # Persistence
+    # ---------------------------
+    def save(self, path: str) -> None:
+        tmp = f"{path}.tmp.npz"
+        np.savez(
+            tmp,
+            centroids=self.centroids,
+            codes=self.codes,
+            scales=self.scales,
+            ids=self.ids,
+            departments=np.array(self.departments),
+            offsets=self.offsets,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "AnnIndex":
+        z = np.load(path)
+        return cls(z["centroids"], z["codes"], z["scales"], z["ids"], [str(d) for d in z["departments"]], z["offsets"])
+
+    # ---------------------------
+    # Search
+    # ---------------------------
+    def search(self, q: List[float], allowed_depts: List[str], k: int, nprobe: int = ANN_NPROBE) -> List[Tuple[str, float]]:
+        """Top-k (id, approx cosine) among rows whose department is allowed."""
+        dept_ids = [self.dept_index[d] for d in allowed_depts if d in self.dept_index]
+        if not dept_ids or k <= 0:
+            return []
+
+        qv = np.asarray(q, dtype=np.float32)
+        nd = len(self.departments)
+        order = np.argsort(-(self.centroids @ qv))
+
+        ranges = []
+        total = 0
+        for probed, li in enumerate(order, start=1):
+            base = int(li) * nd
+            for d in dept_ids:
+                a, b = int(self.offsets[base + d]), int(self.offsets[base + d + 1])
+                if b > a:
+                    ranges.append((a, b))
+                    total += b - a
+            # Keep probing past nprobe until the allowed departments supplied enough rows.
+            if probed >= nprobe and total >= k:
+                break
+        if not ranges:
+            return []
+
+        idx = np.concatenate([np.arange(a, b) for a, b in ranges])
+        scores = (self.codes[idx].astype(np.float32) @ qv) * self.scales[idx]
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[idx[t]].decode("utf-8"), float(scores[t])) for t in top]
+
+
+# ---------------------------
+# Per-generation manager
+# ---------------------------
+class AnnManager:
+    def __init__(self, index_dir: Optional[str]) -> None:
+        # None for in-memory Chroma: indexes are rebuilt per process, never saved.
+        self.index_dir = index_dir
+        self._indexes: Dict[int, AnnIndex] = {}
+        self._lock = threading.Lock()
+        self._building: set = set()
+        self.last_error: Optional[str] = None
+
+    def _path(self, version: int) -> Optional[str]:
+        return os.path.join(self.index_dir, f"ann_g{version}.npz") if self.index_dir else None
+
+    def get(self, version: int) -> Optional[AnnIndex]:
+        return self._indexes.get(version)
+
+    def ensure(self, version: int, children_col, background: bool = True) -> None:
+        with self._lock:
+            if version in self._indexes or version in self._building:
+                return
+            self._building.add(version)
+
+        def _run() -> None:
+            try:
+                t0 = time.monotonic()
+                path = self._path(version)
+                if path and os.path.exists(path):
+                    index = AnnIndex.load(path)
+                else:
+                    index = AnnIndex.from_collection(children_col)
+                    if path:
+                        index.save(path)
+                with self._lock:
+                    self._indexes[version] = index
+                    for v in [v for v in self._indexes if v < version]:
+                        del self._indexes[v]
+                self._prune_files(version)
+                print(f"[ann] generation {version}: {len(index)} rows, {index.nbytes / 1e6:.1f} MB, {time.monotonic() - t0:.1f}s")
+            except Exception as exc:
+                self.last_error = str(exc)
+                print(f"[ann] build failed for generation {version}: {exc}")
+            finally:
+                with self._lock:
+                    self._building.discard(version)
+
+        if background:
+            threading.Thread(target=_run, name=f"ann-build-{version}", daemon=True).start()
+        else:
+            _run()
+
+    def _prune_files(self, version: int) -> None:
+        if not self.index_dir:
+            return
+        for path in glob.glob(os.path.join(self.index_dir, "ann_g*.npz")):
+            try:
+                v = int(os.path.basename(path)[len("ann_g") : -len(".npz")])
+            except ValueError:
+                continue
+            if v < version - 1:
+                os.remove(path)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "ready": sorted(self._indexes),
+            "building": sorted(self._building),
+            "rows": {v: len(i) for v, i in self._indexes.items()},
+            "mb": {v: round(i.nbytes / 1e6, 1) for v, i in self._indexes.items()},
+            "last_error": self.last_error,
+        }
+
+
+# ---------------------------
+# Benchmark: recall@k vs exact search, latency
+# ---------------------------
+def _synthetic(n: int, dim: int, n_depts: int, seed: int = 0) -> Tuple[List[str], np.ndarray, List[str]]:
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(max(16, n // 500), dim)).astype(np.float32)
+    x = topics[rng.integers(0, len(topics), size=n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    depts = [f"dept{d}" for d in rng.integers(0, n_depts, size=n)]
+    return [f"c{i}" for i in range(n)], x, depts
+
+
+def _load_active() -> Tuple[List[str], np.ndarray, List[str]]:
+    import chromadb
+    from chromadb.config import Settings
+
+    from ingestion.ingest import CHROMA_PATH, collection_names, load_generation_state
+
+    client = chromadb.PersistentClient(path=CHROMA_PATH, settings=Settings(anonymized_telemetry=False))
+    col = client.get_or_create_collection(collection_names(int(load_generation_state()["active"]))[1])
+    got = col.get(include=["embeddings", "metadatas"])
+    return list(got["ids"]), np.asarray(got["embeddings"], dtype=np.float32), [m.get("department", "") for m in got["metadatas"]]
+
+
+def benchmark(ids: List[str], x: np.ndarray, depts: List[str], k: int = 8, queries: int = 200, seed: int = 1) -> None:
+    rng = np.random.default_rng(seed)
+    t0 = time.monotonic()
+    index = AnnIndex.build(
+        ((ids[a : a + ANN_PAGE_SIZE], x[a : a + ANN_PAGE_SIZE], depts[a : a + ANN_PAGE_SIZE]) for a in range(0, len(ids), ANN_PAGE_SIZE))
+    )
+    print(f"rows={len(ids)} dim={x.shape[1]} lists={len(index.centroids)} build={time.monotonic() - t0:.1f}s")
+    print(f"memory: float32={x.nbytes / 1e6:.1f} MB  ann(int8)={index.nbytes / 1e6:.1f} MB")
+
+    dept_names = sorted(set(depts))
+    dept_arr = np.array(depts)
+    row_of = {i: n for n, i in enumerate(ids)}
+    qs = x[rng.integers(0, len(x), size=queries)] + 0.3 * rng.normal(size=(queries, x.shape[1])).astype(np.float32)
+    qs /= np.linalg.norm(qs, axis=1, keepdims=True)
+    allowed = [list(rng.choice(dept_names, size=max(1, len(dept_names) // 3), replace=False)) for _ in range(queries)]
+
+    exact_ids, exact_ms = [], []
+    for q, allow in zip(qs, allowed):
+        t = time.perf_counter()
+        mask = np.isin(dept_arr, allow)
+        cand = np.flatnonzero(mask)
+        s = x[cand] @ q
+        exact_ids.append(set(cand[np.argsort(-s)[:k]].tolist()))
+        exact_ms.append((time.perf_counter() - t) * 1000)
+    print(f"exact (filtered brute force): p50={np.percentile(exact_ms, 50):.2f}ms p95={np.percentile(exact_ms, 95):.2f}ms")
+
+    print(f"{'nprobe':>6} {'rescore':>8} {'recall@' + str(k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for nprobe in (1, 4, 8, 16, 32):
+        for rescore in (False, True):
+            hits, lat = 0, []
+            for q, allow, truth in zip(qs, allowed, exact_ids):
+                t = time.perf_counter()
+                res = index.search(q, allow, k * ANN_RESCORE_FACTOR if rescore else k, nprobe=nprobe)
+                rows = [row_of[i] for i, _ in res]
+                if rescore and rows:
+                    s = x[rows] @ q
+                    rows = [rows[j] for j in np.argsort(-s)[:k]]
+                lat.append((time.perf_counter() - t) * 1000)
+                hits += len(truth & set(rows[:k]))
+            recall = hits / float(sum(len(t) for t in exact_ids) or 1)
+            print(f"{nprobe:>6} {str(rescore):>8} {recall:>10.3f} {np.percentile(lat, 50):>8.2f} {np.percentile(lat, 95):>8.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Recall@k and latency of the IVF-int8 index vs exact search.")
+    parser.add_argument("--synthetic", type=int, default=0, help="benchmark on N synthetic vectors instead of the active index")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--depts", type=int, default=8)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    data = _synthetic(args.synthetic, args.dim, args.depts) if args.synthetic else _load_active()
+    benchmark(*data, k=args.k, queries=args.queries)
+
+
+if __name__ == "__main__":
+    main()
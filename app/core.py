@@ -2,25 +2,46 @@
 # ============================================================
 # Shared RAG + RBAC logic used by the FastAPI backend (server.py).
 # Extracted from the old Streamlit app so it has a single home.
+#
+# Heavy dependencies (chromadb, sentence_transformers/torch, numpy,
+# google.generativeai) are not imported at module load: chromadb when a
+# RagRuntime is built, the rest on first use (RagRuntime.embedder,
+# GeminiGenerator.model). `python -m app.startup` checks this stays true.
 # ============================================================
 
 import os
-from typing import Any, Dict, List, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-import chromadb
-import google.generativeai as genai
 import yaml
-from chromadb.config import Settings
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 
-from ingestion.ingest import run_ingestion
+from app.cache import ANSWER_CACHE_SIZE, EMBEDDING_CACHE_SIZE, PARENT_CACHE_SIZE, Lazy, LRUCache, SingleFlight
+from app.embedding import EMBED_BATCH_WINDOW_MS, EMBED_MAX_BATCH, EmbeddingBatcher, load_embedder
+from app.extractive import NOT_ENOUGH_INFO, SENTENCE_CACHE_SIZE, extractive_answer
+from app.generation import LLM_DEADLINE_SECONDS, FakeGenerator, GeminiGenerator, GenerationError, ResilientGenerator
+from app.history import compact_history
+from app.index import IndexManager
+from app.intents import IntentRouter, normalize_question
+from app.policy import PolicyManager, RolePlan, department_where
+from app.scheduler import FairScheduler
+from ingestion.ingest import CHROMA_PATH, GENERATIONS_STATE_PATH
+
+if TYPE_CHECKING:
+    from app.ann import AnnIndex, AnnManager
+    from app.shards import ShardCoordinator, ShardView
 
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
 TOP_K_CHILD = 8
 MAX_PARENTS_IN_CONTEXT = 3
+PARENT_AGGREGATION = "max"     # rank parents by best child ("max") or summed child similarity ("sum")
+PARENT_OVERFETCH = 2           # children fetched per wanted parent before widening
+MAX_CHILD_FETCH = 64
 MAX_HISTORY_TURNS = 4
+INDEX_WATCH_SECONDS = 10.0
+ANSWER_MODES = ("generative", "extractive")
+RETRIEVAL_BACKEND = "chroma"   # "chroma" (exact), "ann" (IVF-int8, app/ann.py) or "sharded" (app/shards.py)
+HISTORY_MODE = "compact"       # "compact": fold old turns into a summary; "trim": drop them
 
 
 def load_yaml(path: str) -> Dict[str, Any]:
@@ -28,54 +49,194 @@ def load_yaml(path: str) -> Dict[str, Any]:
         return yaml.safe_load(f) or {}
 
 
-def allowed_departments_for_role(rules: Dict[str, Any], role: str) -> List[str]:
-    roles = rules.get("roles", {})
-    return (roles.get(role, {}) or {}).get("allow_departments", []) or []
-
-
 def trim_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
     max_items = MAX_HISTORY_TURNS * 2
     return history[-max_items:] if len(history) > max_items else history
 
 
-def format_history(history: List[Dict[str, str]]) -> str:
-    lines = []
+def format_history(history: List[Dict[str, str]], summary: str = "") -> str:
+    lines = [f"Summary of earlier conversation: {summary}"] if summary else []
     for h in history:
         prefix = "User: " if h["role"] == "user" else "Assistant: "
         lines.append(prefix + h["text"])
     return "\n".join(lines).strip()
 
 
-def retrieve_children(children_col, embedder, question: str, allowed_depts: List[str], k: int = TOP_K_CHILD) -> List[Dict[str, Any]]:
-    q_emb = embedder.encode([question], normalize_embeddings=True).tolist()[0]
-    where_filter = {"department": {"$in": allowed_depts}} if allowed_depts else {"department": "__none__"}
-
-    res = children_col.query(
-        query_embeddings=[q_emb],
-        n_results=k,
-        where=where_filter,
-        include=["documents", "metadatas", "distances"],
-    )
-
-    docs = res.get("documents", [[]])[0]
+def search_children(
+    children_col,
+    q_emb: List[float],
+    allowed_depts: List[str],
+    k: int,
+    ann: Optional["AnnIndex"] = None,
+    rescore: bool = True,
+    shards: Optional["ShardView"] = None,
+    with_documents: bool = True,
+    where: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Top-k children for a query embedding as a Chroma-shaped query result, from
+    whichever backend is active. `where` is the role's precompiled Chroma
+    filter (RolePlan.where); without it one is built from allowed_depts.
+    """
+    # Shards return None when none answered within their deadline; Chroma is the fallback.
+    res = shards.search(q_emb, allowed_depts, k, with_documents=with_documents) if shards is not None else None
+    if res is None and ann is not None:
+        res = _query_ann(children_col, ann, q_emb, allowed_depts, k, rescore, with_documents)
+    if res is None:
+        res = children_col.query(
+            query_embeddings=[q_emb],
+            n_results=k,
+            where=where if where is not None else department_where(allowed_depts),
+            include=["documents", "metadatas", "distances"] if with_documents else ["metadatas", "distances"],
+        )
+    return res
+
+
+def _query_ann(
+    children_col,
+    ann: "AnnIndex",
+    q_emb: List[float],
+    allowed_depts: List[str],
+    k: int,
+    rescore: bool,
+    with_documents: bool = True,
+) -> Dict[str, Any]:
+    """ANN shortlist (RBAC-filtered inside the index), optionally rescored on full-precision vectors from Chroma."""
+    import numpy as np
+
+    from app.ann import ANN_NPROBE, ANN_RESCORE_FACTOR
+
+    shortlist = ann.search(q_emb, allowed_depts, k * ANN_RESCORE_FACTOR if rescore else k, nprobe=ANN_NPROBE)
+    if not shortlist:
+        return {}
+
+    include = ["documents", "metadatas"] if with_documents else ["metadatas"]
+    if rescore:
+        include.append("embeddings")
+    got = children_col.get(ids=[cid for cid, _ in shortlist], include=include)
+    ids = got.get("ids") or []
+    if rescore:
+        scores = (np.asarray(got["embeddings"], dtype=np.float32) @ np.asarray(q_emb, dtype=np.float32)).tolist()
+    else:
+        approx = dict(shortlist)
+        scores = [approx[cid] for cid in ids]
+
+    scored = sorted(zip(scores, range(len(ids)), ids), key=lambda t: -t[0])[:k]
+
+    # Same shape as a Chroma query result; distance is squared L2 on unit vectors.
+    res = {
+        "ids": [[cid for _, _, cid in scored]],
+        "metadatas": [[got["metadatas"][i] for _, i, _ in scored]],
+        "distances": [[2.0 - 2.0 * score for score, _, _ in scored]],
+    }
+    if with_documents:
+        res["documents"] = [[got["documents"][i] for _, i, _ in scored]]
+    return res
+
+
+def _unique_children(res: Dict[str, Any]) -> List[Dict[str, Any]]:
+    ids = res.get("ids", [[]])[0]
     metas = res.get("metadatas", [[]])[0]
     dists = res.get("distances", [[]])[0]
+    docs = (res.get("documents") or [[None] * len(ids)])[0] or [None] * len(ids)
 
     out: List[Dict[str, Any]] = []
     seen = set()
-    for doc, meta, dist in zip(docs, metas, dists):
+    for cid, doc, meta, dist in zip(ids, docs, metas, dists):
         if not meta:
             continue
         key = (meta.get("source"), meta.get("parent_id"), meta.get("child_index"))
         if key in seen:
             continue
         seen.add(key)
-        out.append({"text": doc, "metadata": meta, "distance": float(dist)})
-
+        out.append({"id": cid, "text": doc, "metadata": meta, "distance": float(dist)})
     return out
 
 
-def build_parent_context(parents_col, retrieved_children: List[Dict[str, Any]], max_parents: int = MAX_PARENTS_IN_CONTEXT) -> Tuple[List[str], List[Dict[str, Any]]]:
+def _with_texts(children_col, children: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fill in child texts that the search did not fetch, with one get by id on the same collection."""
+    missing = [c["id"] for c in children if c.get("text") is None]
+    if not missing:
+        return children
+    got = children_col.get(ids=missing, include=["documents"])
+    texts = dict(zip(got.get("ids") or [], got.get("documents") or []))
+    return [c if c.get("text") is not None else {**c, "text": texts.get(c["id"])} for c in children]
+
+
+def retrieve_children(
+    children_col,
+    embedder,
+    question: str,
+    allowed_depts: List[str],
+    k: int = TOP_K_CHILD,
+    q_emb: Optional[List[float]] = None,
+    ann: Optional["AnnIndex"] = None,
+    rescore: bool = True,
+    shards: Optional["ShardView"] = None,
+    where: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    if q_emb is None:
+        q_emb = embedder.encode([question], normalize_embeddings=True).tolist()[0]
+    return _unique_children(search_children(children_col, q_emb, allowed_depts, k, ann, rescore, shards, where=where))
+
+
+def retrieve_parents(
+    children_col,
+    q_emb: List[float],
+    allowed_depts: List[str],
+    m: int = MAX_PARENTS_IN_CONTEXT,
+    aggregation: str = PARENT_AGGREGATION,
+    with_documents: bool = False,
+    ann: Optional["AnnIndex"] = None,
+    shards: Optional["ShardView"] = None,
+    max_children: int = MAX_CHILD_FETCH,
+    where: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Top-m parents ranked by their children's similarity to the query:
+    "max" (best child) or "sum" (over the children fetched).
+    Fetches m * PARENT_OVERFETCH children and doubles that until m distinct
+    parents are found, the filtered collection is exhausted or max_children
+    is reached. With "max" the ranking is exact once m parents are seen.
+    Each parent is {"parent_id", "score", "children"}; children carry ids,
+    metadata and distances, plus text only if with_documents.
+    """
+    if aggregation not in ("max", "sum"):
+        raise ValueError(f"aggregation must be 'max' or 'sum', got {aggregation!r}")
+
+    k = min(max_children, max(m, m * PARENT_OVERFETCH))
+    while True:
+        children = _unique_children(
+            search_children(
+                children_col, q_emb, allowed_depts, k, ann, shards=shards, with_documents=with_documents, where=where
+            )
+        )
+        groups: Dict[str, Dict[str, Any]] = {}
+        for child in children:
+            pid = child["metadata"].get("parent_id")
+            if not pid:
+                continue
+            sim = 1.0 - child["distance"] / 2.0   # squared L2 on unit vectors -> cosine
+            g = groups.get(pid)
+            if g is None:
+                groups[pid] = {"parent_id": pid, "score": sim, "children": [child]}
+                continue
+            g["score"] = max(g["score"], sim) if aggregation == "max" else g["score"] + sim
+            g["children"].append(child)
+
+        if len(groups) >= m or len(children) < k or k >= max_children:
+            break
+        k = min(max_children, k * 2)
+
+    return sorted(groups.values(), key=lambda g: -g["score"])[:m]
+
+
+def build_parent_context(
+    parents_col,
+    retrieved_children: List[Dict[str, Any]],
+    max_parents: int = MAX_PARENTS_IN_CONTEXT,
+    parent_cache: Optional[LRUCache] = None,
+) -> Tuple[List[str], List[Dict[str, Any]]]:
     parent_ids: List[str] = []
     seen = set()
 
@@ -88,17 +249,39 @@ def build_parent_context(parents_col, retrieved_children: List[Dict[str, Any]],
         if len(parent_ids) >= max_parents:
             break
 
+    return parent_context(parents_col, parent_ids, parent_cache)
+
+
+def parent_context(
+    parents_col,
+    parent_ids: List[str],
+    parent_cache: Optional[LRUCache] = None,
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Numbered context blocks and citations for the given parents, in the given order."""
     if not parent_ids:
         return [], []
 
-    got = parents_col.get(ids=parent_ids, include=["documents", "metadatas"])
-    parent_docs = got.get("documents") or []
-    parent_metas = got.get("metadatas") or []
+    found: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    if parent_cache is not None:
+        for pid in parent_ids:
+            hit = parent_cache.get(pid)
+            if hit is not None:
+                found[pid] = hit
+
+    missing = [pid for pid in parent_ids if pid not in found]
+    if missing:
+        got = parents_col.get(ids=missing, include=["documents", "metadatas"])
+        for pid, ptxt, pmeta in zip(got.get("ids") or [], got.get("documents") or [], got.get("metadatas") or []):
+            found[pid] = (ptxt, pmeta)
+            if parent_cache is not None:
+                parent_cache.put(pid, (ptxt, pmeta))
 
     context_blocks: List[str] = []
     citations: List[Dict[str, Any]] = []
 
-    for i, (ptxt, pmeta) in enumerate(zip(parent_docs, parent_metas), start=1):
+    # Keep retrieval rank order; Chroma's get() does not promise to preserve it.
+    ranked = [found[pid] for pid in parent_ids if pid in found]
+    for i, (ptxt, pmeta) in enumerate(ranked, start=1):
         context_blocks.append(f"[{i}] {ptxt}")
         citations.append(
             {
@@ -112,8 +295,14 @@ def build_parent_context(parents_col, retrieved_children: List[Dict[str, Any]],
     return context_blocks, citations
 
 
-def build_prompt(question: str, allowed_depts: List[str], history: List[Dict[str, str]], context_blocks: List[str]) -> str:
-    history_text = format_history(history)
+def build_prompt(
+    question: str,
+    allowed_depts: List[str],
+    history: List[Dict[str, str]],
+    context_blocks: List[str],
+    summary: str = "",
+) -> str:
+    history_text = format_history(history, summary)
     return f"""
 You are a helpful, professional enterprise assistant.
 
@@ -148,46 +337,331 @@ def is_streamlit_cloud() -> bool:
 
 
 class RagRuntime:
-    """Holds the heavy, shared singletons: chroma client, collections, embedder, gemini model."""
+    """
+    Holds the heavy, shared singletons: chroma client, collections, embedder, gemini model.
+    The embedder and the Gemini client are built on first use; call preload() to pay that up front.
+    """
 
     def __init__(self) -> None:
         load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
 
-        api_key = os.environ.get("GEMINI_API_KEY", "").strip()
-        model_name = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash").strip()
-        if not api_key:
-            raise RuntimeError("Missing GEMINI_API_KEY. Set it in .env or the environment.")
+        # LLM_PROVIDER=fake swaps Gemini for a local generator with injected latency/errors.
+        if os.environ.get("LLM_PROVIDER", "gemini").strip() == "fake":
+            provider = FakeGenerator(
+                latency_s=float(os.environ.get("FAKE_LLM_LATENCY_MS", "800")) / 1000.0,
+                error_rate=float(os.environ.get("FAKE_LLM_ERROR_RATE", "0")),
+            )
+        else:
+            api_key = os.environ.get("GEMINI_API_KEY", "").strip()
+            model_name = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash").strip()
+            if not api_key:
+                raise RuntimeError("Missing GEMINI_API_KEY. Set it in .env or the environment.")
+
+            provider = GeminiGenerator(model_name, api_key)
+
+        self.generator = ResilientGenerator(
+            provider,
+            deadline_s=float(os.environ.get("LLM_DEADLINE_SECONDS", LLM_DEADLINE_SECONDS)),
+            hedge=os.environ.get("LLM_HEDGE", "1").strip() != "0",
+        )
+
+        import chromadb
+        from chromadb.config import Settings
+
+        # EMBEDDER_SOCKET: use the shared embedding server (app/embed_server.py) for queries and new chunks.
+        embed_socket = os.environ.get("EMBEDDER_SOCKET", "").strip()
+        remote_embedder = None
+        if embed_socket:
+            from app.embed_server import EmbeddingClient
 
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
+            remote_embedder = EmbeddingClient(embed_socket)
 
         if is_streamlit_cloud():
             self.client = chromadb.Client(Settings(anonymized_telemetry=False))
+            self.index = IndexManager(self.client, state_path=None, embedder=remote_embedder)
         else:
             self.client = chromadb.PersistentClient(
                 path=os.path.join(PROJECT_ROOT, "chroma_db"),
                 settings=Settings(anonymized_telemetry=False),
             )
+            self.index = IndexManager(self.client, state_path=GENERATIONS_STATE_PATH, embedder=remote_embedder)
+
+        if self.index.current().children_col.count() == 0:
+            self.index.refresh(full=True)
+        self.index_watch_seconds = float(os.environ.get("INDEX_WATCH_SECONDS", INDEX_WATCH_SECONDS))
+
+        # Optional ANN backend: one index per generation, built in the background.
+        self.ann: Optional["AnnManager"] = None
+        if os.environ.get("RETRIEVAL_BACKEND", RETRIEVAL_BACKEND).strip() == "ann":
+            from app import ann as ann_backend
+
+            self.ann = ann_backend.AnnManager(None if is_streamlit_cloud() else CHROMA_PATH)
+            self.ann.ensure(self.index.version, self.index.current().children_col)
+            self.index.on_swap.append(lambda version: self.ann.ensure(version, self.index.current().children_col))
+
+        # Optional sharded tier: SHARD_COUNT worker processes, each searching its slice of the children.
+        self.shards: Optional["ShardCoordinator"] = None
+        if os.environ.get("RETRIEVAL_BACKEND", RETRIEVAL_BACKEND).strip() == "sharded":
+            if is_streamlit_cloud():
+                raise RuntimeError("RETRIEVAL_BACKEND=sharded needs the persistent Chroma store.")
+            from app import shards as shard_tier
+
+            self.shards = shard_tier.ShardCoordinator(
+                n_shards=int(os.environ.get("SHARD_COUNT", shard_tier.SHARD_COUNT)),
+                strategy=os.environ.get("SHARD_STRATEGY", shard_tier.SHARD_STRATEGY).strip(),
+                deadline_ms=float(os.environ.get("SHARD_DEADLINE_MS", shard_tier.SHARD_DEADLINE_MS)),
+            )
+            self.shards.start()
+            self.shards.load(self.index.version)
+            self.index.on_swap.append(self.shards.load)
+
+        self._embedder = Lazy(load_embedder) if remote_embedder is None else Lazy(lambda: remote_embedder)
+        # Concurrent query encodes are micro-batched; EMBED_BATCH_WINDOW_MS=0 encodes each one directly.
+        window_ms = float(os.environ.get("EMBED_BATCH_WINDOW_MS", EMBED_BATCH_WINDOW_MS))
+        self.batcher: Optional[EmbeddingBatcher] = None
+        if window_ms > 0:
+            self.batcher = EmbeddingBatcher(
+                self._encode, window_ms=window_ms, max_batch=int(os.environ.get("EMBED_MAX_BATCH", EMBED_MAX_BATCH))
+            )
 
-        self.parents_col = self.client.get_or_create_collection("rt_parents")
-        self.children_col = self.client.get_or_create_collection("rt_children")
-
-        if self.children_col.count() == 0:
-            run_ingestion(clear_existing=True, client=self.client)
-
-        self.embedder = SentenceTransformer("all-MiniLM-L6-v2")
-
-        self.rules = load_yaml(os.path.join(PROJECT_ROOT, "rbac_rules.yaml"))
-        self.users = load_yaml(os.path.join(PROJECT_ROOT, "users.yaml")).get("users", {})
-
-    def answer(self, question: str, allowed_depts: List[str], history: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, Any]]]:
-        retrieved_children = retrieve_children(self.children_col, self.embedder, question, allowed_depts)
-        context_blocks, citations = build_parent_context(self.parents_col, retrieved_children)
-
-        if not context_blocks:
-            return "I don't have enough information in the allowed documents.", []
-
-        prompt = build_prompt(question, allowed_depts, history, context_blocks)
-        resp = self.model.generate_content(prompt)
-        answer = (getattr(resp, "text", "") or "").strip()
+        # Validated at load (raises PolicyError); the server hot-reloads it with policy.start_watcher().
+        self.policy = PolicyManager()
+        self.intents = IntentRouter.from_yaml(load_yaml(os.path.join(PROJECT_ROOT, "intents.yaml")))
+        # LLM generation slots are shared fairly across users and roles (scheduler.yaml).
+        scheduler_path = os.environ.get("SCHEDULER_PATH") or os.path.join(PROJECT_ROOT, "scheduler.yaml")
+        self.scheduler = FairScheduler.from_config(load_yaml(scheduler_path))
+        self.history_mode = os.environ.get("HISTORY_MODE", HISTORY_MODE).strip()
+        self.parent_aggregation = os.environ.get("PARENT_AGGREGATION", PARENT_AGGREGATION).strip()
+
+        self.embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+        self.parent_cache = LRUCache(PARENT_CACHE_SIZE)
+        self.answer_cache = LRUCache(ANSWER_CACHE_SIZE)
+        self.sentence_cache = LRUCache(SENTENCE_CACHE_SIZE)
+        self.in_flight = SingleFlight()
+        self.warmup_report: Optional[Dict[str, Any]] = None
+
+    @property
+    def embedder(self):
+        """The SentenceTransformer (loaded from the local snapshot on first access) or the embedding-server client."""
+        return self._embedder.get()
+
+    def _backends(self, version: int) -> Tuple[Optional["AnnIndex"], Optional["ShardView"]]:
+        ann = self.ann.get(version) if self.ann is not None else None
+        shards = self.shards.get(version) if self.shards is not None else None
+        return ann, shards
+
+    def close(self) -> None:
+        """Stop background threads and worker processes."""
+        self.index.stop_watcher()
+        self.policy.stop_watcher()
+        if self.shards is not None:
+            self.shards.stop()
+
+    def preload(self) -> None:
+        """Load the lazily-built dependencies now (e.g. in a background thread at server startup)."""
+        self.embedder.encode(["warm up"], normalize_embeddings=True)
+        if isinstance(self.generator.generator, GeminiGenerator):
+            self.generator.generator.model
+
+    def embed_query(self, question: str) -> List[float]:
+        # The model is uncased, so case/whitespace variants share one vector.
+        key = " ".join(question.lower().split())
+        q_emb = self.embedding_cache.get(key)
+        if q_emb is None:
+            q_emb = self.batcher.encode(question) if self.batcher is not None else self._encode([question])[0]
+            self.embedding_cache.put(key, q_emb)
+        return q_emb
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        return self.embedder.encode(texts, normalize_embeddings=True, batch_size=max(1, len(texts))).tolist()
+
+    def embed_queries(self, questions: List[str], batch_size: int = 64) -> int:
+        """Batch-encode the questions that are not cached yet. Returns how many were encoded."""
+        todo: Dict[str, str] = {}
+        for q in questions:
+            key = " ".join(q.lower().split())
+            if key and key not in self.embedding_cache and key not in todo:
+                todo[key] = q
+        if todo:
+            vecs = self.embedder.encode(list(todo.values()), normalize_embeddings=True, batch_size=batch_size)
+            for key, vec in zip(todo, vecs.tolist()):
+                self.embedding_cache.put(key, vec)
+        return len(todo)
+
+    def answer_cache_key(
+        self, question: str, allowed_depts: List[str], version: int, mode: str = "generative"
+    ) -> Tuple[Any, ...]:
+        return (version, mode, normalize_question(question), tuple(sorted(allowed_depts)))
+
+    def summarize(self, prompt: str, user: Optional[str] = None, role: Optional[str] = None) -> str:
+        # Summaries are LLM calls too: they wait for a fair-share slot like answers do,
+        # but stay out of the answer latency statistics that drive hedging.
+        with self.scheduler.slot(user, role):
+            return self.generator.generate(prompt, track=False)
+
+    def update_history(self, session: Dict[str, Any]) -> None:
+        """Keep session["history"] bounded: by token budget + running summary, or by turn count."""
+        if self.history_mode == "compact":
+
+            def summarize(prompt: str) -> str:
+                return self.summarize(prompt, session.get("username"), session.get("role"))
+
+            compact_history(session, summarize)
+        else:
+            session["history"] = trim_history(session["history"])
+
+    def answer(
+        self,
+        question: str,
+        allowed_depts: List[str],
+        history: List[Dict[str, str]],
+        summary: str = "",
+        mode: str = "generative",
+        trace: Optional[Dict[str, Any]] = None,
+        user: Optional[str] = None,
+        role: Optional[str] = None,
+        plan: Optional[RolePlan] = None,
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        mode="generative" asks the LLM; mode="extractive" returns the best
+        retrieved sentences without it. Generative falls back to extractive
+        when the LLM is unavailable or past its deadline. If given, `trace`
+        receives how the answer was produced (trace["mode"], ...).
+
+        Concurrent history-free calls for the same question, departments and
+        index version share one pipeline run (trace["coalesced"] is True for
+        the callers that waited on another's run).
+
+        `user` is admitted against its own rate limit before any sharing
+        (RateLimited when exceeded); LLM calls wait for a fair-share slot as
+        `user`/`role`, and when none frees up in time the answer falls back
+        to extractive as well.
+
+        `plan` is the role's compiled RolePlan; retrieval then uses its
+        prebuilt `where` filter instead of building one from allowed_depts.
+        """
+        trace = trace if trace is not None else {}
+        with self.scheduler.admission(user):
+            return self._answer_admitted(question, allowed_depts, history, summary, mode, trace, user, role, plan)
+
+    def _answer_admitted(
+        self,
+        question: str,
+        allowed_depts: List[str],
+        history: List[Dict[str, str]],
+        summary: str,
+        mode: str,
+        trace: Dict[str, Any],
+        user: Optional[str],
+        role: Optional[str],
+        plan: Optional[RolePlan],
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        if history or summary:
+            return self._answer(question, allowed_depts, history, summary, mode, trace, user, role, plan)
+
+        # Only same-role callers share a run, so the LLM slot is taken under the right role weight.
+        key = (role, *self.answer_cache_key(question, allowed_depts, self.index.version, mode))
+
+        def run() -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+            run_trace: Dict[str, Any] = {}
+            answer, citations = self._answer(question, allowed_depts, [], "", mode, run_trace, user, role, plan)
+            return answer, citations, run_trace
+
+        (answer, citations, run_trace), shared = self.in_flight.do(key, run)
+        trace.update(run_trace)
+        trace["coalesced"] = shared
+        return answer, [dict(c) for c in citations]
+
+    def _answer(
+        self,
+        question: str,
+        allowed_depts: List[str],
+        history: List[Dict[str, str]],
+        summary: str,
+        mode: str,
+        trace: Dict[str, Any],
+        user: Optional[str] = None,
+        role: Optional[str] = None,
+        plan: Optional[RolePlan] = None,
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        trace["mode"] = "rag" if mode == "generative" else mode
+        where = plan.where if plan is not None else department_where(allowed_depts)
+
+        # Answers only depend on (question, departments, index) when there is no conversation context.
+        cacheable = not history and not summary
+
+        # Every lookup, including an extractive fallback after a failed LLM call, must hit the same
+        # generation, even if a swap lands in between; the lease is held until the answer is built.
+        with self.index.lease() as gen:
+            trace["index_version"] = gen.version
+            key = self.answer_cache_key(question, allowed_depts, gen.version, mode)
+            if cacheable:
+                cached = self.answer_cache.get(key)
+                if cached is not None:
+                    trace["cache"] = "hit"
+                    return cached[0], [dict(c) for c in cached[1]]
+
+            q_emb = self.embed_query(question)
+            ann, shards = self._backends(gen.version)
+            trace["retrieval"] = "sharded" if shards is not None else "ann" if ann is not None else "chroma"
+            if mode == "extractive":
+                retrieved_children = retrieve_children(
+                    gen.children_col,
+                    self.embedder,
+                    question,
+                    allowed_depts,
+                    q_emb=q_emb,
+                    ann=ann,
+                    shards=shards,
+                    where=where,
+                )
+            else:
+                # Only parent ids and scores are needed here, so child documents are not fetched.
+                parents = retrieve_parents(
+                    gen.children_col,
+                    q_emb,
+                    allowed_depts,
+                    aggregation=self.parent_aggregation,
+                    ann=ann,
+                    shards=shards,
+                    where=where,
+                )
+                retrieved_children = sorted((c for p in parents for c in p["children"]), key=lambda c: c["distance"])
+                trace["parents"] = [{"parent_id": p["parent_id"], "score": round(p["score"], 4)} for p in parents]
+                context_blocks, citations = parent_context(
+                    gen.parents_col, [p["parent_id"] for p in parents], parent_cache=self.parent_cache
+                )
+            trace["top_children"] = [
+                {
+                    "distance": r["distance"],
+                    "department": r["metadata"].get("department"),
+                    "source": r["metadata"].get("source"),
+                    "parent_index": r["metadata"].get("parent_index"),
+                    "child_index": r["metadata"].get("child_index"),
+                }
+                for r in retrieved_children
+            ]
+
+            if mode == "extractive":
+                answer, citations = extractive_answer(self.embedder, q_emb, retrieved_children, cache=self.sentence_cache)
+            elif not context_blocks:
+                answer = NOT_ENOUGH_INFO
+                citations = []
+            else:
+                prompt = build_prompt(question, allowed_depts, history, context_blocks, summary)
+                try:
+                    with self.scheduler.slot(user, role) as waited:
+                        trace["queue_wait_ms"] = round(waited * 1000, 1)
+                        answer = self.generator.generate(prompt)
+                except GenerationError as exc:
+                    # Degrade to an extractive answer instead of failing the request; that needs child texts.
+                    trace["mode"] = "extractive_fallback"
+                    trace["llm_error"] = f"{type(exc).__name__}: {exc}"
+                    # The children retrieved above, from the same leased generation; only their texts are missing.
+                    retrieved_children = _with_texts(gen.children_col, retrieved_children[:TOP_K_CHILD])
+                    answer, citations = extractive_answer(self.embedder, q_emb, retrieved_children, cache=self.sentence_cache)
+                    return answer, citations
+
+        if cacheable and answer:
+            self.answer_cache.put(key, (answer, [dict(c) for c in citations]))
         return answer, citations
@@ -0,0 +1,186 @@
+# app/embed_bench.py
+# ============================================================
+# Embedder backend checks (EMBEDDER_BACKEND in app/embedding.py).
+#
+# parity: encodes every corpus child chunk (split exactly as ingestion
+#   does) with the torch reference and each other backend, and reports the
+#   per-chunk cosine between the two vectors. Exits 1 when a backend's mean
+#   or minimum cosine is under PARITY_BUDGET.
+# bench: per backend, in a fresh interpreter so import cost and memory are
+#   not shared: load time, RSS after load and peak, single-query encode
+#   latency percentiles and batch throughput over the corpus chunks.
+#
+#   python -m app.embed_bench parity [--backends onnx onnx-int8] [--limit N]
+#   python -m app.embed_bench bench  [--backends torch onnx onnx-int8] [--threads N] [--json]
+# ============================================================
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from app.embedding import EMBEDDER_BACKENDS, PROJECT_ROOT, load_embedder
+
+# backend -> (minimum mean cosine, minimum worst-case cosine) against torch
+PARITY_BUDGET = {"onnx": (0.9999, 0.999), "onnx-int8": (0.99, 0.95)}
+BENCH_QUERIES = 200
+BENCH_QUERY_CHARS = 80      # single-query latency uses chunk prefixes of about question length
+BENCH_BATCH_SIZE = 64
+
+
+def corpus_texts(limit: Optional[int] = None) -> List[str]:
+    from ingestion.ingest import corpus_chunks
+
+    texts = corpus_chunks()
+    if not texts:
+        raise RuntimeError("No corpus chunks under data/; nothing to compare.")
+    return texts[:limit] if limit else texts
+
+
+# ---------------------------
+# Parity
+# ---------------------------
+def parity(backends: List[str], texts: List[str]) -> Dict[str, Any]:
+    import numpy as np
+
+    reference = load_embedder(backend="torch").encode(texts, normalize_embeddings=True, batch_size=BENCH_BATCH_SIZE)
+    report: Dict[str, Any] = {"chunks": len(texts), "backends": {}, "failures": []}
+    for backend in backends:
+        vecs = load_embedder(backend=backend).encode(texts, normalize_embeddings=True, batch_size=BENCH_BATCH_SIZE)
+        cos = np.sum(reference * vecs, axis=1)
+        worst = int(np.argmin(cos))
+        got = {
+            "mean": round(float(cos.mean()), 5),
+            "p01": round(float(np.percentile(cos, 1)), 5),
+            "min": round(float(cos[worst]), 5),
+            "worst_chunk": texts[worst][:80],
+        }
+        report["backends"][backend] = got
+        min_mean, min_min = PARITY_BUDGET.get(backend, (0.0, 0.0))
+        if got["mean"] < min_mean:
+            report["failures"].append(f"{backend}: mean cosine {got['mean']} < {min_mean}")
+        if got["min"] < min_min:
+            report["failures"].append(f"{backend}: min cosine {got['min']} < {min_min}")
+    return report
+
+
+# ---------------------------
+# Benchmark
+# ---------------------------
+_BENCH_PROBE = """
+import json, resource, sys, time
+from app.generation import LatencyTracker
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+
+with open({texts_path!r}, encoding="utf-8") as f:
+    texts = json.load(f)
+base_rss = rss_mb()
+t0 = time.perf_counter()
+from app.embedding import load_embedder
+model = load_embedder(backend={backend!r}, threads={threads!r})
+model.encode(["warm up"], normalize_embeddings=True)
+load_ms = (time.perf_counter() - t0) * 1000
+loaded_rss = rss_mb()
+
+single = LatencyTracker()
+for text in texts[:{queries}]:
+    t = time.perf_counter()
+    model.encode([text[:{query_chars}]], normalize_embeddings=True)
+    single.add(time.perf_counter() - t)
+
+t = time.perf_counter()
+model.encode(texts, normalize_embeddings=True, batch_size={batch_size})
+batch_s = time.perf_counter() - t
+
+print(json.dumps({{
+    "load_ms": round(load_ms, 1),
+    "rss_mb": {{"base": base_rss, "loaded": loaded_rss, "peak": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}},
+    "query_latency": single.summary(),
+    "throughput_texts_per_s": round(len(texts) / batch_s, 1),
+}}))
+"""
+
+
+def bench_backend(backend: str, texts_path: str, threads: Optional[int]) -> Dict[str, Any]:
+    code = _BENCH_PROBE.format(
+        texts_path=texts_path,
+        backend=backend,
+        threads=threads,
+        queries=BENCH_QUERIES,
+        query_chars=BENCH_QUERY_CHARS,
+        batch_size=BENCH_BATCH_SIZE,
+    )
+    proc = subprocess.run([sys.executable, "-c", code], cwd=PROJECT_ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "probe failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def bench(backends: List[str], texts: List[str], threads: Optional[int]) -> Dict[str, Any]:
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as f:
+        json.dump(texts, f)
+    try:
+        results: Dict[str, Any] = {}
+        for backend in backends:
+            try:
+                results[backend] = bench_backend(backend, f.name, threads)
+            except RuntimeError as exc:
+                results[backend] = {"error": str(exc)}
+        return {"chunks": len(texts), "threads": threads, "backends": results}
+    finally:
+        os.remove(f.name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare embedder backends: parity with torch, latency, throughput, RSS.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    par = sub.add_parser("parity", help="cosine agreement of each backend with torch on the corpus chunks")
+    par.add_argument("--backends", nargs="+", default=[b for b in EMBEDDER_BACKENDS if b != "torch"])
+    par.add_argument("--limit", type=int, default=None, help="only the first N chunks")
+    par.add_argument("--json", action="store_true")
+    ben = sub.add_parser("bench", help="load time, RSS, query latency and batch throughput per backend")
+    ben.add_argument("--backends", nargs="+", default=list(EMBEDDER_BACKENDS))
+    ben.add_argument("--limit", type=int, default=None, help="only the first N chunks")
+    ben.add_argument("--threads", type=int, default=None, help="intra-op threads (default: library default)")
+    ben.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    texts = corpus_texts(args.limit)
+    if args.cmd == "parity":
+        report = parity(args.backends, texts)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print(f"parity vs torch over {report['chunks']} chunks")
+            for backend, got in report["backends"].items():
+                print(f"  {backend:10} mean={got['mean']} p01={got['p01']} min={got['min']}")
+            for failure in report["failures"]:
+                print(f"FAIL {failure}")
+        sys.exit(1 if report["failures"] else 0)
+
+    report = bench(args.backends, texts, args.threads)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"embedder benchmark over {report['chunks']} chunks (threads={report['threads'] or 'default'})")
+    for backend, got in report["backends"].items():
+        if "error" in got:
+            print(f"  {backend:10} error: {got['error']}")
+            continue
+        lat = got["query_latency"]
+        print(
+            f"  {backend:10} load={got['load_ms']}ms rss={got['rss_mb']['loaded']}MB (peak {got['rss_mb']['peak']}MB) "
+            f"query p50={lat['p50_ms']}ms p95={lat['p95_ms']}ms batch={got['throughput_texts_per_s']} texts/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
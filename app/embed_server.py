@@ -0,0 +1,229 @@
+# app/embed_server.py
+# ============================================================
+# Shared local embedding server: one model copy per host.
+#
+# - A standalone process loads the embedder (app.embedding.load_embedder,
+#   any EMBEDDER_BACKEND), pins it to EMBED_SERVER_THREADS threads and
+#   serves batch encodes on a Unix socket. Requests from all clients are encoded one at a time.
+# - Requests are small JSON messages (same framing as app/shards.py). The
+#   float32 result matrix is written into a shared-memory segment owned by
+#   the connection, so vectors are never serialized; the reply only says
+#   where to read them.
+# - EmbeddingClient mimics SentenceTransformer.encode(), so RagRuntime
+#   (EMBEDDER_SOCKET) and ingestion (--embedder-socket) can use it as their
+#   embedder unchanged.
+#
+#   python -m app.embed_server [--socket PATH] [--threads N]
+# ============================================================
+
+import argparse
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Optional
+
+from app.embedding import embedder_backend, embedder_path, load_embedder
+from app.shards import recv_msg, send_msg
+
+EMBEDDER_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "rt-embedder.sock")
+EMBED_SERVER_THREADS = max(1, (os.cpu_count() or 2) // 2)
+EMBED_SERVER_BATCH = 64
+SHM_MIN_BYTES = 1 << 20
+
+
+class EmbedServerError(RuntimeError):
+    pass
+
+
+# ---------------------------
+# Server
+# ---------------------------
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        import numpy as np
+
+        server: "_Server" = self.server  # type: ignore[assignment]
+        shm: Optional[shared_memory.SharedMemory] = None
+        try:
+            while True:
+                try:
+                    msg = recv_msg(self.request)
+                except (ConnectionError, OSError):
+                    return
+                try:
+                    op = msg.get("op")
+                    if op == "encode":
+                        vecs = server.encode(msg["texts"], bool(msg.get("normalize", False)))
+                        if shm is None or shm.size < vecs.nbytes:
+                            if shm is not None:
+                                shm.close()
+                                shm.unlink()
+                            shm = shared_memory.SharedMemory(create=True, size=max(SHM_MIN_BYTES, 2 * vecs.nbytes))
+                        np.ndarray(vecs.shape, dtype=np.float32, buffer=shm.buf)[:] = vecs
+                        reply = {"shm": shm.name, "rows": int(vecs.shape[0]), "dim": int(vecs.shape[1])}
+                    elif op == "info":
+                        reply = server.info()
+                    else:
+                        reply = {"error": f"unknown op {op!r}"}
+                except Exception as exc:
+                    reply = {"error": f"{type(exc).__name__}: {exc}"}
+                try:
+                    send_msg(self.request, reply)
+                except OSError:
+                    return
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, model, threads: int) -> None:
+        super().__init__(socket_path, _Handler)
+        self.model = model
+        self.threads = threads
+        self._encode_lock = threading.Lock()
+        self.requests = 0
+        self.texts = 0
+        self.busy_s = 0.0
+
+    def encode(self, texts: List[str], normalize: bool):
+        import numpy as np
+
+        # One encode at a time: the intra-op pool is sized for the whole host, not per client.
+        with self._encode_lock:
+            t0 = time.monotonic()
+            vecs = self.model.encode(
+                texts, normalize_embeddings=normalize, batch_size=EMBED_SERVER_BATCH, convert_to_numpy=True
+            )
+            self.busy_s += time.monotonic() - t0
+            self.requests += 1
+            self.texts += len(texts)
+        return np.ascontiguousarray(vecs, dtype=np.float32).reshape(len(texts), -1)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "model": embedder_path(),
+            "backend": embedder_backend(),
+            "threads": self.threads,
+            "requests": self.requests,
+            "texts": self.texts,
+            "busy_s": round(self.busy_s, 2),
+        }
+
+
+def serve(socket_path: str = EMBEDDER_SOCKET_PATH, threads: int = EMBED_SERVER_THREADS) -> None:
+    model = load_embedder(threads=threads)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = _Server(socket_path, model, threads)
+    print(f"[embed-server] {embedder_path()} ({embedder_backend()}) on {socket_path} ({threads} threads)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# ---------------------------
+# Client
+# ---------------------------
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # The server owns (and unlinks) the segment; don't let this process's tracker unlink it at exit.
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+    return shm
+
+
+class _Conn:
+    def __init__(self, address: str, timeout_s: Optional[float]) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout_s)
+        self.sock.connect(address)
+        self.shm: Optional[shared_memory.SharedMemory] = None
+
+    def close(self) -> None:
+        if self.shm is not None:
+            self.shm.close()
+        self.sock.close()
+
+
+class EmbeddingClient:
+    """Drop-in for SentenceTransformer.encode() backed by the embedding server."""
+
+    def __init__(self, socket_path: str = EMBEDDER_SOCKET_PATH, timeout_s: Optional[float] = 60.0) -> None:
+        self.socket_path = socket_path
+        self.timeout_s = timeout_s
+        self._idle: List[_Conn] = []
+        self._lock = threading.Lock()
+
+    def _conn(self) -> _Conn:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return _Conn(self.socket_path, self.timeout_s)
+        except OSError as exc:
+            raise EmbedServerError(
+                f"embedding server not reachable at {self.socket_path} ({exc}); start it with `python -m app.embed_server`"
+            ) from exc
+
+    def encode(self, sentences, normalize_embeddings: bool = False, batch_size: int = EMBED_SERVER_BATCH, **_: Any):
+        import numpy as np
+
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        conn = self._conn()
+        try:
+            send_msg(conn.sock, {"op": "encode", "texts": texts, "normalize": normalize_embeddings})
+            reply = recv_msg(conn.sock)
+            if "error" in reply:
+                raise EmbedServerError(reply["error"])
+            if conn.shm is None or conn.shm.name != reply["shm"]:
+                if conn.shm is not None:
+                    conn.shm.close()
+                conn.shm = _attach(reply["shm"])
+            out = np.ndarray((reply["rows"], reply["dim"]), dtype=np.float32, buffer=conn.shm.buf).copy()
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conn)
+        return out[0] if single else out
+
+    def info(self) -> Dict[str, Any]:
+        conn = self._conn()
+        try:
+            send_msg(conn.sock, {"op": "info"})
+            return recv_msg(conn.sock)
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the embedder to local processes over a Unix socket.")
+    parser.add_argument("--socket", default=os.environ.get("EMBEDDER_SOCKET", EMBEDDER_SOCKET_PATH))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("EMBED_SERVER_THREADS", EMBED_SERVER_THREADS)))
+    args = parser.parse_args()
+    serve(args.socket, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+# app/embedding.py
+# ============================================================
+# Query/document embedder loading.
+#
+# - The model is loaded from a pinned local snapshot (models/<name>/), with
+#   the Hugging Face hub forced offline: no network lookups at startup.
+#   `snapshot` resolves the requested revision to its commit SHA and records
+#   it in snapshot.json; load_embedder refuses a snapshot without one (and
+#   one that differs from EMBEDDER_REVISION, when that is set).
+# - sentence_transformers (and torch with it) is only imported when the
+#   embedder is actually loaded, not when app.core is imported.
+# - EMBEDDER_BACKEND picks the encoder: "torch" (SentenceTransformer), or
+#   "onnx" / "onnx-int8" (OnnxEmbedder: the same weights exported to ONNX,
+#   fp32 or with dynamically int8-quantized weights, run by onnxruntime
+#   with the `tokenizers` tokenizer; no torch in the process).
+#
+# - EmbeddingBatcher coalesces concurrent single-query encodes into one
+#   batched encode call (dynamic micro-batching).
+#
+# Create or refresh the snapshot once per machine/image, then (for the
+# ONNX backends) export it; check parity/speed with app.embed_bench:
+#   python -m app.embedding snapshot
+#   python -m app.embedding export-onnx
+# ============================================================
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.generation import LatencyTracker
+from app.profiling import StackSampler, current_sampler
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+EMBEDDER_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDER_PATH = os.path.join(PROJECT_ROOT, "models", "all-MiniLM-L6-v2")
+SNAPSHOT_INFO = "snapshot.json"
+
+COMMIT_SHA = re.compile(r"[0-9a-f]{40}")
+
+EMBEDDER_BACKEND = "torch"
+ONNX_DIR = "onnx"
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+EMBEDDER_BACKENDS = ("torch", *ONNX_FILES)
+ONNX_OPSET = 14
+
+EMBED_BATCH_WINDOW_MS = 5.0    # how long the first queued query waits for company
+EMBED_MAX_BATCH = 32
+
+
+def embedder_path() -> str:
+    return os.environ.get("EMBEDDER_PATH", EMBEDDER_PATH)
+
+
+def embedder_backend() -> str:
+    return os.environ.get("EMBEDDER_BACKEND", EMBEDDER_BACKEND).strip()
+
+
+def check_snapshot(path: str) -> Dict[str, Any]:
+    """The snapshot's recorded metadata. Raises RuntimeError unless it is pinned to a hub commit SHA."""
+    info = _read_json(os.path.join(path, SNAPSHOT_INFO), {})
+    revision = str(info.get("revision") or "")
+    if not COMMIT_SHA.fullmatch(revision):
+        raise RuntimeError(
+            f"Embedder snapshot at {path} is not pinned to a commit (revision={revision or None!r}). "
+            "Re-create it with `python -m app.embedding snapshot`."
+        )
+    expected = os.environ.get("EMBEDDER_REVISION", "").strip()
+    if expected and expected != revision:
+        raise RuntimeError(f"Embedder snapshot at {path} is revision {revision}, but EMBEDDER_REVISION={expected}.")
+    return info
+
+
+def load_embedder(path: Optional[str] = None, backend: Optional[str] = None, threads: Optional[int] = None):
+    """
+    Load the embedder for `backend` (default: EMBEDDER_BACKEND) from the local
+    snapshot. `threads` caps intra-op threads (torch or onnxruntime).
+    """
+    path = path or embedder_path()
+    backend = backend or embedder_backend()
+    if backend not in EMBEDDER_BACKENDS:
+        raise ValueError(f"EMBEDDER_BACKEND must be one of {list(EMBEDDER_BACKENDS)}, got {backend!r}")
+    if not os.path.isdir(path):
+        raise RuntimeError(
+            f"No embedder snapshot at {path}. Run `python -m app.embedding snapshot` once "
+            "(needs network), or point EMBEDDER_PATH at an existing snapshot."
+        )
+    check_snapshot(path)
+
+    if backend != "torch":
+        model_path = os.path.join(path, ONNX_DIR, ONNX_FILES[backend])
+        if not os.path.isfile(model_path):
+            raise RuntimeError(f"No ONNX export at {model_path}. Run `python -m app.embedding export-onnx` once.")
+        if threads is None and os.environ.get("EMBED_ONNX_THREADS"):
+            threads = int(os.environ["EMBED_ONNX_THREADS"])
+        return OnnxEmbedder(path, model_path, threads=threads or 0)
+
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    from sentence_transformers import SentenceTransformer
+
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+    return SentenceTransformer(path, device="cpu", local_files_only=True)
+
+
+def _read_json(path: str, default: Any) -> Any:
+    if not os.path.isfile(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class OnnxEmbedder:
+    """
+    SentenceTransformer.encode() look-alike over an exported ONNX graph.
+
+    Tokenization, truncation, pooling and normalization follow the snapshot's
+    own sentence-transformers config, so vectors match the torch backend up to
+    numerical (and, for int8, quantization) error; `python -m app.embed_bench
+    parity` measures that on the corpus.
+    """
+
+    def __init__(self, path: str, model_path: str, threads: int = 0) -> None:
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        st_cfg = _read_json(os.path.join(path, "sentence_bert_config.json"), {})
+        modules = _read_json(os.path.join(path, "modules.json"), [])
+        pooling_dir = next((m["path"] for m in modules if m.get("type", "").endswith(".Pooling")), "1_Pooling")
+        pooling = _read_json(os.path.join(path, pooling_dir, "config.json"), {})
+
+        self.model_path = model_path
+        self.max_seq_length = int(st_cfg.get("max_seq_length", 256))
+        self.lowercase = bool(st_cfg.get("do_lower_case", False))
+        self.cls_pooling = bool(pooling.get("pooling_mode_cls_token", False))
+        self.normalized = any(m.get("type", "").endswith(".Normalize") for m in modules)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.max_seq_length)
+        pad_token = "[PAD]" if self.tokenizer.token_to_id("[PAD]") is not None else "<pad>"
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dim = int(self.session.get_outputs()[0].shape[-1])
+
+    def encode(self, sentences, normalize_embeddings: bool = False, batch_size: int = 32, **_: Any):
+        import numpy as np
+
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if self.lowercase:
+            texts = [t.lower() for t in texts]
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+
+        # Longest first, like SentenceTransformer, so each batch pads to similar lengths.
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(order), max(1, batch_size)):
+            idx = order[start : start + max(1, batch_size)]
+            encs = self.tokenizer.encode_batch([texts[i] for i in idx])
+            mask = np.array([e.attention_mask for e in encs], dtype=np.int64)
+            feeds = {"input_ids": np.array([e.ids for e in encs], dtype=np.int64), "attention_mask": mask}
+            if "token_type_ids" in self.input_names:
+                feeds["token_type_ids"] = np.array([e.type_ids for e in encs], dtype=np.int64)
+            hidden = self.session.run(None, feeds)[0]
+            if self.cls_pooling:
+                pooled = hidden[:, 0]
+            else:
+                weights = mask[..., None].astype(np.float32)
+                pooled = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+            out[idx] = pooled
+
+        if normalize_embeddings or self.normalized:
+            out /= np.clip(np.linalg.norm(out, axis=1, keepdims=True), 1e-12, None)
+        return out[0] if single else out
+
+
+class EmbeddingBatcher:
+    """
+    Dynamic micro-batching for query embeddings.
+
+    When nothing is encoding and nothing is queued, a call encodes its text
+    immediately on the caller's thread. Otherwise it is queued; one worker
+    thread takes everything that queued up (up to max_batch), waiting at most
+    window_ms after the oldest item for more, runs a single batched encode and
+    resolves each caller's future. Only one encode runs at a time, so torch's
+    intra-op thread pool is never shared between competing calls.
+    """
+
+    def __init__(
+        self,
+        encode_batch: Callable[[List[str]], List[List[float]]],
+        window_ms: float = EMBED_BATCH_WINDOW_MS,
+        max_batch: int = EMBED_MAX_BATCH,
+    ) -> None:
+        self.encode_batch = encode_batch
+        self.window_s = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        # (text, future, queued_at, sampler of the request if it is profiled)
+        self._queue: Deque[Tuple[str, Future, float, Optional[StackSampler]]] = deque()
+        self._busy = False
+        self._cond = threading.Condition()
+        self.batch_sizes: Counter = Counter()
+        self.queue_wait = LatencyTracker()
+        self.encode_time = LatencyTracker()
+        self.immediate = 0
+        self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._thread.start()
+
+    def encode(self, text: str) -> List[float]:
+        with self._cond:
+            idle = not self._busy and not self._queue
+            if idle:
+                self._busy = True
+            else:
+                fut: Future = Future()
+                self._queue.append((text, fut, time.monotonic(), current_sampler()))
+                self._cond.notify_all()
+        if not idle:
+            return fut.result()
+
+        try:
+            t0 = time.monotonic()
+            vec = self.encode_batch([text])[0]
+            self.encode_time.add(time.monotonic() - t0)
+            self.immediate += 1
+            self.batch_sizes[1] += 1
+            return vec
+        finally:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _take_batch(self) -> List[Tuple[str, Future, float, Optional[StackSampler]]]:
+        with self._cond:
+            while not self._queue or self._busy:
+                self._cond.wait()
+            self._busy = True
+            deadline = self._queue[0][2] + self.window_s
+            while len(self._queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            started = time.monotonic()
+            for _, _, queued_at, _ in batch:
+                self.queue_wait.add(started - queued_at)
+            try:
+                # The encode is shared: it shows up in the profile of every profiled request in the batch.
+                with ExitStack() as profiled:
+                    for sampler in {s for _, _, _, s in batch if s is not None}:
+                        profiled.enter_context(sampler.attached())
+                    vecs = self.encode_batch([text for text, _, _, _ in batch])
+                for (_, fut, _, _), vec in zip(batch, vecs):
+                    fut.set_result(vec)
+            except Exception as exc:
+                for _, fut, _, _ in batch:
+                    fut.set_exception(exc)
+            finally:
+                self.encode_time.add(time.monotonic() - started)
+                self.batch_sizes[len(batch)] += 1
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def metrics(self) -> Dict[str, Any]:
+        sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        queries = sum(size * n for size, n in sizes.items())
+        return {
+            "window_ms": round(self.window_s * 1000, 1),
+            "max_batch": self.max_batch,
+            "queries": queries,
+            "batches": batches,
+            "immediate": self.immediate,
+            "mean_batch_size": round(queries / batches, 2) if batches else None,
+            "batch_sizes": {str(k): sizes[k] for k in sorted(sizes)},
+            "queue_wait": self.queue_wait.summary(),
+            "encode": self.encode_time.summary(),
+        }
+
+
+def resolve_revision(model: str, revision: Optional[str] = None) -> str:
+    """Commit SHA of `revision` (branch, tag or commit; default main) on the Hugging Face hub."""
+    if revision and COMMIT_SHA.fullmatch(revision):
+        return revision
+    from huggingface_hub import HfApi
+
+    return HfApi().model_info(model, revision=revision or "main").sha
+
+
+def snapshot(model: str = EMBEDDER_MODEL, path: str = EMBEDDER_PATH, revision: Optional[str] = None) -> str:
+    from sentence_transformers import SentenceTransformer
+
+    # Download the resolved commit, not the branch, so the files match the SHA recorded below.
+    sha = resolve_revision(model, revision)
+    st = SentenceTransformer(model, device="cpu", revision=sha)
+    st.save(path)
+    with open(os.path.join(path, SNAPSHOT_INFO), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "model": model,
+                "revision": sha,
+                "requested": revision or "main",
+                "saved_at": datetime.now(timezone.utc).isoformat(),
+            },
+            f,
+            indent=2,
+        )
+    return path
+
+
+def export_onnx(path: Optional[str] = None) -> Dict[str, str]:
+    """
+    Export the snapshot's transformer to <snapshot>/onnx/model.onnx and an
+    int8 dynamically-quantized copy (model_int8.onnx). Needs torch,
+    transformers and onnxruntime at export time only.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel
+
+    path = path or embedder_path()
+    out_dir = os.path.join(path, ONNX_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, ONNX_FILES["onnx"])
+    int8_path = os.path.join(out_dir, ONNX_FILES["onnx-int8"])
+
+    class _Encoder(torch.nn.Module):
+        # Positional inputs and a single tensor output, whatever the transformers forward() signature is.
+        def __init__(self) -> None:
+            super().__init__()
+            self.model = AutoModel.from_pretrained(path, local_files_only=True).eval()
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            out = self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+            return out.last_hidden_state
+
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dummy = tuple(torch.ones((1, 8), dtype=torch.long) for _ in names)
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder().eval(),
+            dummy,
+            fp32_path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{n: {0: "batch", 1: "seq"} for n in names}, "last_hidden_state": {0: "batch", 1: "seq"}},
+            opset_version=ONNX_OPSET,
+            dynamo=False,  # the TorchScript exporter: plain dynamic axes, no onnxscript dependency
+        )
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return {"onnx": fp32_path, "onnx-int8": int8_path}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Manage the local embedder snapshot.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    snap = sub.add_parser("snapshot", help="download the model once and save it under models/")
+    snap.add_argument("--model", default=EMBEDDER_MODEL)
+    snap.add_argument(
+        "--revision", default=None, help="branch, tag or commit; pinned to its commit SHA (default: main)"
+    )
+    snap.add_argument("--path", default=EMBEDDER_PATH)
+    export = sub.add_parser("export-onnx", help="export the snapshot to ONNX (fp32 + int8) for the onnx backends")
+    export.add_argument("--path", default=None, help="snapshot directory (default: EMBEDDER_PATH)")
+    args = parser.parse_args()
+
+    if args.cmd == "snapshot":
+        path = snapshot(args.model, args.path, args.revision)
+        print(f"[embedding] saved {args.model}@{check_snapshot(path)['revision']} to {path}")
+    elif args.cmd == "export-onnx":
+        for backend, file in export_onnx(args.path).items():
+            print(f"[embedding] {backend}: {file} ({os.path.getsize(file) / 2**20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# app/extractive.py
+# ============================================================
+# Extractive answers: no LLM call.
+#
+# - Split the retrieved child chunks into sentences.
+# - Encode all sentences in one batch (cached per child chunk) and score
+#   them against the query embedding that retrieval already computed.
+# - Return the best one or two sentences with the usual citations.
+#
+# Used for mode="extractive" and as the fallback when the LLM is down or
+# past its deadline.
+# ============================================================
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.cache import LRUCache
+
+TOP_SENTENCES = 2
+MIN_SENTENCE_CHARS = 30
+MIN_SENTENCE_SCORE = 0.25
+SENTENCE_CACHE_SIZE = 4096     # child chunks
+
+NOT_ENOUGH_INFO = "I don't have enough information in the allowed documents."
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+_BULLET = re.compile(r"^(?:[-*•]|\d+[.)])\s+")
+
+
+def split_sentences(text: str) -> List[str]:
+    out: List[str] = []
+    for raw in _SENTENCE_SPLIT.split(text):
+        s = _BULLET.sub("", raw.strip())
+        # Headings and RACI-style "Name – R" lines are not answers.
+        if s.startswith("#") or len(s) < MIN_SENTENCE_CHARS or len(s.split()) < 5:
+            continue
+        out.append(s)
+    return out
+
+
+def _child_sentences(embedder, children: List[Dict[str, Any]], cache: Optional[LRUCache]) -> List[Tuple[List[str], Any]]:
+    """(sentences, normalized embedding matrix) per child; uncached children are encoded in a single batch."""
+    import numpy as np
+
+    results: List[Optional[Tuple[List[str], Any]]] = [None] * len(children)
+    todo: List[Tuple[int, List[str]]] = []
+
+    for i, child in enumerate(children):
+        key = child.get("id")
+        hit = cache.get(key) if (cache is not None and key) else None
+        if hit is not None:
+            results[i] = hit
+        else:
+            todo.append((i, split_sentences(child["text"])))
+
+    flat = [s for _, sents in todo for s in sents]
+    matrix = embedder.encode(flat, normalize_embeddings=True, batch_size=64) if flat else np.zeros((0, 0))
+
+    offset = 0
+    for i, sents in todo:
+        entry = (sents, np.asarray(matrix[offset : offset + len(sents)], dtype=np.float32))
+        offset += len(sents)
+        results[i] = entry
+        key = children[i].get("id")
+        if cache is not None and key:
+            cache.put(key, entry)
+
+    return [r for r in results if r is not None]
+
+
+def extractive_answer(
+    embedder,
+    q_emb: List[float],
+    retrieved_children: List[Dict[str, Any]],
+    cache: Optional[LRUCache] = None,
+    top_n: int = TOP_SENTENCES,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    if not retrieved_children:
+        return NOT_ENOUGH_INFO, []
+    import numpy as np
+
+    per_child = _child_sentences(embedder, retrieved_children, cache)
+    sentences: List[str] = []
+    owners: List[int] = []
+    blocks = []
+    for ci, (sents, mat) in enumerate(per_child):
+        if not sents:
+            continue
+        sentences.extend(sents)
+        owners.extend([ci] * len(sents))
+        blocks.append(mat)
+    if not sentences:
+        return NOT_ENOUGH_INFO, []
+
+    scores = np.vstack(blocks) @ np.asarray(q_emb, dtype=np.float32)
+    order = np.argsort(-scores)
+
+    picked: List[int] = []
+    seen = set()
+    for idx in order:
+        if scores[idx] < MIN_SENTENCE_SCORE or len(picked) >= top_n:
+            break
+        norm = sentences[idx].lower()
+        if norm in seen:
+            continue
+        seen.add(norm)
+        picked.append(int(idx))
+    if not picked:
+        return NOT_ENOUGH_INFO, []
+
+    # One citation per parent chunk, numbered in answer order.
+    citations: List[Dict[str, Any]] = []
+    cite_of: Dict[Any, int] = {}
+    parts: List[str] = []
+    for idx in picked:
+        meta = retrieved_children[owners[idx]]["metadata"]
+        pid = meta.get("parent_id")
+        if pid not in cite_of:
+            cite_of[pid] = len(citations) + 1
+            citations.append(
+                {
+                    "n": cite_of[pid],
+                    "source": meta.get("source"),
+                    "department": meta.get("department"),
+                    "parent_index": meta.get("parent_index"),
+                }
+            )
+        s = sentences[idx]
+        parts.append(s if s.endswith((".", "!", "?")) else s + ".")
+
+    refs = ", ".join(f"[{c['n']}]" for c in citations)
+    return " ".join(parts) + f"\n\nSources: {refs}", citations
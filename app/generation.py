@@ -0,0 +1,332 @@
+# app/generation.py
+# ============================================================
+# Generation layer between RagRuntime and the LLM provider.
+#
+# - Per-request deadline: a caller never waits longer than deadline_s,
+#   even if the provider call itself hangs.
+# - Hedging: if the first call is slower than the recent p95 (floored by
+#   hedge_min_delay_s), a second identical call is fired and the first
+#   answer wins.
+# - Circuit breaker: when the recent error rate crosses a threshold the
+#   breaker opens and calls fail fast for cooldown_s, then one probe call
+#   decides whether to close again.
+# - Tail-latency metrics (p50/p95/p99) and counters for /api/metrics.
+#
+# Generators are plain objects with generate(prompt, timeout_s) -> str, so
+# FakeGenerator (injected latency + errors) can stand in for Gemini locally.
+# ============================================================
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.cache import Lazy
+from app.profiling import carry
+
+LLM_DEADLINE_SECONDS = 25.0
+HEDGE_MIN_DELAY_SECONDS = 2.0
+HEDGE_MIN_SAMPLES = 20           # don't trust p95 before this many samples
+BREAKER_WINDOW_SECONDS = 60.0
+BREAKER_MIN_REQUESTS = 10
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN_SECONDS = 30.0
+GENERATION_WORKERS = 32
+LATENCY_SAMPLES = 512
+
+
+class GenerationError(RuntimeError):
+    pass
+
+
+class GenerationTimeout(GenerationError):
+    pass
+
+
+class CircuitOpenError(GenerationError):
+    pass
+
+
+# ---------------------------
+# Providers
+# ---------------------------
+def _gemini_model(model_name: str, api_key: str):
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+class GeminiGenerator:
+    """google.generativeai is imported and configured on the first call, not at startup."""
+
+    def __init__(self, model_name: str, api_key: str) -> None:
+        self.model_name = model_name
+        self._model = Lazy(lambda: _gemini_model(model_name, api_key))
+
+    @property
+    def model(self):
+        return self._model.get()
+
+    def generate(self, prompt: str, timeout_s: Optional[float] = None) -> str:
+        kwargs: Dict[str, Any] = {}
+        if timeout_s is not None:
+            kwargs["request_options"] = {"timeout": timeout_s}
+        resp = self.model.generate_content(prompt, **kwargs)
+        return (getattr(resp, "text", "") or "").strip()
+
+
+class FakeGenerator:
+    """Local stand-in for the provider: lognormal-ish latency, a slow tail and random errors."""
+
+    def __init__(
+        self,
+        latency_s: float = 0.8,
+        jitter: float = 0.3,
+        slow_rate: float = 0.05,
+        slow_s: float = 8.0,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.latency_s = latency_s
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_s = slow_s
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: str, timeout_s: Optional[float] = None) -> str:
+        with self._lock:
+            slow = self._rng.random() < self.slow_rate
+            fail = self._rng.random() < self.error_rate
+            delay = self.slow_s if slow else max(0.0, self._rng.gauss(self.latency_s, self.latency_s * self.jitter))
+        time.sleep(delay)
+        if fail:
+            raise GenerationError("fake provider error")
+        return "This is a generated answer from the local fake provider. Sources: [1]"
+
+
+# ---------------------------
+# Metrics + breaker
+# ---------------------------
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class LatencyTracker:
+    def __init__(self, maxlen: int = LATENCY_SAMPLES) -> None:
+        self._samples: Deque[float] = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            data = sorted(self._samples)
+        return percentile(data, p)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        def ms(v: Optional[float]) -> Optional[float]:
+            return None if v is None else round(v * 1000, 1)
+
+        return {
+            "samples": len(self._samples),
+            "p50_ms": ms(self.percentile(50)),
+            "p95_ms": ms(self.percentile(95)),
+            "p99_ms": ms(self.percentile(99)),
+            "max_ms": ms(self.percentile(100)),
+        }
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window_s: float = BREAKER_WINDOW_SECONDS,
+        min_requests: int = BREAKER_MIN_REQUESTS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        cooldown_s: float = BREAKER_COOLDOWN_SECONDS,
+    ) -> None:
+        self.window_s = window_s
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown_s = cooldown_s
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._lock = threading.Lock()
+        self._opened_at: Optional[float] = None
+        self._probe = 0          # id of the half-open probe in flight, 0 when none
+        self._probe_seq = 0
+
+    def _prune(self, now: float) -> None:
+        while self._outcomes and now - self._outcomes[0][0] > self.window_s:
+            self._outcomes.popleft()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.cooldown_s:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> Optional[int]:
+        """
+        None when the call must fail fast. Otherwise a ticket to pass back to
+        record(): 0 for an ordinary call, or the probe id for the single
+        half-open probe. Only that probe's outcome closes or reopens the breaker.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            if time.monotonic() - self._opened_at < self.cooldown_s or self._probe:
+                return None
+            self._probe_seq += 1
+            self._probe = self._probe_seq
+            return self._probe
+
+    def record(self, ok: bool, ticket: int = 0) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if ticket:
+                if ticket == self._probe:
+                    self._probe = 0
+                    self._opened_at = None if ok else now
+                    self._outcomes.clear()
+                return
+            self._outcomes.append((now, ok))
+            self._prune(now)
+            total = len(self._outcomes)
+            errors = sum(1 for _, good in self._outcomes if not good)
+            if self._opened_at is None and total >= self.min_requests and errors / total >= self.error_rate:
+                self._opened_at = now
+                print(f"[llm] circuit opened: {errors}/{total} failures in {self.window_s:.0f}s")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._prune(time.monotonic())
+            total = len(self._outcomes)
+            errors = sum(1 for _, good in self._outcomes if not good)
+        return {"state": self.state, "window_requests": total, "window_errors": errors}
+
+
+# ---------------------------
+# Resilient wrapper
+# ---------------------------
+class ResilientGenerator:
+    def __init__(
+        self,
+        generator,
+        deadline_s: float = LLM_DEADLINE_SECONDS,
+        hedge: bool = True,
+        hedge_min_delay_s: float = HEDGE_MIN_DELAY_SECONDS,
+        breaker: Optional[CircuitBreaker] = None,
+        max_workers: int = GENERATION_WORKERS,
+    ) -> None:
+        self.generator = generator
+        self.deadline_s = deadline_s
+        self.hedge = hedge
+        self.hedge_min_delay_s = hedge_min_delay_s
+        self.breaker = breaker or CircuitBreaker()
+        # Timed-out calls keep running here until the provider gives up; the
+        # bounded pool stops them from piling up without limit.
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "untracked": 0,
+            "ok": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "short_circuited": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        # No hedging until p95 is trustworthy: on a cold server the floor alone would double every slow call.
+        if len(self.latency) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_delay_s, self.latency.percentile(95) or 0.0)
+
+    def generate(self, prompt: str, deadline_s: Optional[float] = None, track: bool = True) -> str:
+        """
+        track=False is for background calls (history summaries): they are not
+        hedged and stay out of the latency percentiles that drive hedging and
+        /api/metrics, but still count towards the circuit breaker.
+        """
+        self._count("requests" if track else "untracked")
+        ticket = self.breaker.allow()
+        if ticket is None:
+            self._count("short_circuited")
+            raise CircuitOpenError("LLM provider circuit is open; failing fast.")
+
+        budget = self.deadline_s if deadline_s is None else deadline_s
+        started = time.monotonic()
+        deadline = started + budget
+
+        primary = self._pool.submit(carry(self.generator.generate), prompt, budget)
+        pending: List[Future] = [primary]
+        last_exc: Optional[BaseException] = None
+
+        delay = self.hedge_delay() if track else None
+        if delay is not None and delay < budget:
+            done, _ = wait(pending, timeout=delay)
+            if not done:
+                self._count("hedges")
+                pending.append(self._pool.submit(carry(self.generator.generate), prompt, deadline - time.monotonic()))
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for fut in done:
+                pending.remove(fut)
+                exc = fut.exception()
+                if exc is None:
+                    if track:
+                        self.latency.add(time.monotonic() - started)
+                    self.breaker.record(True, ticket)
+                    self._count("ok")
+                    if fut is not primary:
+                        self._count("hedge_wins")
+                    return fut.result()
+                last_exc = exc
+
+        self.breaker.record(False, ticket)
+        if pending:
+            # Still running at the deadline: count it at the deadline so p99 shows the stall.
+            if track:
+                self.latency.add(budget)
+            self._count("timeouts")
+            raise GenerationTimeout(f"LLM generation exceeded {budget:.1f}s deadline.")
+        self._count("errors")
+        raise GenerationError(str(last_exc)) from last_exc
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            **counters,
+            "latency": self.latency.summary(),
+            "hedge_delay_ms": None if self.hedge_delay() is None else round(self.hedge_delay() * 1000, 1),
+            "breaker": self.breaker.snapshot(),
+        }
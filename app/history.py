@@ -0,0 +1,101 @@
+# app/history.py
+# ============================================================
+# Rolling conversation-history compaction.
+#
+# - Recent turns stay verbatim as long as they fit HISTORY_TOKEN_BUDGET.
+# - When they don't, the oldest turns are folded into session["summary"].
+#   Only the turns being folded (plus the previous summary) are sent to the
+#   summarizer, so each fold costs the same no matter how long the chat is.
+# - Folding goes down to a low-water mark so it happens every few turns,
+#   not on every request.
+# ============================================================
+
+from typing import Any, Callable, Dict, List
+
+HISTORY_TOKEN_BUDGET = 800
+HISTORY_LOW_WATER = 0.5       # fold down to this fraction of the budget
+SUMMARY_MAX_TOKENS = 250
+CHARS_PER_TOKEN = 4           # cheap estimate; no tokenizer on the request path
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def history_tokens(history: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(h["text"]) + 2 for h in history)
+
+
+def clip_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0].rstrip() + " ..."
+
+
+def build_summary_prompt(summary: str, turns: List[Dict[str, str]]) -> str:
+    lines = []
+    for h in turns:
+        prefix = "User: " if h["role"] == "user" else "Assistant: "
+        lines.append(prefix + h["text"])
+    return f"""
+You maintain a running summary of a conversation between an employee and an enterprise assistant.
+
+Update the summary below with the new turns. Keep topics, decisions, names and
+open questions; drop pleasantries and source citations. Write at most
+{SUMMARY_MAX_TOKENS * 3 // 4} words of plain prose.
+
+Current summary:
+{summary if summary else "(none)"}
+
+New turns:
+{chr(10).join(lines)}
+""".strip()
+
+
+def fallback_summary(summary: str, turns: List[Dict[str, str]]) -> str:
+    """Extractive fold used when the summarizer fails: keep each question and the lead sentence of its answer."""
+    parts = [summary] if summary else []
+    for h in turns:
+        text = " ".join(h["text"].split())
+        if h["role"] == "user":
+            parts.append(f"User asked: {text}")
+        else:
+            parts.append(f"Assistant: {text.split('. ')[0].rstrip('.')}.")
+    return " ".join(parts)
+
+
+def compact_history(
+    session: Dict[str, Any],
+    summarize: Callable[[str], str],
+    budget: int = HISTORY_TOKEN_BUDGET,
+) -> bool:
+    """Fold the oldest turns of session["history"] into session["summary"] if over budget."""
+    history = session.get("history") or []
+    if history_tokens(history) <= budget:
+        return False
+
+    target = int(budget * HISTORY_LOW_WATER)
+    cut = 0
+    # Always keep the newest item; only cut on a user-turn boundary so a
+    # question is never separated from its answer.
+    while cut < len(history) - 1 and history_tokens(history[cut:]) > target:
+        cut += 1
+        while cut < len(history) - 1 and history[cut]["role"] != "user":
+            cut += 1
+    if cut == 0:
+        return False
+
+    folded = history[:cut]
+    previous = session.get("summary", "")
+    try:
+        summary = (summarize(build_summary_prompt(previous, folded)) or "").strip()
+    except Exception:
+        summary = ""
+    if not summary:
+        summary = fallback_summary(previous, folded)
+
+    session["summary"] = clip_tokens(summary, SUMMARY_MAX_TOKENS)
+    session["history"] = history[cut:]
+    session["summarized_turns"] = session.get("summarized_turns", 0) + len(folded)
+    return True
@@ -0,0 +1,215 @@
+# app/index.py
+# ============================================================
+# Live index generations for the API server.
+#
+# - IndexManager owns the active (rt_parents, rt_children) collection pair.
+# - Each request takes a lease on the generation that is active when it
+#   starts and keeps using it to the end, even if a swap happens meanwhile.
+# - A swap only changes which generation *new* leases get; the retired one
+#   is dropped once its last lease is released and no other server
+#   process pins it (see ingestion.ingest.pin_generations).
+# - A polling watcher notices changes under data/, builds the delta into a
+#   shadow generation (see ingestion.ingest.build_generation) and swaps.
+# ============================================================
+
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from ingestion.ingest import (
+    activate_generation,
+    allocate_generation,
+    build_generation,
+    collection_names,
+    diff_manifests,
+    drop_generation,
+    load_generation_state,
+    pin_generations,
+    pinned_generations,
+    scan_corpus,
+)
+
+
+class IndexGeneration:
+    """One immutable, fully built pair of collections."""
+
+    def __init__(self, version: int, parents_col, children_col, built_at: Optional[str], manifest: Dict[str, Any]) -> None:
+        self.version = version
+        self.parents_col = parents_col
+        self.children_col = children_col
+        self.built_at = built_at
+        self.manifest = manifest
+        self.leases = 0
+        self.retired = False
+
+
+class IndexManager:
+    def __init__(self, client, state_path: Optional[str], embedder=None) -> None:
+        self.client = client
+        # Passed to ingestion for new chunks; None keeps Chroma's default embedding function.
+        self.embedder = embedder
+        # None for in-memory clients: the pointer then lives only in this process.
+        self.state_path = state_path
+
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._draining: Dict[int, IndexGeneration] = {}
+
+        self.building = False
+        self.last_error: Optional[str] = None
+        # Called with the new version after each swap (e.g. to re-warm caches).
+        self.on_swap: List[Callable[[int], None]] = []
+        self._active = self._open(load_generation_state(state_path))
+        self._pin()
+
+    def _open(self, state: Dict[str, Any]) -> IndexGeneration:
+        version = int(state.get("active", 0))
+        parents_name, children_name = collection_names(version)
+        return IndexGeneration(
+            version=version,
+            parents_col=self.client.get_or_create_collection(parents_name),
+            children_col=self.client.get_or_create_collection(children_name),
+            built_at=state.get("built_at"),
+            manifest=state.get("manifest") or {},
+        )
+
+    def _pin(self) -> None:
+        with self._lock:
+            held = [self._active.version, *self._draining]
+        pin_generations(self.state_path, held)
+
+    def _retire(self, version: int) -> None:
+        """Drop a drained generation unless another server process still reads it; the last one out drops it."""
+        self._pin()
+        if version not in pinned_generations(self.state_path, exclude_self=True):
+            drop_generation(self.client, version)
+
+    # ---------------------------
+    # Readers
+    # ---------------------------
+    def current(self) -> IndexGeneration:
+        return self._active
+
+    @property
+    def version(self) -> int:
+        return self._active.version
+
+    @contextmanager
+    def lease(self) -> Iterator[IndexGeneration]:
+        with self._lock:
+            gen = self._active
+            gen.leases += 1
+        try:
+            yield gen
+        finally:
+            with self._lock:
+                gen.leases -= 1
+                drained = gen.retired and gen.leases == 0
+                if drained:
+                    self._draining.pop(gen.version, None)
+            if drained:
+                self._retire(gen.version)
+
+    # ---------------------------
+    # Writers
+    # ---------------------------
+    def _swap(self, state: Dict[str, Any]) -> None:
+        new_gen = self._open(state)
+        with self._lock:
+            old = self._active
+            self._active = new_gen
+            old.retired = True
+            drained = old.leases == 0
+            if not drained:
+                self._draining[old.version] = old
+        if drained:
+            self._retire(old.version)
+        else:
+            self._pin()
+        print(f"[index] now serving generation {new_gen.version} (retired {old.version})")
+        for callback in self.on_swap:
+            try:
+                callback(new_gen.version)
+            except Exception as exc:
+                print(f"[index] on_swap callback failed: {exc}")
+
+    def refresh(self, full: bool = False) -> bool:
+        """
+        Bring the index up to date with data/. Returns True if a new generation
+        went live. Concurrent calls are skipped, not queued.
+        """
+        if not self._build_lock.acquire(blocking=False):
+            return False
+        try:
+            active = self.current()
+
+            # Another process (e.g. `python -m ingestion.ingest`) may have flipped the pointer.
+            if self.state_path:
+                on_disk = load_generation_state(self.state_path)
+                if int(on_disk.get("active", 0)) != active.version:
+                    self._swap(on_disk)
+                    return True
+
+            manifest = scan_corpus()
+            if not full and not any(diff_manifests(active.manifest, manifest).values()):
+                return False
+
+            self.building = True
+            generation = allocate_generation(self.state_path, max([active.version, *self._draining]))
+            state = build_generation(
+                self.client,
+                None if full else active.version,
+                generation,
+                {} if full else active.manifest,
+                manifest,
+                self.embedder,
+            )
+            if not activate_generation(state, self.state_path):
+                # Another process went live with a newer generation meanwhile: serve that one instead.
+                drop_generation(self.client, generation)
+                self._swap(load_generation_state(self.state_path))
+                return True
+            self._swap(state)
+            self.last_error = None
+            return True
+        finally:
+            self.building = False
+            self._build_lock.release()
+
+    # ---------------------------
+    # Watcher
+    # ---------------------------
+    def _watch(self, interval_s: float) -> None:
+        while not self._stop.wait(interval_s):
+            try:
+                self.refresh()
+            except Exception as exc:
+                self.last_error = str(exc)
+                print(f"[index] refresh failed: {exc}")
+
+    def start_watcher(self, interval_s: float) -> None:
+        if interval_s <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(interval_s,), name="index-watcher", daemon=True)
+        self._thread.start()
+
+    def stop_watcher(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def info(self) -> Dict[str, Any]:
+        gen = self.current()
+        return {
+            "version": gen.version,
+            "built_at": gen.built_at,
+            "files": len(gen.manifest),
+            "child_chunks": gen.children_col.count(),
+            "building": self.building,
+            "draining": sorted(self._draining),
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,237 @@
+# app/intents.py
+# ============================================================
+# Zero-LLM fast path for the API server.
+#
+# Questions that don't need retrieval (greetings, help, "what can I access",
+# "who owns incident response") are answered from intents.yaml before any
+# embedding / Chroma / Gemini work happens.
+#
+# Everything is compiled once at load time:
+#   - exact phrases   -> one dict lookup
+#   - contains phrases -> one alternation regex (single C-level scan)
+#   - patterns         -> compiled regexes
+# so routing a question costs microseconds.
+#
+#   python -m app.intents   # route the `examples` in intents.yaml, exit 1 on a mismatch
+# ============================================================
+
+import os
+import re
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ingestion.ingest import DATA_ROOT, _dept_from_rel, _source_display
+
+Responder = Callable[["Intent", Dict[str, str], Dict[str, Any]], Optional[Tuple[str, List[Dict[str, Any]]]]]
+
+_NON_WORD = re.compile(r"[^a-z0-9' ]+")
+_RACI_HEADING = re.compile(r"^#+\s*\d+\.\s*(.+?)\s*$")
+_RACI_LINE = re.compile(r"^(.+?)\s+[–-]\s+([RACI])\s*$")
+_RACI_WORDS = {"R": "responsible", "A": "accountable", "C": "consulted", "I": "informed"}
+
+
+def normalize_question(q: str) -> str:
+    q = q.lower().replace("’", "'")
+    return " ".join(_NON_WORD.sub(" ", q).split())
+
+
+class Intent:
+    def __init__(self, cfg: Dict[str, Any]) -> None:
+        self.name: str = cfg["name"]
+        self.mode: str = cfg.get("mode", "canned")
+        self.match: str = cfg.get("match", "exact")
+        self.phrases: List[str] = [normalize_question(p) for p in cfg.get("phrases", []) or []]
+        self.pattern = re.compile(cfg["pattern"]) if cfg.get("pattern") else None
+        self.cfg = cfg
+
+
+class IntentMatch:
+    def __init__(self, intent: Intent, answer: str, citations: List[Dict[str, Any]]) -> None:
+        self.name = intent.name
+        self.mode = intent.mode
+        self.answer = answer
+        self.citations = citations
+
+
+# ---------------------------
+# Responders (one per mode)
+# ---------------------------
+def respond_canned(intent: Intent, groups: Dict[str, str], ctx: Dict[str, Any]):
+    departments = ", ".join(ctx.get("allowed_departments") or []) or "none"
+    return intent.cfg.get("answer", "").format(
+        username=ctx.get("username", ""),
+        role=ctx.get("role", ""),
+        departments=departments,
+    ), []
+
+
+def answer_access_from_rbac(role: str, allowed_depts: List[str]) -> str:
+    if not allowed_depts:
+        return (
+            f"As {role}, you don’t currently have any configured access. "
+            "Ask an admin to add allowed departments for your role."
+        )
+    dept_list = ", ".join(allowed_depts)
+    return (
+        f"As {role}, you can access documents in these areas: {dept_list}. "
+        "If you need access to additional areas, request an update to your role permissions."
+    )
+
+
+def respond_rbac_access(intent: Intent, groups: Dict[str, str], ctx: Dict[str, Any]):
+    return answer_access_from_rbac(ctx.get("role", ""), ctx.get("allowed_departments") or []), []
+
+
+def parse_raci(text: str) -> Dict[str, Dict[str, List[str]]]:
+    """'# 2. Incident Response' + 'CISO – A' lines -> {"incident response": {"A": ["CISO"], ...}}"""
+    table: Dict[str, Dict[str, List[str]]] = {}
+    current: Optional[Dict[str, List[str]]] = None
+    for raw in text.splitlines():
+        line = raw.strip()
+        heading = _RACI_HEADING.match(line)
+        if heading:
+            current = table.setdefault(normalize_question(heading.group(1)), {})
+            continue
+        row = _RACI_LINE.match(line)
+        if row and current is not None:
+            current.setdefault(row.group(2), []).append(row.group(1).strip())
+    return {k: v for k, v in table.items() if v}
+
+
+class RaciResponder:
+    """Answers "who owns <process>" from a RACI matrix, only for roles allowed to read that document."""
+
+    def __init__(self, rel: str) -> None:
+        with open(os.path.join(DATA_ROOT, rel), "r", encoding="utf-8", errors="ignore") as f:
+            self.table = parse_raci(f.read())
+        self.department = _dept_from_rel(rel)
+        self.source = _source_display(rel)
+        names = sorted(self.table, key=len, reverse=True)
+        self.lookup = re.compile(r"\b(" + "|".join(re.escape(n) for n in names) + r")\b") if names else None
+
+    def __call__(self, intent: Intent, groups: Dict[str, str], ctx: Dict[str, Any]):
+        if self.lookup is None or self.department not in (ctx.get("allowed_departments") or []):
+            return None
+        hit = self.lookup.search(groups.get("process", ""))
+        if not hit:
+            return None
+
+        process = hit.group(1)
+        row = self.table[process]
+        parts = []
+        for letter in ("A", "R", "C", "I"):
+            who = row.get(letter)
+            if who:
+                verb = "is" if len(who) == 1 else "are"
+                parts.append(f"{' and '.join(who)} {verb} {_RACI_WORDS[letter]}")
+        answer = f"For {process.title()}, " + "; ".join(parts) + ". Sources: [1]"
+        citation = {"n": 1, "source": self.source, "department": self.department, "parent_index": None}
+        return answer, [citation]
+
+
+# ---------------------------
+# Router
+# ---------------------------
+class IntentRouter:
+    def __init__(self, intents: List[Intent]) -> None:
+        self.intents = intents
+        self.responders: Dict[str, Responder] = {
+            "canned": respond_canned,
+            "rbac_access": respond_rbac_access,
+        }
+        self._raci: Dict[str, RaciResponder] = {}
+        self._compile()
+
+    @classmethod
+    def from_yaml(cls, cfg: Dict[str, Any]) -> "IntentRouter":
+        return cls([Intent(c) for c in cfg.get("intents", []) or []])
+
+    def register(self, mode: str, responder: Responder) -> None:
+        """Plug in a new mode; intents.yaml entries with `mode: <mode>` will use it."""
+        self.responders[mode] = responder
+
+    def _compile(self) -> None:
+        self._exact: Dict[str, Intent] = {}
+        self._contains: Dict[str, Intent] = {}
+        self._patterns: List[Intent] = []
+
+        for intent in self.intents:
+            if intent.match == "exact":
+                for p in intent.phrases:
+                    self._exact.setdefault(p, intent)
+            elif intent.match == "contains":
+                for p in intent.phrases:
+                    self._contains.setdefault(p, intent)
+            elif intent.pattern is not None:
+                self._patterns.append(intent)
+            if intent.mode == "raci" and intent.cfg.get("source"):
+                self._raci[intent.name] = RaciResponder(intent.cfg["source"])
+
+        phrases = sorted(self._contains, key=len, reverse=True)
+        self._contains_re = re.compile(r"\b(?:" + "|".join(re.escape(p) for p in phrases) + r")\b") if phrases else None
+
+    def _respond(self, intent: Intent, groups: Dict[str, str], ctx: Dict[str, Any]) -> Optional[IntentMatch]:
+        responder = self._raci.get(intent.name) if intent.mode == "raci" else self.responders.get(intent.mode)
+        if responder is None:
+            return None
+        out = responder(intent, groups, ctx)
+        if out is None:
+            return None
+        answer, citations = out
+        return IntentMatch(intent, answer, citations)
+
+    def route(self, question: str, ctx: Dict[str, Any]) -> Optional[IntentMatch]:
+        """Return a ready answer for fast-path questions, or None to fall through to RAG."""
+        q = normalize_question(question)
+        if not q:
+            return None
+
+        intent = self._exact.get(q)
+        if intent is not None:
+            hit = self._respond(intent, {}, ctx)
+            if hit is not None:
+                return hit
+
+        if self._contains_re is not None:
+            m = self._contains_re.search(q)
+            if m:
+                hit = self._respond(self._contains[m.group(0)], {}, ctx)
+                if hit is not None:
+                    return hit
+
+        for intent in self._patterns:
+            m = intent.pattern.search(q)
+            if m:
+                hit = self._respond(intent, m.groupdict(), ctx)
+                if hit is not None:
+                    return hit
+        return None
+
+
+def main() -> None:
+    import yaml
+
+    from app.policy import load_policy
+
+    with open(os.path.join(os.path.dirname(DATA_ROOT), "intents.yaml"), "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f) or {}
+    router = IntentRouter.from_yaml(cfg)
+
+    # Every role may see the RACI document here, so a routing miss is never an RBAC effect.
+    policy = load_policy()
+    departments = sorted({d for plan in policy.roles.values() for d in plan.departments})
+    ctx = {"username": "check", "role": "check", "allowed_departments": departments}
+
+    failed = 0
+    for question, expected in (cfg.get("examples") or {}).items():
+        hit = router.route(question, ctx)
+        got = hit.name if hit is not None else None
+        ok = got == expected
+        failed += not ok
+        print(f"  {'ok  ' if ok else 'FAIL'} {question!r} -> {got or 'retrieval'} (expected {expected or 'retrieval'})")
+    print(f"{len(cfg.get('examples') or {}) - failed} ok, {failed} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+# app/loadtest.py
+# ============================================================
+# End-to-end load test for the API server.
+#
+# - Virtual users log in as the accounts in users.yaml (round-robin, so all
+#   roles are covered) and replay questions mined from audit_log.jsonl
+#   (per role) or a requests.jsonl-style file, with think time between
+#   questions sampled from the gaps between real turns in the audit log
+#   (exponential around --think-ms when there are too few).
+# - Concurrency ramps up step by step; each step runs for --step-seconds.
+# - By default a local server is started with the stub generator
+#   (LLM_PROVIDER=fake), a scratch audit log and no warm-up, so numbers
+#   measure our stack rather than Gemini, and real logs stay clean.
+#   Its per-user rate limits (scheduler.yaml) are lifted, because a few
+#   demo accounts stand in for many users; LLM slots and role weights
+#   stay. --rate-limits keeps the configured limits. The local server runs
+#   a single worker: sessions live in per-process memory, so a login and
+#   the chats that follow it must reach the same process.
+# - Per step: throughput and latency percentiles of successful requests,
+#   error and 429 rates (reported separately), failed logouts and the
+#   server's peak RSS.
+#
+#   python -m app.loadtest --steps 1 2 4 8 16 32 --step-seconds 30 [--out report.json]
+#   python -m app.loadtest --url http://localhost:8000 --server-pid 1234
+# ============================================================
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+from app.core import PROJECT_ROOT, load_yaml
+from app.generation import percentile
+
+AUDIT_LOG_PATH = os.path.join(PROJECT_ROOT, "audit_log.jsonl")
+USERS_PATH = os.path.join(PROJECT_ROOT, "users.yaml")
+SCHEDULER_PATH = os.path.join(PROJECT_ROOT, "scheduler.yaml")
+UNLIMITED = 1_000_000
+
+LOAD_STEPS = [1, 2, 4, 8, 16, 32]
+STEP_SECONDS = 30.0
+THINK_MS = 2000.0
+MIN_THINK_GAPS = 20             # audit-log gaps needed before they replace the exponential model
+MAX_THINK_SECONDS = 60.0
+REQUEST_TIMEOUT_SECONDS = 60.0
+FAKE_LLM_LATENCY_MS = 800
+SERVER_READY_SECONDS = 180.0
+
+
+# ---------------------------
+# Workload
+# ---------------------------
+def _parse_ts(ts: Optional[str]) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(ts).timestamp() if ts else None
+    except ValueError:
+        return None
+
+
+def load_questions(path: str) -> Tuple[Dict[str, List[str]], List[float]]:
+    """
+    (role -> questions, think-time gaps in seconds) from an audit log or a
+    requests.jsonl-style file. Questions without a role go under "*".
+    """
+    by_role: Dict[str, List[str]] = {}
+    last_ts: Dict[str, float] = {}
+    gaps: List[float] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if rec.get("source") == "batch":
+                continue
+            question = (rec.get("question") or rec.get("body") or rec.get("title") or "").strip()
+            if not question:
+                continue
+            by_role.setdefault(rec.get("role") or "*", []).append(question)
+
+            ts, sid = _parse_ts(rec.get("ts")), rec.get("session_id")
+            if ts is not None and sid:
+                if sid in last_ts and 0 < ts - last_ts[sid] <= MAX_THINK_SECONDS:
+                    gaps.append(ts - last_ts[sid])
+                last_ts[sid] = ts
+    return by_role, gaps
+
+
+class ThinkTime:
+    def __init__(self, gaps: List[float], mean_ms: float, rng: random.Random) -> None:
+        self.gaps = gaps if len(gaps) >= MIN_THINK_GAPS else []
+        self.mean_s = mean_ms / 1000.0
+        self.rng = rng
+
+    def sample(self) -> float:
+        if self.gaps:
+            return self.rng.choice(self.gaps)
+        return min(MAX_THINK_SECONDS, self.rng.expovariate(1.0 / self.mean_s)) if self.mean_s > 0 else 0.0
+
+
+# ---------------------------
+# HTTP
+# ---------------------------
+def _post(url: str, body: Dict[str, Any], timeout_s: float = REQUEST_TIMEOUT_SECONDS) -> Tuple[int, Dict[str, Any]]:
+    req = urllib.request.Request(
+        url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout_s) as resp:
+            return resp.status, json.loads(resp.read() or b"{}")
+    except urllib.error.HTTPError as exc:
+        return exc.code, {}
+
+
+def _get(url: str, timeout_s: float = 5.0) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=timeout_s) as resp:
+        return json.loads(resp.read() or b"{}")
+
+
+def rss_mb(pid: Optional[int]) -> Optional[float]:
+    """Resident set size of `pid` and its children (uvicorn workers), from /proc."""
+    if pid is None:
+        return None
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    total_kb = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1) if total_kb else None
+
+
+# ---------------------------
+# Local server
+# ---------------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _unlimited_scheduler(scratch: str) -> str:
+    """scheduler.yaml with the per-user rate limits lifted (slots and role weights unchanged)."""
+    cfg = load_yaml(SCHEDULER_PATH) if os.path.exists(SCHEDULER_PATH) else {}
+    cfg.update(
+        rate_limit={"per_minute": UNLIMITED, "burst": UNLIMITED}, user_rate_limits={}, max_queued_per_user=UNLIMITED
+    )
+    path = os.path.join(scratch, "scheduler.yaml")
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(cfg, f)
+    return path
+
+
+def start_server(env_overrides: Optional[Dict[str, str]] = None, rate_limits: bool = False) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    scratch = tempfile.mkdtemp(prefix="rt-loadtest-")
+    env = dict(os.environ)
+    env.setdefault("LLM_PROVIDER", "fake")
+    env.setdefault("FAKE_LLM_LATENCY_MS", str(FAKE_LLM_LATENCY_MS))
+    env.setdefault("WARMUP_TOP_N", "0")
+    env.setdefault("INDEX_WATCH_SECONDS", "0")
+    env.setdefault("AUDIT_LOG_PATH", os.path.join(scratch, "audit_log.jsonl"))
+    if not rate_limits:
+        env.setdefault("SCHEDULER_PATH", _unlimited_scheduler(scratch))
+    env.update(env_overrides or {})
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_ROOT,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_READY_SECONDS
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode} during startup")
+        try:
+            _get(url + "/api/index")
+            return proc, url
+        except (OSError, ValueError):
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError(f"server not ready after {SERVER_READY_SECONDS:.0f}s")
+
+
+# ---------------------------
+# Load steps
+# ---------------------------
+class VirtualUser(threading.Thread):
+    def __init__(
+        self,
+        url: str,
+        account: Tuple[str, Dict[str, Any]],
+        questions: List[str],
+        think: ThinkTime,
+        mode: str,
+        stop: threading.Event,
+        results: List[Tuple[int, float]],
+        lock: threading.Lock,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.url = url
+        self.username, self.user = account
+        self.questions = questions
+        self.think = think
+        self.mode = mode
+        self.stop = stop
+        self.results = results
+        self.lock = lock
+        # HTTP status of the final logout (0: connection error), None if the user never logged in.
+        self.logout_status: Optional[int] = None
+
+    def _record(self, status: int, latency_s: float) -> None:
+        with self.lock:
+            self.results.append((status, latency_s))
+
+    def run(self) -> None:
+        status, body = _post(self.url + "/api/login", {"username": self.username, "password": self.user.get("password")})
+        if status != 200:
+            self._record(status, 0.0)
+            return
+        session_id = body["session_id"]
+        # Stagger the first question so a step does not open with a synchronized burst.
+        if self.stop.wait(self.think.rng.uniform(0, self.think.sample())):
+            return
+        while not self.stop.is_set():
+            question = self.think.rng.choice(self.questions)
+            t0 = time.monotonic()
+            try:
+                status, _ = _post(self.url + "/api/chat", {"session_id": session_id, "question": question, "mode": self.mode})
+            except OSError:
+                status = 0   # connection error / timeout
+            self._record(status, time.monotonic() - t0)
+            if self.stop.wait(self.think.sample()):
+                break
+        # /api/logout takes session_id as a query parameter; sessions left behind would inflate later steps' RSS.
+        query = urllib.parse.urlencode({"session_id": session_id})
+        try:
+            self.logout_status, _ = _post(f"{self.url}/api/logout?{query}", {}, timeout_s=5.0)
+        except OSError:
+            self.logout_status = 0
+
+
+def run_step(
+    url: str,
+    concurrency: int,
+    seconds: float,
+    accounts: List[Tuple[str, Dict[str, Any]]],
+    questions: Dict[str, List[str]],
+    gaps: List[float],
+    think_ms: float,
+    mode: str,
+    server_pid: Optional[int],
+    seed: int,
+) -> Dict[str, Any]:
+    stop = threading.Event()
+    lock = threading.Lock()
+    results: List[Tuple[int, float]] = []
+    fallback = [q for qs in questions.values() for q in qs]
+
+    users = []
+    for i in range(concurrency):
+        account = accounts[i % len(accounts)]
+        pool = questions.get(account[1].get("role")) or fallback
+        rng = random.Random(seed * 1000 + i)
+        users.append(VirtualUser(url, account, pool, ThinkTime(gaps, think_ms, rng), mode, stop, results, lock))
+
+    started = time.monotonic()
+    for u in users:
+        u.start()
+    peak_rss = rss_mb(server_pid)
+    while time.monotonic() - started < seconds:
+        time.sleep(1.0)
+        rss = rss_mb(server_pid)
+        if rss is not None and (peak_rss is None or rss > peak_rss):
+            peak_rss = rss
+    stop.set()
+    for u in users:
+        u.join(timeout=REQUEST_TIMEOUT_SECONDS)
+    elapsed = time.monotonic() - started
+
+    with lock:
+        done = list(results)
+    ok = sorted(lat for status, lat in done if status == 200)
+    throttled = sum(1 for status, _ in done if status == 429)
+    errors = sum(1 for status, _ in done if status not in (200, 429))
+    logout_failures = sum(1 for u in users if u.logout_status not in (None, 200))
+    n = len(done)
+
+    def ms(v: Optional[float]) -> Optional[float]:
+        return None if v is None else round(v * 1000, 1)
+
+    return {
+        "concurrency": concurrency,
+        "requests": n,
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {p: ms(percentile(ok, q)) for p, q in (("p50", 50), ("p90", 90), ("p95", 95), ("p99", 99), ("max", 100))},
+        "error_rate": round(errors / n, 4) if n else None,
+        "rate_limited_rate": round(throttled / n, 4) if n else None,
+        "logout_failures": logout_failures,
+        "server_rss_mb": peak_rss,
+    }
+
+
+def run_ramp(
+    url: str,
+    steps: List[int],
+    step_seconds: float,
+    questions_path: str,
+    think_ms: float = THINK_MS,
+    mode: str = "generative",
+    server_pid: Optional[int] = None,
+    stop_error_rate: float = 0.5,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    questions, gaps = load_questions(questions_path)
+    if not questions:
+        raise ValueError(f"no questions found in {questions_path}")
+    accounts = sorted((load_yaml(USERS_PATH).get("users") or {}).items())
+    if not accounts:
+        raise ValueError(f"no users in {USERS_PATH}")
+
+    report = []
+    for i, concurrency in enumerate(steps):
+        step = run_step(url, concurrency, step_seconds, accounts, questions, gaps, think_ms, mode, server_pid, seed + i)
+        report.append(step)
+        lat = step["latency_ms"]
+        print(
+            f"[loadtest] c={concurrency:<4} rps={step['throughput_rps']} p50={lat['p50']} p95={lat['p95']} "
+            f"p99={lat['p99']} err={step['error_rate']} 429={step['rate_limited_rate']} "
+            f"logout_fail={step['logout_failures']} rss={step['server_rss_mb']}MB",
+            file=sys.stderr,
+        )
+        if step["error_rate"] is not None and step["error_rate"] > stop_error_rate:
+            print(f"[loadtest] stopping: error rate above {stop_error_rate}", file=sys.stderr)
+            break
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ramp concurrency against the API server and report per step.")
+    parser.add_argument("--url", help="existing server; default starts a local one with the stub generator")
+    parser.add_argument("--server-pid", type=int, help="pid to sample RSS from when using --url")
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep scheduler.yaml's per-user rate limits on the local server (default: lifted, so steps measure capacity)",
+    )
+    parser.add_argument("--questions", default=AUDIT_LOG_PATH, help="audit_log.jsonl or requests.jsonl-style file")
+    parser.add_argument("--steps", type=int, nargs="+", default=LOAD_STEPS)
+    parser.add_argument("--step-seconds", type=float, default=STEP_SECONDS)
+    parser.add_argument("--think-ms", type=float, default=THINK_MS)
+    parser.add_argument("--mode", default="generative", choices=("generative", "extractive"))
+    parser.add_argument("--stop-error-rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args()
+
+    proc = None
+    url, pid = args.url, args.server_pid
+    if not url:
+        proc, url = start_server(rate_limits=args.rate_limits)
+        pid = proc.pid
+    try:
+        steps = run_ramp(
+            url, args.steps, args.step_seconds, args.questions, args.think_ms, args.mode, pid, args.stop_error_rate, args.seed
+        )
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    report = {"url": url, "questions": args.questions, "step_seconds": args.step_seconds, "steps": steps}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
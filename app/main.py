@@ -1,29 +1,32 @@
 # app/main.py
 # ============================================================
-# Clean RAG + RBAC (Chroma) + Gemini
+# CLI front-end for the shared RAG pipeline in app/core.py (RagRuntime)
 # + Audit logging (JSONL)
 # + Persistent sessions (JSON)
-# + Conversational history (bounded)
-# + Parent/Child retrieval (2 collections)
+# + Conversational history (bounded, same policy as the API server)
 #
-# Collections:
-#   - rt_children: embedded child chunks (retrieval)
-#   - rt_parents : parent chunks (coherent generation context)
+# Two ways to run it:
+#   python -m app.main
+#       interactive: pick a role, then ask questions / type commands
+#   python -m app.main --batch questions.jsonl [--workers 8] [--out results.jsonl]
+#       non-interactive: one {"question", "role", "id"?, "mode"?} per line
+#       (requests.jsonl-style {"request_id", "title", "body"} also works);
+#       results stream out as they finish, followed by a throughput /
+#       latency summary on stderr. Used for nightly regression runs.
 # ============================================================
 
-import os
+import argparse
 import json
+import os
+import sys
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
-from typing import Dict, Any, List
-
-import yaml
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+from typing import Any, Dict, List, Optional
 
-from dotenv import load_dotenv
-import google.generativeai as genai
+from app.core import ANSWER_MODES, PROJECT_ROOT, RagRuntime
+from app.generation import percentile
 
 
 # ============================================================
@@ -33,9 +36,8 @@ import google.generativeai as genai
 AUDIT_LOG_PATH = "audit_log.jsonl"
 SESSIONS_DIR = "sessions"
 
-MAX_HISTORY_TURNS = 6          # keep last N user/assistant pairs in memory
-TOP_K_CHILD = 12               # retrieve this many child chunks
-MAX_PARENTS_IN_CONTEXT = 4     # include top unique parents for coherence
+BATCH_WORKERS = 8
+EMBED_BATCH_SIZE = 64
 
 
 # ============================================================
@@ -81,196 +83,56 @@ def load_session(project_root: str, session_id: str) -> Dict[str, Any]:
         return json.load(f)
 
 
-# ============================================================
-# RBAC (YAML RULES)
-# ============================================================
-
-def load_rbac_rules(path: str) -> Dict[str, Any]:
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
-
-
-def allowed_departments_for_role(rules: Dict[str, Any], role: str) -> List[str]:
-    roles = rules.get("roles", {})
-    if role not in roles:
-        return []
-    return roles[role].get("allow_departments", [])
-
-
-# ============================================================
-# INTENT ROUTER FOR "ACCESS" QUESTIONS
-# These should be answered from RBAC rules, not RAG docs.
-# ============================================================
-
-def is_access_question(q: str) -> bool:
-    q = q.lower().strip()
-    triggers = [
-        "what do i have access",
-        "what all i have access",
-        "what can i access",
-        "my access",
-        "my permissions",
-        "what am i allowed",
-        "what am i authorized",
-        "which documents can i see",
-        "which departments can i access",
-        "access rights",
-        "rbac",
-        "permissions",
-        "authorized",
-    ]
-    return any(t in q for t in triggers)
-
-
-def answer_access_from_rbac(role: str, allowed_depts: List[str]) -> str:
-    if not allowed_depts:
-        return (
-            f"As {role}, you don’t currently have any configured access. "
-            "Ask an admin to add allowed departments for your role."
-        )
-    dept_list = ", ".join(allowed_depts)
-    return (
-        f"As {role}, you can access documents in these areas: {dept_list}. "
-        "If you need access to additional areas, request an update to your role permissions."
-    )
+def new_session(role: Optional[str], allowed_depts: List[str]) -> Dict[str, Any]:
+    return {
+        "session_id": str(uuid.uuid4()),
+        "created_at": utc_now_iso(),
+        "username": "cli",
+        "role": role,
+        "allowed_departments": allowed_depts,
+        "history": [],
+        "summary": "",
+    }
 
 
 # ============================================================
-# RETRIEVAL (CHILD COLLECTION)
-# - Embed question
-# - Chroma query with RBAC metadata filter
-# - Deduplicate by (source, parent_id, child_index)
+# ONE QUESTION THROUGH THE PIPELINE
+# Fast-path intents first (same router as the API server), then RAG.
 # ============================================================
 
-def retrieve_children(children_col, embedder, question: str, allowed_depts: List[str], k: int = TOP_K_CHILD):
-    q_emb = embedder.encode([question], normalize_embeddings=True).tolist()[0]
-    where_filter = {"department": {"$in": allowed_depts}} if allowed_depts else {"department": "__none__"}
-
-    res = children_col.query(
-        query_embeddings=[q_emb],
-        n_results=k,
-        where=where_filter,
-        include=["documents", "metadatas", "distances"],
+def ask(runtime: RagRuntime, session: Dict[str, Any], question: str, mode: str = "generative") -> Dict[str, Any]:
+    hit = runtime.intents.route(question, session)
+    if hit is not None:
+        return {"answer": hit.answer, "citations": hit.citations, "mode": hit.mode, "intent": hit.name, "trace": {}}
+
+    trace: Dict[str, Any] = {}
+    answer, citations = runtime.answer(
+        question=question,
+        allowed_depts=session["allowed_departments"],
+        history=session["history"][:-1],
+        summary=session.get("summary", ""),
+        mode=mode,
+        trace=trace,
+        plan=runtime.policy.current.plan(session["role"]),
     )
-
-    docs = res.get("documents", [[]])[0]
-    metas = res.get("metadatas", [[]])[0]
-    dists = res.get("distances", [[]])[0]
-
-    seen = set()
-    out = []
-    for doc, meta, dist in zip(docs, metas, dists):
-        if not meta:
-            continue
-        key = (meta.get("source"), meta.get("parent_id"), meta.get("child_index"))
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append({"text": doc, "metadata": meta, "distance": float(dist)})
-
-    return out
-
-
-# ============================================================
-# CONTEXT BUILDING (PARENT COLLECTION)
-# - Collect top unique parent_ids (rank order)
-# - Fetch parent texts from rt_parents by parent_id
-# - Build coherent context blocks for the LLM
-# ============================================================
-
-def build_parent_context_from_ids(
-    parents_col,
-    retrieved_children: List[Dict[str, Any]],
-    max_parents: int = MAX_PARENTS_IN_CONTEXT,
-):
-    parent_ids: List[str] = []
-    seen = set()
-
-    for r in retrieved_children:
-        pid = r["metadata"].get("parent_id")
-        if not pid or pid in seen:
-            continue
-        seen.add(pid)
-        parent_ids.append(pid)
-        if len(parent_ids) >= max_parents:
-            break
-
-    if not parent_ids:
-        return [], []
-
-    got = parents_col.get(ids=parent_ids, include=["documents", "metadatas"])
-    parent_docs = got.get("documents") or []
-    parent_metas = got.get("metadatas") or []
-
-    context_blocks = []
-    citations = []
-    for i, (ptxt, pmeta) in enumerate(zip(parent_docs, parent_metas), start=1):
-        context_blocks.append(f"[{i}] {ptxt}")
-        citations.append({
-            "n": i,
-            "source": (pmeta or {}).get("source"),
-            "department": (pmeta or {}).get("department"),
-            "parent_index": (pmeta or {}).get("parent_index"),
-        })
-
-    return context_blocks, citations
-
-
-# ============================================================
-# CONVERSATION HISTORY
-# - Bounded memory for continuity
-# ============================================================
-
-def trim_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    max_items = MAX_HISTORY_TURNS * 2
-    return history[-max_items:] if len(history) > max_items else history
-
-
-def format_history(history: List[Dict[str, str]]) -> str:
-    lines = []
-    for h in history:
-        if h["role"] == "user":
-            lines.append(f"User: {h['text']}")
-        else:
-            lines.append(f"Assistant: {h['text']}")
-    return "\n".join(lines).strip()
-
-
-# ============================================================
-# PROMPTING (NATURAL ASSISTANT STYLE)
-# - No metadata/chunk talk
-# - No "based on the doc"
-# - Clean paragraph
-# - Citations only at the end
-# ============================================================
-
-def build_prompt(question: str, allowed_depts: List[str], history: List[Dict[str, str]], context_blocks: List[str]) -> str:
-    history_text = format_history(history)
-
-    return f"""
-You are a professional enterprise AI assistant.
-
-INSTRUCTIONS:
-- Answer naturally and clearly, as if speaking to an employee.
-- Do NOT mention file paths, chunking, metadata, or internal system behavior.
-- Do NOT say "based on the document" or "the context says".
-- Prefer a single clean paragraph unless the user explicitly asks for a list.
-- Only use information from the provided context blocks.
-- If the context is insufficient, say: "I don't have enough information in the allowed documents."
-- Add citations ONLY at the very end like: Sources: [1], [2]
-
-RBAC allowed departments:
-{allowed_depts}
-
-Conversation so far (for continuity, not for new facts):
-{history_text if history_text else "(none)"}
-
-User question:
-{question}
-
-Context blocks:
-{chr(10).join(context_blocks)}
-""".strip()
+    return {"answer": answer, "citations": citations, "mode": trace["mode"], "intent": None, "trace": trace}
+
+
+def audit_record(session: Dict[str, Any], question: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "ts": utc_now_iso(),
+        "session_id": session["session_id"],
+        "role": session["role"],
+        "allowed_departments": session["allowed_departments"],
+        "question": question,
+        "mode": result["mode"],
+        "intent": result["intent"],
+        "index_version": result["trace"].get("index_version"),
+        "coalesced": result["trace"].get("coalesced", False),
+        "queue_wait_ms": result["trace"].get("queue_wait_ms"),
+        "retrieved": result["citations"],   # parent-level citations
+        "answer": result["answer"],
+    }
 
 
 # ============================================================
@@ -288,64 +150,27 @@ def print_commands():
 
 
 # ============================================================
-# MAIN APP LOOP
+# INTERACTIVE LOOP
 # ============================================================
 
-def main():
-    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    rules_path = os.path.join(project_root, "rbac_rules.yaml")
-    db_dir = os.path.join(project_root, "chroma_db")
-
+def run_interactive(runtime: RagRuntime, project_root: str) -> None:
     ensure_dirs(project_root)
 
-    # ---- Load Gemini config ----
-    load_dotenv(os.path.join(project_root, ".env"))
-    api_key = os.getenv("GEMINI_API_KEY", "").strip()
-    model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash").strip()
-
-    if not api_key:
-        raise SystemExit("Missing GEMINI_API_KEY in .env")
-
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_name)
-
-    # ---- Load RBAC rules ----
-    rules = load_rbac_rules(rules_path)
-
-    # ---- Chroma: 2 collections (parents + children) ----
-    client = chromadb.PersistentClient(path=db_dir, settings=Settings(anonymized_telemetry=False))
-    parents_col = client.get_or_create_collection(name="rt_parents")
-    children_col = client.get_or_create_collection(name="rt_children")
-
-    # ---- Embeddings ----
-    embedder = SentenceTransformer("all-MiniLM-L6-v2")
-
-    # ---- Session state ----
-    session = {
-        "session_id": str(uuid.uuid4()),
-        "created_at": utc_now_iso(),
-        "role": None,
-        "allowed_departments": [],
-        "history": [],
-    }
-
     print("\n=== Clean RAG with RBAC (Chroma + Gemini) ===")
     print("Type 'help' to see commands.\n")
 
     # ---- Role selection (RBAC gate) ----
     role = input("Enter role (engineering/hr/legal/operations/security/risk): ").strip()
-    allowed_depts = allowed_departments_for_role(rules, role)
+    policy = runtime.policy.current
+    allowed_depts = policy.departments(role)
 
-    if rules.get("default_deny", True) and not allowed_depts:
+    if policy.default_deny and not allowed_depts:
         print("\n[RBAC] DENY: role not recognized or no allowed departments configured.")
         return
 
-    session["role"] = role
-    session["allowed_departments"] = allowed_depts
-
+    session = new_session(role, allowed_depts)
     print(f"\n[RBAC] ALLOW: role={role} can access departments={allowed_depts}")
 
-    # ---- Interactive loop ----
     while True:
         raw = input("\nAsk a question (or type a command): ").strip()
         if not raw:
@@ -366,6 +191,7 @@ def main():
 
         if cmd == "reset":
             session["history"] = []
+            session["summary"] = ""
             print("Conversation history cleared.")
             continue
 
@@ -378,8 +204,8 @@ def main():
             _, sid = raw.split(" ", 1)
             sid = sid.strip()
             try:
-                loaded = load_session(project_root, sid)
-                session = loaded
+                session = load_session(project_root, sid)
+                session.setdefault("summary", "")
                 role = session["role"]
                 allowed_depts = session["allowed_departments"]
                 print(f"Loaded session {sid} (role={role}, allowed={allowed_depts})")
@@ -388,129 +214,165 @@ def main():
             continue
 
         if cmd == "newsession":
-            session = {
-                "session_id": str(uuid.uuid4()),
-                "created_at": utc_now_iso(),
-                "role": role,
-                "allowed_departments": allowed_depts,
-                "history": [],
-            }
+            session = new_session(role, allowed_depts)
             print(f"Started new session: {session['session_id']}")
             continue
 
-        # ====================================================
-        # Normal Question Flow
-        # ====================================================
+        # ---- Normal question flow ----
         question = raw
-
-        # ---- Add user msg to history ----
         session["history"].append({"role": "user", "text": question})
-        session["history"] = trim_history(session["history"])
-
-        # ---- RBAC access questions: answer from rules ----
-        if is_access_question(question):
-            answer = answer_access_from_rbac(role, allowed_depts)
-            print("\n=== Answer ===\n")
-            print(answer)
-
-            session["history"].append({"role": "assistant", "text": answer})
-            session["history"] = trim_history(session["history"])
-
-            append_audit({
-                "ts": utc_now_iso(),
-                "session_id": session["session_id"],
-                "role": role,
-                "allowed_departments": allowed_depts,
-                "question": question,
-                "mode": "rbac_access",
-                "retrieved": [],
-                "answer": answer,
-            }, project_root)
-            continue
 
-        # ---- Retrieve children (RBAC filtered) ----
-        retrieved_children = retrieve_children(children_col, embedder, question, allowed_depts, k=TOP_K_CHILD)
-
-        if not retrieved_children:
-            answer = "I don't have enough information in the allowed documents."
-            print("\n=== Answer ===\n")
-            print(answer)
-
-            session["history"].append({"role": "assistant", "text": answer})
-            session["history"] = trim_history(session["history"])
-
-            append_audit({
-                "ts": utc_now_iso(),
-                "session_id": session["session_id"],
-                "role": role,
-                "allowed_departments": allowed_depts,
-                "question": question,
-                "mode": "rag",
-                "retrieved": [],
-                "answer": answer,
-            }, project_root)
-            continue
+        result = ask(runtime, session, question)
 
         # ---- Developer visibility (optional) ----
-        print("\n[Retrieval] Top child matches:")
-        for i, r in enumerate(retrieved_children[:6], start=1):
-            m = r["metadata"]
-            print(
-                f"  {i}. dist={r['distance']:.4f} dept={m.get('department')} source={m.get('source')} "
-                f"parent_id={m.get('parent_id')} parent={m.get('parent_index')} child={m.get('child_index')}"
-            )
+        top = result["trace"].get("top_children") or []
+        if top:
+            print("\n[Retrieval] Top child matches:")
+            for i, m in enumerate(top[:6], start=1):
+                print(
+                    f"  {i}. dist={m['distance']:.4f} dept={m.get('department')} source={m.get('source')} "
+                    f"parent={m.get('parent_index')} child={m.get('child_index')}"
+                )
 
-        # ---- Fetch parent texts to build coherent context ----
-        context_blocks, citations = build_parent_context_from_ids(
-            parents_col, retrieved_children, max_parents=MAX_PARENTS_IN_CONTEXT
-        )
-
-        if not context_blocks:
-            answer = "I don't have enough information in the allowed documents."
-            print("\n=== Answer ===\n")
-            print(answer)
-
-            session["history"].append({"role": "assistant", "text": answer})
-            session["history"] = trim_history(session["history"])
-
-            append_audit({
-                "ts": utc_now_iso(),
-                "session_id": session["session_id"],
-                "role": role,
-                "allowed_departments": allowed_depts,
-                "question": question,
-                "mode": "rag",
-                "retrieved": citations,
-                "answer": answer,
-            }, project_root)
-            continue
+        print("\n=== Answer ===\n")
+        print(result["answer"])
 
-        # ---- Build prompt with conversation history (bounded) ----
-        # Use history excluding current user message if you prefer. Here we exclude it:
-        prompt = build_prompt(question, allowed_depts, session["history"][:-1], context_blocks)
+        session["history"].append({"role": "assistant", "text": result["answer"]})
+        runtime.update_history(session)
+        append_audit(audit_record(session, question, result), project_root)
 
-        # ---- Gemini generation ----
-        resp = model.generate_content(prompt)
-        answer = (resp.text or "").strip()
 
-        print("\n=== Answer ===\n")
-        print(answer)
-
-        # ---- Add assistant msg to history ----
-        session["history"].append({"role": "assistant", "text": answer})
-        session["history"] = trim_history(session["history"])
-
-        # ---- Audit log ----
-        append_audit({
-            "ts": utc_now_iso(),
-            "session_id": session["session_id"],
-            "role": role,
-            "allowed_departments": allowed_depts,
-            "question": question,
-            "mode": "rag",
-            "retrieved": citations,   # parent-level citations
-            "answer": answer,
-        }, project_root)
+# ============================================================
+# BATCH MODE
+# ============================================================
+
+def load_batch(path: str, default_role: Optional[str], default_mode: str) -> List[Dict[str, Any]]:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            items.append(
+                {
+                    "id": rec.get("id") or rec.get("request_id") or str(line_no),
+                    "question": (rec.get("question") or rec.get("body") or rec.get("title") or "").strip(),
+                    "role": rec.get("role") or default_role,
+                    "mode": rec.get("mode") or default_mode,
+                }
+            )
+    return items
+
+
+def run_batch(
+    runtime: RagRuntime,
+    project_root: str,
+    items: List[Dict[str, Any]],
+    workers: int = BATCH_WORKERS,
+    out=sys.stdout,
+    audit: bool = True,
+) -> Dict[str, Any]:
+    batch_id = str(uuid.uuid4())
+    started = time.monotonic()
+
+    # One batched encode up front; every worker then hits the embedding cache.
+    runtime.embed_queries([it["question"] for it in items if it["question"]], batch_size=EMBED_BATCH_SIZE)
+
+    # One policy version for the whole batch.
+    policy = runtime.policy.current
+
+    def work(item: Dict[str, Any]) -> Dict[str, Any]:
+        t0 = time.monotonic()
+        allowed = policy.departments(item["role"])
+        session = new_session(item["role"], allowed)
+        session["session_id"] = batch_id
+        out_rec: Dict[str, Any] = {"id": item["id"], "role": item["role"], "question": item["question"]}
+        try:
+            if not item["question"]:
+                raise ValueError("empty question")
+            if item["mode"] not in ANSWER_MODES:
+                raise ValueError(f"mode must be one of {list(ANSWER_MODES)}")
+            if policy.default_deny and not allowed:
+                raise PermissionError(f"role {item['role']!r} not recognized or has no allowed departments")
+            session["history"].append({"role": "user", "text": item["question"]})
+            result = ask(runtime, session, item["question"], item["mode"])
+            out_rec.update(answer=result["answer"], citations=result["citations"], mode=result["mode"])
+            out_rec["audit"] = {**audit_record(session, item["question"], result), "source": "batch", "item_id": item["id"]}
+        except Exception as exc:
+            out_rec["error"] = f"{type(exc).__name__}: {exc}"
+        out_rec["latency_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        return out_rec
+
+    latencies: List[float] = []
+    errors = 0
+    modes: Dict[str, int] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch") as pool:
+        futures = [pool.submit(work, it) for it in items]
+        # Written from this thread only, in completion order.
+        for fut in as_completed(futures):
+            rec = fut.result()
+            audit_rec = rec.pop("audit", None)
+            if audit and audit_rec is not None:
+                append_audit(audit_rec, project_root)
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+
+            latencies.append(rec["latency_ms"])
+            if "error" in rec:
+                errors += 1
+            else:
+                modes[rec["mode"]] = modes.get(rec["mode"], 0) + 1
+
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        "batch_id": batch_id,
+        "questions": len(items),
+        "errors": errors,
+        "modes": modes,
+        "workers": workers,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_qps": round(len(items) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": percentile(latencies, 100),
+        },
+    }
+
+
+# ============================================================
+# ENTRY POINT
+# ============================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="RT Healthcare RAG command line.")
+    parser.add_argument("--batch", help="JSONL file of questions to answer non-interactively")
+    parser.add_argument("--role", help="default role for batch lines without one")
+    parser.add_argument("--mode", default="generative", choices=ANSWER_MODES, help="default answer mode for batch lines")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--out", help="write result lines here instead of stdout")
+    parser.add_argument("--no-audit", action="store_true", help="do not append batch results to audit_log.jsonl")
+    args = parser.parse_args()
+
+    runtime = RagRuntime()
+    try:
+        if not args.batch:
+            run_interactive(runtime, PROJECT_ROOT)
+            return
+
+        items = load_batch(args.batch, args.role, args.mode)
+        out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+        try:
+            summary = run_batch(runtime, PROJECT_ROOT, items, workers=args.workers, out=out, audit=not args.no_audit)
+        finally:
+            if args.out:
+                out.close()
+        print(json.dumps(summary, indent=2), file=sys.stderr)
+    finally:
+        runtime.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+# app/policy.py
+# ============================================================
+# Compiled RBAC policy (rbac_rules.yaml + users.yaml).
+#
+# - Both files are validated and compiled together into one immutable
+#   Policy. Every user needs a password and a role that rbac_rules.yaml
+#   defines; every role needs a list of department names. A file with
+#   problems is rejected with all of them listed. Before this, a misspelled
+#   role silently got an empty department list.
+# - Each role's RolePlan is built once per policy version: the department
+#   tuple and the Chroma `where` filter that retrieval uses for it.
+# - PolicyManager polls both files and swaps in a newly compiled Policy
+#   with a single reference assignment. A reload that fails validation is
+#   logged and the previous policy stays active.
+# - Sessions remember the policy version they were resolved against. The
+#   API server re-resolves role and departments when the version changes,
+#   so permission changes apply without re-login.
+#
+#   python -m app.policy     # validate both files, print each role's plan
+# ============================================================
+
+import difflib
+import hmac
+import os
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import yaml
+
+from ingestion.ingest import DATA_ROOT, _dept_from_rel, scan_corpus
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RBAC_RULES_PATH = os.path.join(PROJECT_ROOT, "rbac_rules.yaml")
+USERS_PATH = os.path.join(PROJECT_ROOT, "users.yaml")
+POLICY_WATCH_SECONDS = 2.0
+NO_DEPARTMENT = "__none__"     # matches nothing: the filter for an empty department list
+
+
+class PolicyError(ValueError):
+    def __init__(self, problems: List[str]) -> None:
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+@lru_cache(maxsize=256)
+def _where(departments: Tuple[str, ...]) -> Dict[str, Any]:
+    return {"department": {"$in": list(departments)}} if departments else {"department": NO_DEPARTMENT}
+
+
+def department_where(departments: Iterable[str]) -> Dict[str, Any]:
+    """Chroma `where` filter for these departments. Built once per distinct list and shared: do not mutate."""
+    return _where(tuple(departments))
+
+
+class RolePlan:
+    """What one role may retrieve, precomputed when the policy is compiled."""
+
+    def __init__(self, role: str, departments: Tuple[str, ...]) -> None:
+        self.role = role
+        self.departments = departments
+        self.where = department_where(departments)
+
+
+class PolicyUser:
+    def __init__(self, username: str, password: str, role: str, admin: bool) -> None:
+        self.username = username
+        self.password = password
+        self.role = role
+        self.admin = admin
+
+
+class Policy:
+    def __init__(
+        self,
+        version: int,
+        roles: Dict[str, RolePlan],
+        users: Dict[str, PolicyUser],
+        default_deny: bool,
+        warnings: List[str],
+    ) -> None:
+        self.version = version
+        self.roles = roles
+        self.users = users
+        self.default_deny = default_deny
+        self.warnings = warnings
+        self.loaded_at = datetime.now(timezone.utc).isoformat()
+
+    def plan(self, role: Optional[str]) -> Optional[RolePlan]:
+        return self.roles.get(role) if role is not None else None
+
+    def departments(self, role: Optional[str]) -> List[str]:
+        plan = self.plan(role)
+        return list(plan.departments) if plan is not None else []
+
+    def authenticate(self, username: str, password: str) -> Optional[PolicyUser]:
+        user = self.users.get(username)
+        if user is None or not hmac.compare_digest(user.password.encode("utf-8"), password.encode("utf-8")):
+            return None
+        return user
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "default_deny": self.default_deny,
+            "roles": {role: list(plan.departments) for role, plan in sorted(self.roles.items())},
+            "users": len(self.users),
+            "warnings": self.warnings,
+        }
+
+
+# ---------------------------
+# Compilation
+# ---------------------------
+def known_departments(data_root: str = DATA_ROOT) -> Set[str]:
+    return {_dept_from_rel(rel) for rel in scan_corpus(data_root)}
+
+
+def compile_policy(
+    rules: Dict[str, Any],
+    users_cfg: Dict[str, Any],
+    version: int = 1,
+    departments: Optional[Set[str]] = None,
+) -> Policy:
+    """
+    Validate and compile the parsed YAML files. Raises PolicyError listing
+    every problem. `departments` (the corpus departments) only produces
+    warnings: a role may be granted a department before its documents exist.
+    """
+    problems: List[str] = []
+    warnings: List[str] = []
+
+    roles_cfg = rules.get("roles")
+    if not isinstance(roles_cfg, dict) or not roles_cfg:
+        problems.append("rbac_rules.yaml: `roles` must be a non-empty mapping")
+        roles_cfg = {}
+    default_deny = rules.get("default_deny", True)
+    if not isinstance(default_deny, bool):
+        problems.append("rbac_rules.yaml: `default_deny` must be true or false")
+
+    roles: Dict[str, RolePlan] = {}
+    for role, cfg in roles_cfg.items():
+        allowed = cfg.get("allow_departments") if isinstance(cfg, dict) else None
+        if not isinstance(allowed, list) or not all(isinstance(d, str) and d.strip() for d in allowed):
+            problems.append(f"rbac_rules.yaml: role {role!r} needs `allow_departments: [<department>, ...]`")
+            continue
+        depts = tuple(dict.fromkeys(d.strip() for d in allowed))
+        if departments:
+            for d in depts:
+                if d not in departments:
+                    warnings.append(f"role {role!r} allows department {d!r}, which has no documents under data/")
+        roles[str(role)] = RolePlan(str(role), depts)
+
+    users_map = users_cfg.get("users")
+    if not isinstance(users_map, dict):
+        problems.append("users.yaml: `users` must be a mapping of username -> {password, role}")
+        users_map = {}
+
+    users: Dict[str, PolicyUser] = {}
+    for username, cfg in users_map.items():
+        if not isinstance(cfg, dict):
+            problems.append(f"users.yaml: user {username!r} must be a mapping with `password` and `role`")
+            continue
+        password, role = cfg.get("password"), cfg.get("role")
+        if not isinstance(password, str) or not password:
+            problems.append(f"users.yaml: user {username!r} has no password")
+        if not isinstance(role, str) or not role:
+            problems.append(f"users.yaml: user {username!r} has no role")
+        elif role not in roles_cfg:
+            hint = difflib.get_close_matches(role, [str(r) for r in roles_cfg], n=1)
+            problems.append(
+                f"users.yaml: user {username!r} has role {role!r}, which rbac_rules.yaml does not define"
+                + (f" (did you mean {hint[0]!r}?)" if hint else "")
+            )
+        if not isinstance(cfg.get("admin", False), bool):
+            problems.append(f"users.yaml: user {username!r}: `admin` must be true or false")
+        users[str(username)] = PolicyUser(str(username), str(password), str(role), bool(cfg.get("admin", False)))
+
+    if problems:
+        raise PolicyError(problems)
+    return Policy(version, roles, users, default_deny, warnings)
+
+
+def load_policy(
+    rules_path: str = RBAC_RULES_PATH,
+    users_path: str = USERS_PATH,
+    version: int = 1,
+    data_root: Optional[str] = DATA_ROOT,
+) -> Policy:
+    parsed: List[Dict[str, Any]] = []
+    for path in (rules_path, users_path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                parsed.append(yaml.safe_load(f) or {})
+        except (OSError, yaml.YAMLError) as exc:
+            raise PolicyError([f"{os.path.basename(path)}: {exc}"]) from exc
+    departments = known_departments(data_root) if data_root and os.path.isdir(data_root) else None
+    return compile_policy(parsed[0], parsed[1], version, departments)
+
+
+# ---------------------------
+# Hot reload
+# ---------------------------
+class PolicyManager:
+    """
+    Holds the active Policy. `current` is replaced, never mutated, so a
+    request that reads it once sees one consistent version throughout.
+    """
+
+    def __init__(self, rules_path: str = RBAC_RULES_PATH, users_path: str = USERS_PATH, data_root: str = DATA_ROOT) -> None:
+        self.rules_path = rules_path
+        self.users_path = users_path
+        self.data_root = data_root
+        self._stamp = self._file_stamp()
+        # An invalid policy at startup is fatal: there is no previous version to keep serving.
+        self.current: Policy = load_policy(rules_path, users_path, 1, data_root)
+        for warning in self.current.warnings:
+            print(f"[policy] warning: {warning}")
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _file_stamp(self) -> Tuple[Any, ...]:
+        stamp = []
+        for path in (self.rules_path, self.users_path):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def refresh(self) -> bool:
+        """Reload if either file changed since the last attempt. Returns True when a new version went live."""
+        if self._file_stamp() == self._stamp:
+            return False
+        return self.reload()
+
+    def reload(self) -> bool:
+        with self._lock:
+            self._stamp = self._file_stamp()
+            try:
+                policy = load_policy(self.rules_path, self.users_path, self.current.version + 1, self.data_root)
+            except PolicyError as exc:
+                self.last_error = str(exc)
+                print(f"[policy] reload rejected, keeping v{self.current.version}:")
+                for problem in exc.problems:
+                    print(f"  {problem}")
+                return False
+            for warning in policy.warnings:
+                print(f"[policy] warning: {warning}")
+            self.current = policy
+            self.last_error = None
+            print(f"[policy] v{policy.version} active: {len(policy.roles)} roles, {len(policy.users)} users")
+            return True
+
+    def _watch(self, interval_s: float) -> None:
+        while not self._stop.wait(interval_s):
+            try:
+                self.refresh()
+            except Exception as exc:
+                self.last_error = str(exc)
+                print(f"[policy] refresh failed: {exc}")
+
+    def start_watcher(self, interval_s: float = POLICY_WATCH_SECONDS) -> None:
+        if interval_s <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(interval_s,), name="policy-watcher", daemon=True)
+        self._thread.start()
+
+    def stop_watcher(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def info(self) -> Dict[str, Any]:
+        return {**self.current.info(), "last_error": self.last_error}
+
+
+def main() -> None:
+    try:
+        policy = load_policy()
+    except PolicyError as exc:
+        print("policy INVALID:")
+        for problem in exc.problems:
+            print(f"  {problem}")
+        raise SystemExit(1)
+    for warning in policy.warnings:
+        print(f"warning: {warning}")
+    for role, depts in policy.info()["roles"].items():
+        print(f"  {role:12} {', '.join(depts) or '(none)'}")
+    print(f"policy OK: {len(policy.roles)} roles, {len(policy.users)} users")
+
+
+if __name__ == "__main__":
+    main()
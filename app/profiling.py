@@ -0,0 +1,178 @@
+# app/profiling.py
+# ============================================================
+# Opt-in per-request sampling profiler.
+#
+# - A side thread snapshots the Python stacks of every thread working for
+#   the request every few ms (sys._current_frames) and counts identical
+#   stacks. Besides the request thread that is any thread that runs work
+#   wrapped with carry() (LLM and shard pools) or that encodes a batch
+#   holding the request's query (EmbeddingBatcher). Each stack starts with
+#   the name of the thread it was sampled on.
+# - Output is collapsed-stack text ("a;b;c 42" per line), readable by
+#   flamegraph.pl and https://speedscope.app, written to
+#   profiles/<session_id>/<request_id>.collapsed and listed in
+#   profiles/index.jsonl.
+# - Time inside C extensions (torch, sqlite, tokenizers) is charged to the
+#   Python frame that called into them. Work in other processes (shard
+#   workers, the embedding server) shows up as the socket wait for it.
+# - When a request is not profiled nothing is started, so the only cost is
+#   the enable check.
+# ============================================================
+
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+PROFILES_DIR = os.path.join(PROJECT_ROOT, "profiles")
+
+PROFILE_INTERVAL_MS = 5.0
+PROFILE_SAMPLE_RATE = 0.0      # fraction of /api/chat requests profiled without being asked
+
+_SAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+_index_lock = threading.Lock()
+# The sampler of the request being handled in this context, if it is profiled.
+_active: ContextVar[Optional["StackSampler"]] = ContextVar("profile_sampler", default=None)
+
+T = TypeVar("T")
+
+
+def _safe(name: str) -> str:
+    return _SAFE_NAME.sub("_", name).lstrip(".") or "_"
+
+
+def should_sample(rate: float) -> bool:
+    return rate > 0 and random.random() < rate
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval_s: float) -> None:
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        # thread id -> [label, nesting depth]
+        self._threads: Dict[int, List[Any]] = {thread_id: ["request", 1]}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    @contextmanager
+    def attached(self) -> Iterator[None]:
+        """Sample the calling thread too for the duration of the block."""
+        tid = threading.get_ident()
+        with self._lock:
+            entry = self._threads.setdefault(tid, [threading.current_thread().name, 0])
+            entry[1] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._threads[tid]
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = [(tid, entry[0]) for tid, entry in self._threads.items()]
+            for tid, label in threads:
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(label)
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+
+def current_sampler() -> Optional[StackSampler]:
+    return _active.get()
+
+
+def carry(fn: Callable[..., T]) -> Callable[..., T]:
+    """Wrap `fn` so the pool thread that runs it is sampled with the submitting request, if that is profiled."""
+    sampler = _active.get()
+    if sampler is None:
+        return fn
+
+    def run(*args: Any, **kwargs: Any) -> T:
+        with sampler.attached():
+            return fn(*args, **kwargs)
+
+    return run
+
+
+@contextmanager
+def profile_request(
+    session_id: str,
+    request_id: str,
+    enabled: bool,
+    interval_ms: float = PROFILE_INTERVAL_MS,
+    profiles_dir: str = PROFILES_DIR,
+) -> Iterator[Optional[Dict[str, Any]]]:
+    """
+    Profile the calling thread, and the threads working for it, for the
+    duration of the block when enabled. Yields a dict that receives "path"
+    and "samples" on exit (None when disabled).
+    """
+    if not enabled:
+        yield None
+        return
+
+    info: Dict[str, Any] = {}
+    sampler = StackSampler(threading.get_ident(), interval_ms / 1000.0)
+    started = time.perf_counter()
+    token = _active.set(sampler)
+    sampler.start()
+    try:
+        yield info
+    finally:
+        sampler.stop()
+        _active.reset(token)
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        out_dir = os.path.join(profiles_dir, _safe(session_id))
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, f"{_safe(request_id)}.collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(sampler.collapsed())
+
+        info.update(path=os.path.relpath(path, profiles_dir), samples=sampler.samples, duration_ms=duration_ms)
+        entry = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "session_id": session_id,
+            "request_id": request_id,
+            "interval_ms": interval_ms,
+            **info,
+        }
+        with _index_lock:
+            with open(os.path.join(profiles_dir, "index.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,287 @@
+# app/scheduler.py
+# ============================================================
+# Fair-share scheduling of LLM generation slots.
+#
+# - At most `slots` generations run at once. Requests that find no free
+#   slot wait in per-user queues grouped by role.
+# - Roles are served by deficit round-robin: each visit adds the role's
+#   weight to its deficit and every grant costs 1, so with security=4 and
+#   hr=1 security gets four slots for each one hr gets while both wait.
+#   Within a role, users take turns, so one user's burst cannot starve
+#   colleagues in the same role.
+# - Per-user token buckets (requests per minute + burst) and a cap on each
+#   user's requests in progress reject excess requests up front with
+#   RateLimited (-> HTTP 429 with Retry-After). Admission happens before a
+#   request can join another user's coalesced run, so every user is judged
+#   only on their own requests.
+# - A waiter that is not granted a slot within queue_timeout_s gets
+#   QueueTimeout, a GenerationError, so RagRuntime degrades to an
+#   extractive answer exactly as for an LLM timeout.
+#
+# Configured by scheduler.yaml; requests without a user (CLI, warm-up) are
+# not rate limited and are scheduled under SYSTEM_ROLE.
+# ============================================================
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Optional
+
+from app.generation import GenerationError, LatencyTracker
+
+LLM_SLOTS = 8
+QUEUE_TIMEOUT_SECONDS = 20.0
+MAX_QUEUED_PER_USER = 4
+DEFAULT_WEIGHT = 1.0
+RATE_PER_MINUTE = 20.0
+RATE_BURST = 5.0
+SYSTEM_ROLE = "_system"
+
+
+class RateLimited(RuntimeError):
+    def __init__(self, message: str, retry_after_s: float) -> None:
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class QueueTimeout(GenerationError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate_per_s: float, burst: float) -> None:
+        self.rate = rate_per_s
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take one token. Returns 0 on success, otherwise seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+
+class _Waiter:
+    __slots__ = ("user", "role", "event", "granted", "queued_at")
+
+    def __init__(self, user: str, role: str) -> None:
+        self.user = user
+        self.role = role
+        self.event = threading.Event()
+        self.granted = False
+        self.queued_at = time.monotonic()
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        slots: int = LLM_SLOTS,
+        role_weights: Optional[Dict[str, float]] = None,
+        default_weight: float = DEFAULT_WEIGHT,
+        queue_timeout_s: float = QUEUE_TIMEOUT_SECONDS,
+        max_queued_per_user: int = MAX_QUEUED_PER_USER,
+        rate_per_minute: float = RATE_PER_MINUTE,
+        burst: float = RATE_BURST,
+        user_limits: Optional[Dict[str, Dict[str, float]]] = None,
+    ) -> None:
+        self.slots = max(1, slots)
+        self.role_weights = dict(role_weights or {})
+        self.default_weight = default_weight
+        self.queue_timeout_s = queue_timeout_s
+        self.max_queued_per_user = max_queued_per_user
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.user_limits = dict(user_limits or {})
+
+        self._lock = threading.Lock()
+        self._free = self.slots
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._outstanding: Dict[str, int] = {}
+        self._user_queues: Dict[str, Deque[_Waiter]] = {}
+        self._role_users: Dict[str, Deque[str]] = {}
+        self._active_roles: Deque[str] = deque()
+        self._deficit: Dict[str, float] = {}
+
+        self.queue_wait = LatencyTracker()
+        self.counters = {"admitted": 0, "rate_limited": 0, "granted": 0, "queued": 0, "timeouts": 0, "queue_full": 0}
+        self._granted_by_role: Dict[str, int] = {}
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "FairScheduler":
+        rate = cfg.get("rate_limit") or {}
+        return cls(
+            slots=int(cfg.get("slots", LLM_SLOTS)),
+            role_weights={k: float(v) for k, v in (cfg.get("role_weights") or {}).items()},
+            default_weight=float(cfg.get("default_weight", DEFAULT_WEIGHT)),
+            queue_timeout_s=float(cfg.get("queue_timeout_seconds", QUEUE_TIMEOUT_SECONDS)),
+            max_queued_per_user=int(cfg.get("max_queued_per_user", MAX_QUEUED_PER_USER)),
+            rate_per_minute=float(rate.get("per_minute", RATE_PER_MINUTE)),
+            burst=float(rate.get("burst", RATE_BURST)),
+            user_limits=cfg.get("user_rate_limits") or {},
+        )
+
+    def weight(self, role: str) -> float:
+        return max(1e-3, float(self.role_weights.get(role, self.default_weight)))
+
+    # ---------------------------
+    # Admission (per user, before any work is shared with other requests)
+    # ---------------------------
+    @contextmanager
+    def admission(self, user: Optional[str]) -> Iterator[None]:
+        """
+        Admit one request from `user` for the duration of the block: charge its
+        token bucket and cap its requests in progress at max_queued_per_user.
+        Raises RateLimited otherwise. Requests without a user are not limited.
+        """
+        if user is None:
+            yield
+            return
+        with self._lock:
+            if self._outstanding.get(user, 0) >= self.max_queued_per_user:
+                self.counters["queue_full"] += 1
+                raise RateLimited("too many requests in progress", self.queue_timeout_s)
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                limits = self.user_limits.get(user) or {}
+                per_minute = float(limits.get("per_minute", self.rate_per_minute))
+                bucket = self._buckets[user] = TokenBucket(per_minute / 60.0, float(limits.get("burst", self.burst)))
+            retry_after = bucket.take()
+            if retry_after > 0:
+                self.counters["rate_limited"] += 1
+                raise RateLimited("rate limit exceeded", retry_after)
+            self.counters["admitted"] += 1
+            self._outstanding[user] = self._outstanding.get(user, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                left = self._outstanding[user] - 1
+                if left:
+                    self._outstanding[user] = left
+                else:
+                    del self._outstanding[user]
+
+    # ---------------------------
+    # Slots
+    # ---------------------------
+    @contextmanager
+    def slot(self, user: Optional[str], role: Optional[str]) -> Iterator[float]:
+        """Hold one generation slot for the block. Yields the seconds spent queued."""
+        waited = self._acquire(user or SYSTEM_ROLE, role or SYSTEM_ROLE)
+        try:
+            yield waited
+        finally:
+            self._release()
+
+    def _acquire(self, user: str, role: str) -> float:
+        with self._lock:
+            if self._free > 0 and not self._active_roles:
+                self._free -= 1
+                self._grant_count(role)
+                self.queue_wait.add(0.0)
+                return 0.0
+
+            queue = self._user_queues.setdefault(user, deque())
+            waiter = _Waiter(user, role)
+            queue.append(waiter)
+            users = self._role_users.setdefault(role, deque())
+            if user not in users:
+                users.append(user)
+            if role not in self._active_roles:
+                self._active_roles.append(role)
+                self._deficit.setdefault(role, 0.0)
+            self.counters["queued"] += 1
+
+        waiter.event.wait(self.queue_timeout_s)
+        with self._lock:
+            waited = time.monotonic() - waiter.queued_at
+            if not waiter.granted:
+                self._remove(waiter)
+                self.counters["timeouts"] += 1
+                raise QueueTimeout(f"no generation slot within {self.queue_timeout_s:g}s")
+        self.queue_wait.add(waited)
+        return waited
+
+    def _release(self) -> None:
+        with self._lock:
+            waiter = self._next() if self._active_roles else None
+            if waiter is None:
+                self._free += 1
+                return
+            # Hand the slot straight to the next waiter.
+            waiter.granted = True
+            self._grant_count(waiter.role)
+            waiter.event.set()
+
+    def _next(self) -> Optional[_Waiter]:
+        """Deficit round-robin over roles, round-robin over users within the role. Caller holds the lock."""
+        while self._active_roles:
+            role = self._active_roles[0]
+            if self._deficit[role] < 1.0:
+                self._deficit[role] += self.weight(role)
+                if self._deficit[role] < 1.0:
+                    self._active_roles.rotate(-1)
+                    continue
+
+            users = self._role_users[role]
+            user = users[0]
+            queue = self._user_queues[user]
+            waiter = queue.popleft()
+            users.rotate(-1)
+            if not queue:
+                users.remove(user)
+                del self._user_queues[user]
+            self._deficit[role] -= 1.0
+
+            if not users:
+                self._active_roles.popleft()
+                del self._role_users[role]
+                self._deficit[role] = 0.0
+            elif self._deficit[role] < 1.0:
+                self._active_roles.rotate(-1)
+            return waiter
+        return None
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._user_queues.get(waiter.user)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if queue:
+            return
+        del self._user_queues[waiter.user]
+        users = self._role_users[waiter.role]
+        users.remove(waiter.user)
+        if not users:
+            del self._role_users[waiter.role]
+            self._active_roles.remove(waiter.role)
+            self._deficit[waiter.role] = 0.0
+
+    def _grant_count(self, role: str) -> None:
+        self.counters["granted"] += 1
+        self._granted_by_role[role] = self._granted_by_role.get(role, 0) + 1
+
+    # ---------------------------
+    # Metrics
+    # ---------------------------
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            queued: Dict[str, int] = {
+                role: sum(len(self._user_queues[u]) for u in users) for role, users in self._role_users.items()
+            }
+            return {
+                **self.counters,
+                "slots": self.slots,
+                "in_use": self.slots - self._free,
+                "queued_by_role": queued,
+                "granted_by_role": dict(self._granted_by_role),
+                "role_weights": {**self.role_weights, "*": self.default_weight},
+                "queue_wait": self.queue_wait.summary(),
+            }
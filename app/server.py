@@ -6,23 +6,44 @@
 #   POST /api/chat     -> ask a question within a session
 #   POST /api/logout   -> destroy a session
 #   GET  /api/me        -> session info (for page refresh)
+#   GET  /api/index     -> active index generation (hot reload status, ANN/shard state)
+#   GET  /api/policy    -> active RBAC policy version, role -> departments, last reload error
+#   GET  /api/cache     -> cache stats + last warm-up report
+#   GET  /api/metrics   -> LLM latency percentiles, hedging, circuit breaker, coalescing,
+#                          query-embedding batch sizes and queue wait, LLM slot scheduling
 #
-# Sessions are kept in-memory (fine for a single-process demo).
+# /api/chat answers 429 (with Retry-After) when the user exceeds their rate
+# limit or already has too many questions queued for an LLM slot (scheduler.yaml).
+#
+# Profiling: admins (users.yaml `admin: true`) can send `X-Profile: 1` or
+# `?profile=1` on /api/chat to record a sampling profile of that request;
+# PROFILE_SAMPLE_RATE profiles a random fraction of all requests.
+#
+# Sessions are kept in-memory (fine for a single-process demo). rbac_rules.yaml
+# and users.yaml are hot-reloaded (app/policy.py); each request re-resolves
+# its session's role and departments when the policy version has changed.
 # ============================================================
 
 import json
+import math
 import os
+import threading
 import uuid
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from app.core import PROJECT_ROOT, RagRuntime, allowed_departments_for_role, trim_history
+from app.core import ANSWER_MODES, PROJECT_ROOT, RagRuntime
+from app.history import HISTORY_TOKEN_BUDGET, history_tokens
+from app.policy import POLICY_WATCH_SECONDS
+from app.profiling import PROFILE_SAMPLE_RATE, profile_request, should_sample
+from app.scheduler import RateLimited
+from app.warmup import WARMUP_TOP_N, start_background_warmup
 
-AUDIT_LOG_PATH = os.path.join(PROJECT_ROOT, "audit_log.jsonl")
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH") or os.path.join(PROJECT_ROOT, "audit_log.jsonl")
 
 app = FastAPI(title="RT Healthcare RAG API")
 
@@ -36,12 +57,35 @@ app.add_middleware(
 
 runtime: Optional[RagRuntime] = None
 sessions: Dict[str, Dict[str, Any]] = {}
+profile_sample_rate = PROFILE_SAMPLE_RATE
 
 
 @app.on_event("startup")
 def _startup() -> None:
-    global runtime
+    global runtime, profile_sample_rate
     runtime = RagRuntime()
+    profile_sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", PROFILE_SAMPLE_RATE))
+    runtime.index.start_watcher(runtime.index_watch_seconds)
+    runtime.policy.start_watcher(float(os.environ.get("POLICY_WATCH_SECONDS", POLICY_WATCH_SECONDS)))
+
+    # The embedder/LLM client load on first use; by default start loading them now, off the startup path.
+    if os.environ.get("PRELOAD", "1").strip() != "0":
+        threading.Thread(target=runtime.preload, name="preload", daemon=True).start()
+
+    # Warm the answer caches from audit-log traffic now and after every index swap.
+    top_n = int(os.environ.get("WARMUP_TOP_N", WARMUP_TOP_N))
+    if top_n > 0:
+        def warm(_version: Optional[int] = None) -> None:
+            start_background_warmup(runtime, top_n=top_n, audit_path=AUDIT_LOG_PATH)
+
+        runtime.index.on_swap.append(warm)
+        warm()
+
+
+@app.on_event("shutdown")
+def _shutdown() -> None:
+    if runtime is not None:
+        runtime.close()
 
 
 def utc_now_iso() -> str:
@@ -54,9 +98,25 @@ def append_audit(record: Dict[str, Any]) -> None:
 
 
 def get_session(session_id: str) -> Dict[str, Any]:
+    assert runtime is not None
     session = sessions.get(session_id)
     if not session:
         raise HTTPException(status_code=401, detail="Invalid or expired session.")
+
+    # The policy was reloaded since this session last looked: pick up the user's current role and departments.
+    policy = runtime.policy.current
+    if session.get("policy_version") != policy.version:
+        user = policy.users.get(session["username"])
+        if user is None:
+            sessions.pop(session_id, None)
+            raise HTTPException(status_code=401, detail="User no longer exists.")
+        session.update(
+            role=user.role,
+            allowed_departments=policy.departments(user.role),
+            plan=policy.plan(user.role),
+            is_admin=user.admin,
+            policy_version=policy.version,
+        )
     return session
 
 
@@ -75,6 +135,8 @@ class LoginResponse(BaseModel):
 class ChatRequest(BaseModel):
     session_id: str
     question: str
+    # "generative" (LLM) or "extractive" (top retrieved sentences, no LLM call)
+    mode: str = "generative"
 
 
 class Citation(BaseModel):
@@ -92,25 +154,32 @@ class ChatResponse(BaseModel):
 @app.post("/api/login", response_model=LoginResponse)
 def login(req: LoginRequest) -> LoginResponse:
     assert runtime is not None
-    user = runtime.users.get(req.username)
-    if not user or user.get("password") != req.password:
+    policy = runtime.policy.current
+    user = policy.authenticate(req.username, req.password)
+    if user is None:
         raise HTTPException(status_code=401, detail="Invalid username or password.")
 
-    role = user.get("role")
-    allowed_depts = allowed_departments_for_role(runtime.rules, role)
+    allowed_depts = policy.departments(user.role)
 
     session_id = str(uuid.uuid4())
     sessions[session_id] = {
         "username": req.username,
-        "role": role,
+        "role": user.role,
         "allowed_departments": allowed_depts,
+        # The role's compiled retrieval filter; replaced together with allowed_departments on reload.
+        "plan": policy.plan(user.role),
+        "is_admin": user.admin,
+        "policy_version": policy.version,
+        # Held for each chat turn and for the background history compaction that follows it.
+        "lock": threading.Lock(),
         "history": [],
+        "summary": "",
     }
 
     return LoginResponse(
         session_id=session_id,
         username=req.username,
-        role=role,
+        role=user.role,
         allowed_departments=allowed_depts,
     )
 
@@ -129,42 +198,160 @@ def me(session_id: str) -> Dict[str, Any]:
         "role": session["role"],
         "allowed_departments": session["allowed_departments"],
         "history": session["history"],
+        "summary": session.get("summary", ""),
+    }
+
+
+@app.get("/api/index")
+def index_info() -> Dict[str, Any]:
+    assert runtime is not None
+    info = runtime.index.info()
+    if runtime.ann is not None:
+        info["ann"] = runtime.ann.info()
+    if runtime.shards is not None:
+        info["shards"] = runtime.shards.info()
+    return info
+
+
+@app.get("/api/policy")
+def policy_info() -> Dict[str, Any]:
+    assert runtime is not None
+    return runtime.policy.info()
+
+
+@app.get("/api/cache")
+def cache_info() -> Dict[str, Any]:
+    assert runtime is not None
+    return {
+        "embeddings": runtime.embedding_cache.stats(),
+        "parents": runtime.parent_cache.stats(),
+        "answers": runtime.answer_cache.stats(),
+        "last_warmup": runtime.warmup_report,
+    }
+
+
+@app.get("/api/metrics")
+def metrics() -> Dict[str, Any]:
+    assert runtime is not None
+    return {
+        "generation": runtime.generator.metrics(),
+        "coalescing": runtime.in_flight.stats(),
+        "embedding": runtime.batcher.metrics() if runtime.batcher is not None else None,
+        "scheduler": runtime.scheduler.metrics(),
     }
 
 
 @app.post("/api/chat", response_model=ChatResponse)
-def chat(req: ChatRequest) -> ChatResponse:
+def chat(
+    req: ChatRequest,
+    response: Response,
+    profile: bool = False,
+    x_profile: Optional[str] = Header(default=None),
+) -> Union[ChatResponse, Response]:
     assert runtime is not None
     session = get_session(req.session_id)
 
     question = req.question.strip()
     if not question:
         raise HTTPException(status_code=400, detail="Question must not be empty.")
+    if req.mode not in ANSWER_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {list(ANSWER_MODES)}.")
+
+    request_id = str(uuid.uuid4())
+    response.headers["X-Request-Id"] = request_id
+
+    asked = profile or x_profile == "1"
+    if asked and not session.get("is_admin"):
+        raise HTTPException(status_code=403, detail="Profiling is restricted to admins.")
+
+    with profile_request(req.session_id, request_id, asked or should_sample(profile_sample_rate)) as prof:
+        with session["lock"]:
+            result = _chat(req, session, question, request_id)
+        if prof is None:
+            return result
+        # Serialize inside the profiled block so response encoding is part of the profile.
+        rendered = Response(
+            content=result.model_dump_json(), media_type="application/json", headers={"X-Request-Id": request_id}
+        )
 
+    rendered.headers["X-Profile-Path"] = prof["path"]
+    return rendered
+
+
+def _compact_history(session: Dict[str, Any]) -> None:
+    """
+    Bound the session history after the answer. A fold that needs an LLM
+    summary runs in the background, so the user never waits for it; the
+    session lock makes the next turn wait until it is done.
+    """
+    assert runtime is not None
+    if runtime.history_mode != "compact" or history_tokens(session["history"]) <= HISTORY_TOKEN_BUDGET:
+        runtime.update_history(session)
+        return
+
+    def run() -> None:
+        with session["lock"]:
+            runtime.update_history(session)
+
+    threading.Thread(target=run, name="compact-history", daemon=True).start()
+
+
+def _chat(req: ChatRequest, session: Dict[str, Any], question: str, request_id: str) -> ChatResponse:
+    assert runtime is not None
     session["history"].append({"role": "user", "text": question})
-    session["history"] = trim_history(session["history"])
 
-    try:
-        answer, citations = runtime.answer(
-            question=question,
-            allowed_depts=session["allowed_departments"],
-            history=session["history"][:-1],
-        )
-    except Exception as exc:
-        session["history"].pop()
-        raise HTTPException(status_code=502, detail=f"LLM generation failed: {exc}") from exc
+    trace: Dict[str, Any] = {}
+
+    # Fast path: greetings, help, RBAC and RACI questions never reach retrieval.
+    hit = runtime.intents.route(question, session)
+    if hit is not None:
+        answer, citations, mode, intent = hit.answer, hit.citations, hit.mode, hit.name
+    else:
+        intent = None
+        try:
+            # LLM outages and deadline overruns degrade to an extractive answer inside answer().
+            answer, citations = runtime.answer(
+                question=question,
+                allowed_depts=session["allowed_departments"],
+                history=session["history"][:-1],
+                summary=session.get("summary", ""),
+                mode=req.mode,
+                trace=trace,
+                user=session["username"],
+                role=session["role"],
+                plan=session["plan"],
+            )
+            mode = trace["mode"]
+        except RateLimited as exc:
+            session["history"].pop()
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests, please retry later.",
+                headers={"Retry-After": str(math.ceil(exc.retry_after_s))},
+            ) from exc
+        except Exception as exc:
+            session["history"].pop()
+            raise HTTPException(status_code=502, detail=f"LLM generation failed: {exc}") from exc
 
     session["history"].append({"role": "assistant", "text": answer})
-    session["history"] = trim_history(session["history"])
+    _compact_history(session)
 
     append_audit(
         {
             "ts": utc_now_iso(),
             "session_id": req.session_id,
+            "request_id": request_id,
             "username": session["username"],
             "role": session["role"],
             "allowed_departments": session["allowed_departments"],
+            "policy_version": session.get("policy_version"),
             "question": question,
+            "mode": mode,
+            "intent": intent,
+            "index_version": trace.get("index_version"),
+            "llm_error": trace.get("llm_error"),
+            "coalesced": trace.get("coalesced", False),
+            "queue_wait_ms": trace.get("queue_wait_ms"),
             "retrieved": citations,
             "answer": answer,
         }
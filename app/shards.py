@@ -0,0 +1,526 @@
+# app/shards.py
+# ============================================================
+# Sharded retrieval tier (RETRIEVAL_BACKEND=sharded).
+#
+# - The child collection of a generation is split across SHARD_COUNT
+#   worker processes, by hash of parent_id (default) or by department.
+#   Each worker holds its shard in memory and answers exact top-k search
+#   for a query *embedding*; workers never load the embedder.
+# - The coordinator (ShardCoordinator, owned by RagRuntime) sends the
+#   query embedding to the shards that can hold allowed departments,
+#   gathers per-shard top-k under a deadline and merges them. Shards that
+#   miss the deadline are left out of that answer and counted in metrics;
+#   their calls are aborted (socket shut down) so no pool thread waits on them.
+# - Every search names the generation its request leased. Workers keep the
+#   previous generation next to a newly loaded one and answer only for the
+#   generation asked for, so one result never mixes two generations.
+# - Transport is a Unix socket per worker with length-prefixed JSON, so
+#   the same protocol can later run over TCP between hosts.
+#
+#   python -m app.shards --shard 0 --of 4 --socket /tmp/s0.sock
+#
+# Workers read the persistent Chroma store directly; the in-memory
+# (Streamlit Cloud) client cannot be shared and is not supported.
+# ============================================================
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.profiling import carry
+
+SHARD_COUNT = 2
+SHARD_STRATEGY = "hash"            # "hash" (of parent_id) or "department"
+SHARD_DEADLINE_MS = 250.0
+SHARD_PAGE_SIZE = 1000
+SHARD_CONNECT_TIMEOUT_S = 30.0     # worker start-up
+SHARD_LOAD_TIMEOUT_S = 600.0
+SHARD_MAX_CONCURRENCY = 32         # concurrent searches the coordinator's pool is sized for
+
+_HEADER = struct.Struct("!I")
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+# ---------------------------
+# Wire protocol: 4-byte length + JSON
+# ---------------------------
+def send_msg(sock: socket.socket, obj: Dict[str, Any]) -> None:
+    data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_msg(sock: socket.socket) -> Dict[str, Any]:
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, size).decode("utf-8"))
+
+
+def shard_of(child_id: str, metadata: Dict[str, Any], n_shards: int, strategy: str = SHARD_STRATEGY) -> int:
+    if strategy == "department":
+        key = (metadata or {}).get("department") or ""
+    else:
+        # Children of one parent stay together, so per-parent aggregation works shard-locally.
+        key = (metadata or {}).get("parent_id") or child_id
+    return zlib.crc32(key.encode("utf-8")) % n_shards
+
+
+# ---------------------------
+# Worker side
+# ---------------------------
+class ShardStore:
+    """
+    This shard's children (ids, documents, metadatas and a float32 matrix)
+    for the newest generation and any the coordinator asked to keep.
+    """
+
+    def __init__(self, shard: int, n_shards: int, strategy: str) -> None:
+        self.shard = shard
+        self.n_shards = n_shards
+        self.strategy = strategy
+        self.version: Optional[int] = None
+        self._gens: Dict[int, Tuple[Any, ...]] = {}
+        self._lock = threading.Lock()
+
+    def load_rows(self, version: int, pages, keep: Iterable[int] = ()) -> int:
+        """
+        Keep the rows of `pages` ((ids, embeddings, documents, metadatas)
+        batches) that belong to this shard. Generations other than `version`
+        and `keep` are released.
+        """
+        import numpy as np
+
+        ids: List[str] = []
+        docs: List[str] = []
+        metas: List[Dict[str, Any]] = []
+        vecs: List[Any] = []
+        for p_ids, p_embs, p_docs, p_metas in pages:
+            for i, cid in enumerate(p_ids):
+                meta = p_metas[i] or {}
+                if shard_of(cid, meta, self.n_shards, self.strategy) != self.shard:
+                    continue
+                ids.append(cid)
+                docs.append(p_docs[i])
+                metas.append(meta)
+                vecs.append(p_embs[i])
+
+        matrix = np.asarray(vecs, dtype=np.float32).reshape(len(vecs), -1)
+        dept_names = sorted({m.get("department", "") for m in metas})
+        dept_index = {d: i for i, d in enumerate(dept_names)}
+        dept_codes = np.array([dept_index[m.get("department", "")] for m in metas], dtype=np.int32)
+
+        # Swap in one assignment; searches in flight keep the tuple they started with.
+        with self._lock:
+            gens = {v: self._gens[v] for v in keep if v in self._gens}
+            gens[version] = (ids, docs, metas, matrix, dept_index, dept_codes)
+            self._gens = gens
+            self.version = max(gens)
+        return len(ids)
+
+    def load_generation(self, version: int, keep: Iterable[int] = ()) -> int:
+        from ingestion.ingest import _persistent_client, collection_names
+
+        col = _persistent_client().get_collection(collection_names(version)[1])
+
+        def pages():
+            offset = 0
+            while True:
+                got = col.get(limit=SHARD_PAGE_SIZE, offset=offset, include=["embeddings", "documents", "metadatas"])
+                ids = got.get("ids") or []
+                if not ids:
+                    return
+                yield ids, got["embeddings"], got["documents"], got["metadatas"]
+                offset += len(ids)
+
+        return self.load_rows(version, pages(), keep)
+
+    def search(
+        self, q_emb: List[float], allowed_depts: List[str], k: int, with_documents: bool = True, version: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        import numpy as np
+
+        version = self.version if version is None else version
+        data = self._gens.get(version) if version is not None else None
+        if data is None:
+            if version is None:
+                return []
+            raise ShardError(f"generation {version} is not loaded on shard {self.shard}")
+        ids, docs, metas, matrix, dept_index, dept_codes = data
+        codes = [dept_index[d] for d in allowed_depts if d in dept_index]
+        if not codes or not len(ids):
+            return []
+
+        scores = matrix @ np.asarray(q_emb, dtype=np.float32)
+        scores[~np.isin(dept_codes, codes)] = -np.inf
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {"id": ids[i], "score": float(scores[i]), "document": docs[i] if with_documents else None, "metadata": metas[i]}
+            for i in top
+            if np.isfinite(scores[i])
+        ]
+
+    def info(self) -> Dict[str, Any]:
+        gens = self._gens
+        return {"shard": self.shard, "version": self.version, "rows": {v: len(d[0]) for v, d in sorted(gens.items())}}
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        store: ShardStore = self.server.store  # type: ignore[attr-defined]
+        while True:
+            try:
+                msg = recv_msg(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                op = msg.get("op")
+                if op == "search":
+                    version = msg.get("version")
+                    hits = store.search(msg["q"], msg["depts"], int(msg["k"]), msg.get("docs", True), version)
+                    reply = {"version": version if version is not None else store.version, "hits": hits}
+                elif op == "load":
+                    version = int(msg["version"])
+                    reply = {"version": version, "rows": store.load_generation(version, msg.get("keep") or ())}
+                elif op == "info":
+                    reply = store.info()
+                else:
+                    reply = {"error": f"unknown op {op!r}"}
+            except Exception as exc:
+                reply = {"error": f"{type(exc).__name__}: {exc}"}
+            try:
+                send_msg(self.request, reply)
+            except OSError:
+                return   # the coordinator gave up on this call (deadline) and closed the socket
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_worker(shard: int, n_shards: int, socket_path: str, strategy: str) -> None:
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = _Server(socket_path, _Handler)
+    server.store = ShardStore(shard, n_shards, strategy)  # type: ignore[attr-defined]
+
+    # Exit with the coordinator instead of lingering as an orphan.
+    parent = os.getppid()
+
+    def _watch_parent() -> None:
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        server.shutdown()
+
+    threading.Thread(target=_watch_parent, name="parent-watch", daemon=True).start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# ---------------------------
+# Coordinator side
+# ---------------------------
+class _Call:
+    """One in-flight shard call. abort() shuts its socket down, so a call past its deadline returns at once."""
+
+    def __init__(self) -> None:
+        self.sock: Optional[socket.socket] = None
+        self.aborted = False
+        self._lock = threading.Lock()
+
+    def attach(self, sock: socket.socket) -> bool:
+        with self._lock:
+            self.sock = sock
+            return not self.aborted
+
+    def abort(self) -> None:
+        with self._lock:
+            self.aborted = True
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class ShardClient:
+    """Connection pool to one worker."""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self._idle: List[socket.socket] = []
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout_s: Optional[float]) -> socket.socket:
+        with self._lock:
+            if self._idle:
+                sock = self._idle.pop()
+                sock.settimeout(timeout_s)
+                return sock
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout_s)
+        sock.connect(self.address)
+        return sock
+
+    def call(self, msg: Dict[str, Any], timeout_s: Optional[float] = None, handle: Optional[_Call] = None) -> Dict[str, Any]:
+        sock = self._connect(timeout_s)
+        try:
+            if handle is not None and not handle.attach(sock):
+                raise ShardError("call aborted")
+            send_msg(sock, msg)
+            reply = recv_msg(sock)
+        except BaseException:
+            sock.close()   # a late reply would desync the stream
+            raise
+        with self._lock:
+            self._idle.append(sock)
+        if "error" in reply:
+            raise ShardError(reply["error"])
+        return reply
+
+    def close(self) -> None:
+        with self._lock:
+            for sock in self._idle:
+                sock.close()
+            self._idle.clear()
+
+
+class ShardCoordinator:
+    def __init__(
+        self,
+        n_shards: int = SHARD_COUNT,
+        strategy: str = SHARD_STRATEGY,
+        deadline_ms: float = SHARD_DEADLINE_MS,
+        socket_dir: Optional[str] = None,
+    ) -> None:
+        if strategy not in ("hash", "department"):
+            raise ValueError(f"SHARD_STRATEGY must be 'hash' or 'department', got {strategy!r}")
+        self.n_shards = max(1, n_shards)
+        self.strategy = strategy
+        self.deadline_s = deadline_ms / 1000.0
+        self.socket_dir = socket_dir or tempfile.mkdtemp(prefix="rt-shards-")
+        self.clients = [ShardClient(os.path.join(self.socket_dir, f"shard-{i}.sock")) for i in range(self.n_shards)]
+        self._procs: List[subprocess.Popen] = []
+        # One thread per shard call of every concurrent search; aborted calls give theirs back immediately.
+        concurrency = int(os.environ.get("SHARD_MAX_CONCURRENCY", SHARD_MAX_CONCURRENCY))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency) * self.n_shards, thread_name_prefix="shard")
+        # Generations every worker holds; the newest plus the one before it while leases may still read it.
+        self._ready: Set[int] = set()
+        self._loading: Optional[int] = None
+        self._lock = threading.Lock()
+        self.last_error: Optional[str] = None
+        self._counts = {
+            "searches": 0, "partial": 0, "failed": 0, "shard_timeouts": 0, "shard_errors": 0, "stale_replies": 0,
+        }
+
+    # ---- lifecycle ----
+    def start(self) -> None:
+        for i, client in enumerate(self.clients):
+            cmd = [
+                sys.executable, "-m", "app.shards",
+                "--shard", str(i), "--of", str(self.n_shards),
+                "--socket", client.address, "--strategy", self.strategy,
+            ]
+            self._procs.append(subprocess.Popen(cmd, cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))))
+
+        deadline = time.monotonic() + SHARD_CONNECT_TIMEOUT_S
+        for client in self.clients:
+            while True:
+                try:
+                    client.call({"op": "info"}, timeout_s=5.0)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        self.stop()
+                        raise ShardError(f"shard worker at {client.address} did not start")
+                    time.sleep(0.05)
+
+    def stop(self) -> None:
+        for client in self.clients:
+            client.close()
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self._procs = []
+        self._pool.shutdown(wait=False)
+
+    def load(self, version: int, background: bool = True) -> None:
+        """
+        Have every worker load `version`; searches for it are routed to shards
+        once all of them have it. Workers keep the newest generation they
+        already serve for leases still on it; anything older stops being
+        routed now, because the workers release it during this load.
+        """
+        with self._lock:
+            if version in self._ready or version == self._loading:
+                return
+            self._loading = version
+            keep = [max(self._ready)] if self._ready else []
+            self._ready = set(keep)
+
+        def _run() -> None:
+            try:
+                t0 = time.monotonic()
+                msg = {"op": "load", "version": version, "keep": keep}
+                futures = [self._pool.submit(c.call, msg, SHARD_LOAD_TIMEOUT_S) for c in self.clients]
+                rows = [f.result()["rows"] for f in futures]
+                with self._lock:
+                    self._ready.add(version)
+                print(f"[shards] generation {version}: {rows} rows over {self.n_shards} shards, {time.monotonic() - t0:.1f}s")
+            except Exception as exc:
+                self.last_error = f"{type(exc).__name__}: {exc}"
+                print(f"[shards] load failed for generation {version}: {self.last_error}")
+            finally:
+                with self._lock:
+                    if self._loading == version:
+                        self._loading = None
+
+        if background:
+            threading.Thread(target=_run, name=f"shard-load-{version}", daemon=True).start()
+        else:
+            _run()
+
+    def get(self, version: int) -> Optional["ShardView"]:
+        """A view pinned to `version` when every shard holds it, else None (the caller queries Chroma directly)."""
+        return ShardView(self, version) if version in self._ready else None
+
+    # ---- query path ----
+    def shards_for(self, allowed_depts: List[str]) -> List[int]:
+        if self.strategy == "department":
+            return sorted({shard_of("", {"department": d}, self.n_shards, "department") for d in allowed_depts})
+        return list(range(self.n_shards))
+
+    def search(
+        self, q_emb: List[float], allowed_depts: List[str], k: int, version: int, with_documents: bool = True
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Scatter to the relevant shards, gather within the deadline, merge to top-k.
+        Only replies for `version` count. Returns a Chroma-shaped query result,
+        or None when no shard answered in time.
+        """
+        targets = self.shards_for(allowed_depts)
+        if not targets:
+            return {}
+        msg = {
+            "op": "search", "q": list(q_emb), "depts": list(allowed_depts), "k": k, "docs": with_documents,
+            "version": version,
+        }
+        calls = {i: _Call() for i in targets}
+        futures = [self._pool.submit(carry(self.clients[i].call), msg, self.deadline_s, calls[i]) for i in targets]
+        done, not_done = wait(futures, timeout=self.deadline_s)
+        # Free the pool threads and sockets of shards that missed the deadline.
+        for fut, i in zip(futures, targets):
+            if fut in not_done:
+                fut.cancel()
+                calls[i].abort()
+
+        hits: List[Dict[str, Any]] = []
+        answered = timeouts = errors = stale = 0
+        for fut in done:
+            try:
+                reply = fut.result()
+            except (socket.timeout, TimeoutError):
+                timeouts += 1
+                continue
+            except Exception:
+                errors += 1
+                continue
+            if reply.get("version") != version:
+                stale += 1
+                continue
+            hits.extend(reply["hits"])
+            answered += 1
+        timeouts += len(not_done)
+
+        with self._lock:
+            self._counts["searches"] += 1
+            self._counts["shard_timeouts"] += timeouts
+            self._counts["shard_errors"] += errors
+            self._counts["stale_replies"] += stale
+            if answered == 0:
+                self._counts["failed"] += 1
+            elif answered < len(targets):
+                self._counts["partial"] += 1
+        if answered == 0:
+            return None
+
+        hits.sort(key=lambda h: -h["score"])
+        hits = hits[:k]
+        # Same shape as a Chroma query result; distance is squared L2 on unit vectors.
+        res = {
+            "ids": [[h["id"] for h in hits]],
+            "metadatas": [[h["metadata"] for h in hits]],
+            "distances": [[2.0 - 2.0 * h["score"] for h in hits]],
+        }
+        if with_documents:
+            res["documents"] = [[h["document"] for h in hits]]
+        return res
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "shards": self.n_shards,
+            "strategy": self.strategy,
+            "deadline_ms": round(self.deadline_s * 1000, 1),
+            "ready": sorted(self._ready),
+            "loading": self._loading,
+            "last_error": self.last_error,
+            **self._counts,
+        }
+
+
+class ShardView:
+    """The coordinator pinned to one generation: what a request holding that generation's lease searches."""
+
+    def __init__(self, coordinator: ShardCoordinator, version: int) -> None:
+        self.coordinator = coordinator
+        self.version = version
+
+    def search(
+        self, q_emb: List[float], allowed_depts: List[str], k: int, with_documents: bool = True
+    ) -> Optional[Dict[str, Any]]:
+        return self.coordinator.search(q_emb, allowed_depts, k, self.version, with_documents)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve one retrieval shard on a Unix socket (started by ShardCoordinator).")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--of", type=int, required=True, dest="n_shards")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--strategy", default=SHARD_STRATEGY, choices=("hash", "department"))
+    args = parser.parse_args()
+    serve_worker(args.shard, args.n_shards, args.socket, args.strategy)
+
+
+if __name__ == "__main__":
+    main()
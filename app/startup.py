@@ -0,0 +1,141 @@
+# app/startup.py
+# ============================================================
+# Startup benchmark with a budget (startup_budget.yaml).
+#
+# - Import time of each entry-point module, measured in a fresh
+#   interpreter per run, plus which heavy modules that import dragged in.
+# - Time to first answer: cold process -> RagRuntime() -> one question.
+#
+#   python -m app.startup [--budget startup_budget.yaml] [--json]
+#
+# Exits 1 when any number is over budget or a heavy module is imported
+# eagerly, so it can gate CI.
+# ============================================================
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from app.core import PROJECT_ROOT, load_yaml
+
+BUDGET_PATH = os.path.join(PROJECT_ROOT, "startup_budget.yaml")
+
+_IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+ms = (time.perf_counter() - t0) * 1000
+heavy = {heavy!r}
+print(json.dumps({{"ms": ms, "loaded": [m for m in heavy if m in sys.modules]}}))
+"""
+
+_ANSWER_PROBE = """
+import json, time
+t0 = time.perf_counter()
+from app.core import RagRuntime
+t1 = time.perf_counter()
+rt = RagRuntime()
+t2 = time.perf_counter()
+answer, citations = rt.answer({question!r}, rt.policy.current.departments({role!r}), [], mode={mode!r})
+t3 = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (t1 - t0) * 1000,
+    "init_ms": (t2 - t1) * 1000,
+    "answer_ms": (t3 - t2) * 1000,
+    "ms": (t3 - t0) * 1000,
+    "citations": len(citations),
+}}))
+"""
+
+
+def _run_probe(code: str, env: Dict[str, str]) -> Dict[str, Any]:
+    proc = subprocess.run(
+        [sys.executable, "-c", code], cwd=PROJECT_ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "probe failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def measure_import(module: str, heavy: List[str], repeat: int) -> Dict[str, Any]:
+    runs = [_run_probe(_IMPORT_PROBE.format(module=module, heavy=heavy), dict(os.environ)) for _ in range(repeat)]
+    return {
+        "ms": round(statistics.median(r["ms"] for r in runs), 1),
+        "loaded": sorted({m for r in runs for m in r["loaded"]}),
+    }
+
+
+def measure_first_answer(question: str, role: str, mode: str, repeat: int) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.setdefault("LLM_PROVIDER", "fake")
+    code = _ANSWER_PROBE.format(question=question, role=role, mode=mode)
+    runs = [_run_probe(code, env) for _ in range(repeat)]
+    return {
+        key: round(statistics.median(r[key] for r in runs), 1)
+        for key in ("import_ms", "init_ms", "answer_ms", "ms")
+    }
+
+
+def check(budget: Dict[str, Any]) -> Dict[str, Any]:
+    repeat = int(budget.get("repeat", 3))
+    heavy = list(budget.get("heavy_modules") or [])
+    failures: List[str] = []
+
+    imports: Dict[str, Any] = {}
+    for module, max_ms in (budget.get("imports") or {}).items():
+        try:
+            got = measure_import(module, heavy, repeat)
+        except RuntimeError as exc:
+            failures.append(f"import {module}: {exc}")
+            continue
+        got["max_ms"] = max_ms
+        imports[module] = got
+        if got["ms"] > max_ms:
+            failures.append(f"import {module}: {got['ms']}ms > {max_ms}ms")
+        if got["loaded"]:
+            failures.append(f"import {module}: eagerly loads {', '.join(got['loaded'])}")
+
+    first: Dict[str, Any] = {}
+    spec = budget.get("first_answer")
+    if spec:
+        try:
+            first = measure_first_answer(spec["question"], spec["role"], spec.get("mode", "extractive"), 1)
+            first["max_ms"] = spec["max_ms"]
+            if first["ms"] > spec["max_ms"]:
+                failures.append(f"first answer: {first['ms']}ms > {spec['max_ms']}ms")
+        except RuntimeError as exc:
+            failures.append(f"first answer: {exc}")
+
+    return {"imports": imports, "first_answer": first, "failures": failures, "ok": not failures}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check import time and time-to-first-answer against a budget.")
+    parser.add_argument("--budget", default=BUDGET_PATH)
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args()
+
+    report = check(load_yaml(args.budget))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for module, got in report["imports"].items():
+            extra = f"  loads: {', '.join(got['loaded'])}" if got["loaded"] else ""
+            print(f"[startup] import {module:<18} {got['ms']:>8.1f} ms  (budget {got['max_ms']}){extra}")
+        first = report["first_answer"]
+        if first:
+            print(
+                f"[startup] first answer          {first['ms']:>8.1f} ms  (budget {first['max_ms']}; "
+                f"import {first['import_ms']}, init {first['init_ms']}, answer {first['answer_ms']})"
+            )
+        for failure in report["failures"]:
+            print(f"[startup] FAIL: {failure}")
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# app/warmup.py
+# ============================================================
+# Cache warm-up driven by audit-log question frequency.
+#
+# - Mines audit_log.jsonl for the most frequent normalized RAG questions
+#   per role (fast-path intent answers are skipped; they never hit caches).
+# - Replays them through RagRuntime.answer with no history, which fills the
+#   query-embedding, parent and answer caches for the current index version.
+# - Bounded concurrency, a wall-clock budget and a cap on cache-missing
+#   (i.e. LLM-calling) replays. Stops early if the index swaps mid-run.
+#
+# The server runs it in the background at startup and after each index swap.
+# `python -m app.warmup` prints the plan that would be replayed.
+# ============================================================
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.core import PROJECT_ROOT
+from app.intents import normalize_question
+from app.policy import load_policy
+
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH") or os.path.join(PROJECT_ROOT, "audit_log.jsonl")
+
+WARMUP_TOP_N = 10              # questions per role
+WARMUP_CONCURRENCY = 2
+WARMUP_BUDGET_SECONDS = 120.0
+WARMUP_MAX_CALLS = 50          # replays that miss the answer cache (one LLM call each)
+
+_running = threading.Lock()
+
+
+def mine_top_questions(audit_path: str = AUDIT_LOG_PATH, top_n: int = WARMUP_TOP_N) -> Dict[str, List[Dict[str, Any]]]:
+    """role -> [{"question", "count"}], most frequent first. Keeps the most recent raw wording per normalized question."""
+    counts: Dict[str, Counter] = defaultdict(Counter)
+    wording: Dict[tuple, str] = {}
+
+    if not os.path.exists(audit_path):
+        return {}
+
+    with open(audit_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            # Batch regression runs are not user traffic.
+            if rec.get("mode", "rag") != "rag" or rec.get("source") == "batch":
+                continue
+            role, question = rec.get("role"), (rec.get("question") or "").strip()
+            norm = normalize_question(question)
+            if not role or not norm:
+                continue
+            counts[role][norm] += 1
+            wording[(role, norm)] = question
+
+    return {
+        role: [{"question": wording[(role, norm)], "count": n} for norm, n in c.most_common(top_n)]
+        for role, c in counts.items()
+    }
+
+
+def run_warmup(
+    runtime,
+    top_n: int = WARMUP_TOP_N,
+    concurrency: int = WARMUP_CONCURRENCY,
+    budget_seconds: float = WARMUP_BUDGET_SECONDS,
+    max_calls: int = WARMUP_MAX_CALLS,
+    audit_path: str = AUDIT_LOG_PATH,
+) -> Dict[str, Any]:
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    version = runtime.index.version
+    plan = mine_top_questions(audit_path, top_n)
+
+    policy = runtime.policy.current
+    jobs = []
+    for role, questions in plan.items():
+        role_plan = policy.plan(role)
+        if role_plan is None or not role_plan.departments:
+            continue
+        depts = list(role_plan.departments)
+        for q in questions:
+            jobs.append(
+                {"role": role, "question": q["question"], "count": q["count"], "depts": depts, "plan": role_plan}
+            )
+    # Most frequent questions first, across roles, so a tight budget warms what matters most.
+    jobs.sort(key=lambda j: -j["count"])
+
+    calls = 0
+    calls_lock = threading.Lock()
+
+    def warm(job: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal calls
+        entry = {"role": job["role"], "question": job["question"], "count": job["count"]}
+        if runtime.index.version != version:
+            return {**entry, "status": "stale"}
+        if time.monotonic() > deadline:
+            return {**entry, "status": "skipped_budget"}
+        if runtime.answer_cache_key(job["question"], job["depts"], version) in runtime.answer_cache:
+            return {**entry, "status": "cached"}
+        with calls_lock:
+            if calls >= max_calls:
+                return {**entry, "status": "skipped_budget"}
+            calls += 1
+
+        t0 = time.monotonic()
+        try:
+            runtime.answer(question=job["question"], allowed_depts=job["depts"], history=[], plan=job["plan"])
+        except Exception as exc:
+            return {**entry, "status": "error", "error": str(exc)}
+        return {**entry, "status": "warmed", "ms": round((time.monotonic() - t0) * 1000, 1)}
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="warmup") as pool:
+        entries = list(pool.map(warm, jobs))
+
+    by_status = Counter(e["status"] for e in entries)
+    return {
+        "index_version": version,
+        "elapsed_s": round(time.monotonic() - started, 2),
+        "planned": len(jobs),
+        "warmed": by_status.get("warmed", 0),
+        "already_cached": by_status.get("cached", 0),
+        "skipped_budget": by_status.get("skipped_budget", 0),
+        "stale": by_status.get("stale", 0),
+        "errors": by_status.get("error", 0),
+        "entries": entries,
+    }
+
+
+def start_background_warmup(runtime, **kwargs: Any) -> Optional[threading.Thread]:
+    """Run a warm-up in a daemon thread unless one is already running. The report lands on runtime.warmup_report."""
+    if not _running.acquire(blocking=False):
+        return None
+
+    def _run() -> None:
+        try:
+            report = run_warmup(runtime, **kwargs)
+            runtime.warmup_report = report
+            print(
+                f"[warmup] index={report['index_version']} warmed={report['warmed']} "
+                f"cached={report['already_cached']} skipped={report['skipped_budget']} "
+                f"errors={report['errors']} in {report['elapsed_s']}s"
+            )
+        except Exception as exc:
+            print(f"[warmup] failed: {exc}")
+        finally:
+            _running.release()
+
+    t = threading.Thread(target=_run, name="cache-warmup", daemon=True)
+    t.start()
+    return t
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Show the cache warm-up plan mined from the audit log.")
+    parser.add_argument("--audit-log", default=AUDIT_LOG_PATH)
+    parser.add_argument("--top", type=int, default=WARMUP_TOP_N)
+    args = parser.parse_args()
+
+    policy = load_policy()
+    plan = mine_top_questions(args.audit_log, args.top)
+    for role, questions in sorted(plan.items()):
+        allowed = policy.departments(role)
+        print(f"\n[{role}] allowed={allowed}" + ("" if allowed else "  (no access configured, skipped)"))
+        for q in questions:
+            print(f"  {q['count']:>5}  {q['question']}")
+
+
+if __name__ == "__main__":
+    main()
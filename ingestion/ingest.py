@@ -8,24 +8,35 @@
 #     rt_children: smaller semantic chunks (children)
 #
 # IMPORTANT DESIGN:
-# - run_ingestion() accepts an optional `client`.
+# - rebuild_index() accepts an optional `client`.
 #   * Local CLI run: client=None -> PersistentClient(chroma_db/)
 #   * Streamlit Cloud: UI passes in-memory client -> index builds in same memory DB
+#
+# GENERATIONS (hot reload):
+# - Each full or delta build writes a fresh pair of collections
+#   (rt_parents__gN / rt_children__gN) and then flips the active pointer in
+#   chroma_db/generations.json. Readers keep using the old pair until they
+#   are done with it, so nothing ever queries a half-built index.
+# - Generation numbers are allocated through generations.json under a file
+#   lock, so the CLI and a running server never build into the same pair.
+#   A build that finishes after a newer generation went live is discarded.
+# - Each server process pins the generations it still reads
+#   (generations.json.pins/<pid>.json). Old generations are dropped only
+#   once no live process pins them.
+# - Generation 0 keeps the legacy names (rt_parents / rt_children).
 # ============================================================
 
+import fcntl
+import json
 import os
 import re
 import uuid
-from typing import List, Optional
-
-import chromadb
-from chromadb.config import Settings
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-# PDF reader
-try:
-    from pypdf import PdfReader
-except Exception:
-    PdfReader = None  # handled gracefully
+# chromadb and pypdf are imported where they are used, so that importing this
+# module (for paths, manifests, collection names) stays cheap for the API server.
 
 
 # ---------------------------
@@ -37,6 +48,10 @@ CHROMA_PATH = os.path.join(PROJECT_ROOT, "chroma_db")
 
 PARENTS_COLLECTION = "rt_parents"
 CHILDREN_COLLECTION = "rt_children"
+GENERATIONS_STATE_PATH = os.path.join(CHROMA_PATH, "generations.json")
+
+SUPPORTED_EXTS = (".md", ".txt", ".pdf")
+COPY_BATCH_SIZE = 512
 
 
 # ---------------------------
@@ -85,7 +100,9 @@ def _read_text_file(path: str) -> str:
 
 
 def _read_pdf(path: str) -> str:
-    if PdfReader is None:
+    try:
+        from pypdf import PdfReader
+    except Exception:
         raise RuntimeError("pypdf is not installed but a PDF was found. Add `pypdf` to requirements.txt")
 
     r = PdfReader(path)
@@ -95,6 +112,21 @@ def _read_pdf(path: str) -> str:
     return _clean_text("\n".join(out))
 
 
+def read_document(rel: str, data_root: str = DATA_ROOT) -> str:
+    """Cleaned text of one corpus file (path relative to data_root)."""
+    abs_path = os.path.join(data_root, rel)
+    return _read_pdf(abs_path) if rel.lower().endswith(".pdf") else _read_text_file(abs_path)
+
+
+def corpus_chunks(data_root: str = DATA_ROOT) -> List[str]:
+    """Every child chunk of the corpus, split exactly as ingestion does (for embedder checks/benchmarks)."""
+    chunks: List[str] = []
+    for rel in sorted(scan_corpus(data_root)):
+        for parent in _split_text(read_document(rel, data_root), PARENT_CHARS, PARENT_OVERLAP):
+            chunks.extend(_split_text(parent, CHILD_CHARS, CHILD_OVERLAP))
+    return chunks
+
+
 def _dept_from_rel(rel: str) -> str:
     # Example data layout:
     # data/internal/hr/xxx.md -> dept = hr
@@ -113,7 +145,10 @@ def _source_display(rel: str) -> str:
 # ---------------------------
 # Client creation (local default)
 # ---------------------------
-def _persistent_client() -> chromadb.PersistentClient:
+def _persistent_client():
+    import chromadb
+    from chromadb.config import Settings
+
     return chromadb.PersistentClient(
         path=CHROMA_PATH,
         settings=Settings(anonymized_telemetry=False),
@@ -121,110 +156,360 @@ def _persistent_client() -> chromadb.PersistentClient:
 
 
 # ---------------------------
-# Main ingestion
+# Per-file ingestion
 # ---------------------------
-def run_ingestion(clear_existing: bool = True, client: Optional[chromadb.Client] = None) -> int:
-    """
-    Build the index into Chroma.
+def _embed(embedder, docs: List[str]) -> Dict[str, Any]:
+    if embedder is None:
+        return {}
+    return {"embeddings": embedder.encode(docs, normalize_embeddings=True, batch_size=64).tolist()}
 
-    Args:
-      clear_existing: wipe collections before adding
-      client: if provided, ingestion writes into this client (used by Streamlit Cloud in-memory)
 
-    Returns:
-      total number of child chunks added
+def _ingest_file(parents_col, children_col, rel: str, embedder=None) -> int:
     """
-    if not os.path.isdir(DATA_ROOT):
-        raise FileNotFoundError(f"Missing data folder: {DATA_ROOT}")
+    Chunk one file under DATA_ROOT into the given collections. Returns child count.
+    Without an embedder, Chroma's default embedding function embeds the chunks.
+    """
+    dept = _dept_from_rel(rel)
+    text = read_document(rel)
+    if not text:
+        return 0
+
+    # Parent chunks
+    parents = _split_text(text, PARENT_CHARS, PARENT_OVERLAP)
+
+    parent_ids, parent_docs, parent_metas = [], [], []
+    child_ids, child_docs, child_metas = [], [], []
+
+    for p_idx, ptxt in enumerate(parents):
+        pid = str(uuid.uuid4())
+        parent_ids.append(pid)
+        parent_docs.append(ptxt)
+        parent_metas.append(
+            {
+                "department": dept,
+                "source": _source_display(rel),
+                "rel_path": rel,
+                "parent_index": p_idx,
+            }
+        )
+
+        # Child chunks from each parent
+        children = _split_text(ptxt, CHILD_CHARS, CHILD_OVERLAP)
+        for c_idx, ctxt in enumerate(children):
+            cid = f"{pid}:{c_idx}"
+            child_ids.append(cid)
+            child_docs.append(ctxt)
+            child_metas.append(
+                {
+                    "department": dept,
+                    "source": _source_display(rel),
+                    "rel_path": rel,
+                    "parent_id": pid,
+                    "parent_index": p_idx,
+                    "child_index": c_idx,
+                }
+            )
+
+    if parent_ids:
+        parents_col.add(ids=parent_ids, documents=parent_docs, metadatas=parent_metas, **_embed(embedder, parent_docs))
+
+    if child_ids:
+        children_col.add(ids=child_ids, documents=child_docs, metadatas=child_metas, **_embed(embedder, child_docs))
+
+    print(f"[ingest] {rel} -> {len(child_ids)} child chunks (dept={dept})")
+    return len(child_ids)
 
-    if client is None:
-        client = _persistent_client()
 
-    parents_col = client.get_or_create_collection(PARENTS_COLLECTION)
-    children_col = client.get_or_create_collection(CHILDREN_COLLECTION)
+# ---------------------------
+# Corpus scanning
+# ---------------------------
+def scan_corpus(data_root: str = DATA_ROOT) -> Dict[str, List[float]]:
+    """Map every ingestible file (relative path) to its [mtime, size] fingerprint."""
+    manifest: Dict[str, List[float]] = {}
+    for dirpath, _, filenames in os.walk(data_root):
+        for fn in filenames:
+            if not fn.lower().endswith(SUPPORTED_EXTS):
+                continue
+            abs_path = os.path.join(dirpath, fn)
+            rel = os.path.relpath(abs_path, data_root).replace("\\", "/")
+            st = os.stat(abs_path)
+            manifest[rel] = [st.st_mtime, st.st_size]
+    return manifest
+
 
-    if clear_existing:
+def diff_manifests(old: Dict[str, List[float]], new: Dict[str, List[float]]) -> Dict[str, List[str]]:
+    added = sorted(r for r in new if r not in old)
+    removed = sorted(r for r in old if r not in new)
+    changed = sorted(r for r in new if r in old and list(old[r]) != list(new[r]))
+    return {"added": added, "changed": changed, "removed": removed}
+
+
+# ---------------------------
+# Generations (double-buffered collections)
+# ---------------------------
+def collection_names(generation: int) -> Tuple[str, str]:
+    if generation == 0:
+        return PARENTS_COLLECTION, CHILDREN_COLLECTION
+    return f"{PARENTS_COLLECTION}__g{generation}", f"{CHILDREN_COLLECTION}__g{generation}"
+
+
+def load_generation_state(path: Optional[str] = GENERATIONS_STATE_PATH) -> Dict[str, Any]:
+    """Read the active-generation pointer. A missing file means legacy generation 0."""
+    state: Dict[str, Any] = {"active": 0, "built_at": None, "manifest": {}}
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            state.update(json.load(f) or {})
+    return state
+
+
+def save_generation_state(state: Dict[str, Any], path: Optional[str] = GENERATIONS_STATE_PATH) -> None:
+    """Atomically replace the pointer file so readers never see a partial write."""
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _state_lock(path: Optional[str]) -> Iterator[None]:
+    """Exclusive lock shared by every process that allocates or activates generations."""
+    if not path:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
         try:
-            parents_col.delete(where={})
-        except Exception:
-            pass
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def allocate_generation(path: Optional[str], in_use: int = 0) -> int:
+    """
+    Reserve the next generation number. The highest number handed out is kept
+    in the state file, so concurrent builders always get distinct ones.
+    `in_use` is the highest number the caller knows of (e.g. one draining).
+    """
+    with _state_lock(path):
+        state = load_generation_state(path)
+        generation = max(in_use, int(state.get("active", 0)), int(state.get("allocated", 0))) + 1
+        state["allocated"] = generation
+        save_generation_state(state, path)
+    return generation
+
+
+def activate_generation(state: Dict[str, Any], path: Optional[str]) -> bool:
+    """Flip the pointer to state["active"]. Returns False, leaving the pointer alone, if a newer one is live."""
+    with _state_lock(path):
+        on_disk = load_generation_state(path)
+        if int(on_disk.get("active", 0)) > int(state["active"]):
+            return False
+        state["allocated"] = max(int(on_disk.get("allocated", 0)), int(state["active"]))
+        save_generation_state(state, path)
+    return True
+
+
+def _pins_dir(path: str) -> str:
+    return f"{path}.pins"
+
+
+def pin_generations(path: Optional[str], generations: Iterable[int]) -> None:
+    """Record the generations this process still reads; replaces its previous pin."""
+    if not path:
+        return
+    os.makedirs(_pins_dir(path), exist_ok=True)
+    pin = os.path.join(_pins_dir(path), f"{os.getpid()}.json")
+    with open(f"{pin}.tmp", "w", encoding="utf-8") as f:
+        json.dump(sorted(set(generations)), f)
+    os.replace(f"{pin}.tmp", pin)
+
+
+def pinned_generations(path: Optional[str], exclude_self: bool = False) -> Set[int]:
+    """Generations pinned by live processes. Pins left behind by dead processes are removed."""
+    pinned: Set[int] = set()
+    if not path or not os.path.isdir(_pins_dir(path)):
+        return pinned
+    for name in os.listdir(_pins_dir(path)):
+        if not name.endswith(".json") or not name[:-5].isdigit():
+            continue
+        pid = int(name[:-5])
+        if exclude_self and pid == os.getpid():
+            continue
+        pin = os.path.join(_pins_dir(path), name)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            try:
+                os.remove(pin)
+            except OSError:
+                pass
+            continue
+        except PermissionError:
+            pass   # alive, owned by another user
+        try:
+            with open(pin, "r", encoding="utf-8") as f:
+                pinned.update(int(g) for g in json.load(f))
+        except (OSError, ValueError):
+            continue
+    return pinned
+
+
+def drop_generation(client, generation: int) -> None:
+    for name in collection_names(generation):
         try:
-            children_col.delete(where={})
+            client.delete_collection(name)
         except Exception:
             pass
 
-    total_children = 0
 
-    for dirpath, _, filenames in os.walk(DATA_ROOT):
-        for fn in filenames:
-            low = fn.lower()
-            if not (low.endswith(".md") or low.endswith(".txt") or low.endswith(".pdf")):
-                continue
+def _copy_rows(src, dst, rel_paths: Iterable[str]) -> int:
+    """Copy the rows of the given files (with their stored embeddings) from src to dst."""
+    keep = sorted(set(rel_paths))
+    if not keep:
+        return 0
+    where = {"rel_path": {"$in": keep}}
+
+    copied = 0
+    offset = 0
+    while True:
+        got = src.get(
+            where=where,
+            limit=COPY_BATCH_SIZE,
+            offset=offset,
+            include=["documents", "metadatas", "embeddings"],
+        )
+        ids = got.get("ids") or []
+        if not ids:
+            break
+        dst.add(
+            ids=ids,
+            documents=got.get("documents"),
+            metadatas=got.get("metadatas"),
+            embeddings=got.get("embeddings"),
+        )
+        copied += len(ids)
+        offset += len(ids)
+    return copied
+
+
+def build_generation(
+    client,
+    base_generation: Optional[int],
+    generation: int,
+    base_manifest: Dict[str, List[float]],
+    manifest: Dict[str, List[float]],
+    embedder=None,
+) -> Dict[str, Any]:
+    """
+    Build `generation` as base + delta. Unchanged files are copied row-for-row
+    from the base collections (no re-embedding); added/changed files are
+    re-chunked; removed files are simply not carried over.
 
-            abs_path = os.path.join(dirpath, fn)
-            rel = os.path.relpath(abs_path, DATA_ROOT).replace("\\", "/")
-            dept = _dept_from_rel(rel)
+    With base_generation=None this is a full rebuild.
+    """
+    delta = diff_manifests(base_manifest, manifest)
+    touched: Set[str] = set(delta["added"]) | set(delta["changed"])
+
+    # Start from a clean slate in case an earlier build of this generation died halfway.
+    drop_generation(client, generation)
+    parents_name, children_name = collection_names(generation)
+    parents_col = client.get_or_create_collection(parents_name)
+    children_col = client.get_or_create_collection(children_name)
+
+    copied = 0
+    to_ingest = sorted(manifest)
+    if base_generation is not None:
+        unchanged = [r for r in manifest if r in base_manifest and r not in touched]
+        base_parents_name, base_children_name = collection_names(base_generation)
+        _copy_rows(client.get_or_create_collection(base_parents_name), parents_col, unchanged)
+        copied = _copy_rows(client.get_or_create_collection(base_children_name), children_col, unchanged)
+        to_ingest = sorted(touched)
+
+    added_children = 0
+    for rel in to_ingest:
+        added_children += _ingest_file(parents_col, children_col, rel, embedder)
+
+    print(
+        f"[ingest] built generation {generation}: copied={copied} new={added_children} "
+        f"(+{len(delta['added'])} ~{len(delta['changed'])} -{len(delta['removed'])} files)"
+    )
+    return {
+        "active": generation,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "manifest": manifest,
+        "delta": delta,
+    }
+
+
+def rebuild_index(
+    client: Optional[Any] = None,
+    full: bool = True,
+    state_path: Optional[str] = GENERATIONS_STATE_PATH,
+    embedder=None,
+) -> Dict[str, Any]:
+    """
+    Build the next generation next to the active one and flip the pointer.
+    The previous generation is left in place for readers still using it
+    (a running API server retires it once drained). Older ones are dropped
+    unless a live server process still pins them.
+    """
+    if not os.path.isdir(DATA_ROOT):
+        raise FileNotFoundError(f"Missing data folder: {DATA_ROOT}")
 
-            # Read file
-            if low.endswith(".pdf"):
-                text = _read_pdf(abs_path)
-            else:
-                text = _read_text_file(abs_path)
+    if client is None:
+        client = _persistent_client()
 
-            if not text:
-                continue
+    state = load_generation_state(state_path)
+    active = int(state.get("active", 0))
+    base = None if full else active
+    base_manifest = {} if full else (state.get("manifest") or {})
 
-            # Parent chunks
-            parents = _split_text(text, PARENT_CHARS, PARENT_OVERLAP)
-
-            parent_ids, parent_docs, parent_metas = [], [], []
-            child_ids, child_docs, child_metas = [], [], []
-
-            for p_idx, ptxt in enumerate(parents):
-                pid = str(uuid.uuid4())
-                parent_ids.append(pid)
-                parent_docs.append(ptxt)
-                parent_metas.append(
-                    {
-                        "department": dept,
-                        "source": _source_display(rel),
-                        "rel_path": rel,
-                        "parent_index": p_idx,
-                    }
-                )
-
-                # Child chunks from each parent
-                children = _split_text(ptxt, CHILD_CHARS, CHILD_OVERLAP)
-                for c_idx, ctxt in enumerate(children):
-                    cid = f"{pid}:{c_idx}"
-                    child_ids.append(cid)
-                    child_docs.append(ctxt)
-                    child_metas.append(
-                        {
-                            "department": dept,
-                            "source": _source_display(rel),
-                            "rel_path": rel,
-                            "parent_id": pid,
-                            "parent_index": p_idx,
-                            "child_index": c_idx,
-                        }
-                    )
-
-            if parent_ids:
-                parents_col.add(ids=parent_ids, documents=parent_docs, metadatas=parent_metas)
-
-            if child_ids:
-                children_col.add(ids=child_ids, documents=child_docs, metadatas=child_metas)
-                total_children += len(child_ids)
-
-            print(f"[ingest] {rel} -> {len(child_ids)} child chunks (dept={dept})")
-
-    print(f"[ingest] done total_child_chunks={total_children}")
-    return total_children
+    generation = allocate_generation(state_path, active)
+    new_state = build_generation(client, base, generation, base_manifest, scan_corpus(), embedder)
+    if not activate_generation(new_state, state_path):
+        # A newer build went live while this one ran; serving this one would roll the index back.
+        drop_generation(client, generation)
+        print(f"[ingest] discarded generation {generation}: a newer generation is already active")
+        return load_generation_state(state_path)
+
+    pinned = pinned_generations(state_path)
+    for g in range(active):
+        if g not in pinned:
+            drop_generation(client, g)
+    return new_state
 
 
 def main():
-    run_ingestion(clear_existing=True, client=None)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild the vector index into a new generation.")
+    parser.add_argument(
+        "--embedder-socket",
+        default=os.environ.get("EMBEDDER_SOCKET"),
+        help="embed with the shared embedding server (python -m app.embed_server) instead of Chroma's default",
+    )
+    parser.add_argument(
+        "--embedder-backend",
+        default=None,
+        choices=["torch", "onnx", "onnx-int8"],
+        help="embed in-process with this app.embedding backend instead of Chroma's default",
+    )
+    args = parser.parse_args()
+
+    embedder = None
+    if args.embedder_socket:
+        from app.embed_server import EmbeddingClient
+
+        embedder = EmbeddingClient(args.embedder_socket)
+    elif args.embedder_backend:
+        from app.embedding import load_embedder
+
+        embedder = load_embedder(backend=args.embedder_backend)
+    rebuild_index(client=None, full=True, embedder=embedder)
 
 
 if __name__ == "__main__":